@@ -1,11 +1,10 @@
-var initQuery = function() {
-  // See if we have a search box
-  var searchInput = document.querySelector('input#lunr_search');
-  if (searchInput === null) {
-    return;
-  }
+// Prebuilt indexes, one per chapter, written by scripts/build_search_index.py
+var searchIndexUrl = '{{ "/assets/search/" | relative_url }}';
+// The URLs in them are relative to the root of the site, which may be served under a subpath
+var siteBaseUrl = '{{ site.baseurl }}';
 
-  // Function to parse our lunr cache
+// Index built in the browser from the store, if there are no prebuilt indexes
+var storeIndex = function () {
   var idx = lunr(function () {
     this.field('title')
     this.field('excerpt')
@@ -25,13 +24,79 @@ var initQuery = function() {
       })
     }
   });
+  return { index: idx, store: store };
+};
 
-  // Run search upon keyup
-  searchInput.addEventListener('keyup', function () {
+var searchItem = function (entry) {
+  var teaser = '';
+  if (entry.teaser) {
+    teaser =
+      '<div class="archive__item-teaser">'+
+        '<img src="'+entry.teaser+'" alt="">'+
+      '</div>';
+  }
+  return '<div class="list__item">'+
+      '<article class="archive__item" itemscope itemtype="https://schema.org/CreativeWork">'+
+        '<h2 class="archive__item-title" itemprop="headline">'+
+          '<a href="'+entry.url+'" rel="permalink">'+entry.title+'</a>'+
+        '</h2>'+
+        teaser+
+        '<p class="archive__item-excerpt" itemprop="description">'+entry.excerpt.split(" ").splice(0,20).join(" ")+'...</p>'+
+      '</article>'+
+    '</div>';
+};
+
+var initQuery = function() {
+  // See if we have a search box
+  var searchInput = document.querySelector('input#lunr_search');
+  if (searchInput === null) {
+    return;
+  }
+
+  // The chapters are only downloaded once there is something to search for, and
+  // results are shown as each one arrives
+  var params = new URLSearchParams(window.location.search);
+  var locale = params.get('locale') || 'en';
+  var chapter = params.get('chapter');
+  var shards = [];
+  var loading = null;
+  var loadShards = function () {
+    if (loading !== null) {
+      return;
+    }
+    loading = fetch(searchIndexUrl + locale + '/manifest.json')
+      .then(function (response) {
+        if (!response.ok) { throw new Error(response.statusText) }
+        return response.json()
+      })
+      .then(function (manifest) {
+        return Promise.all(manifest.shards
+          .filter(function (shard) { return !chapter || shard.name === chapter })
+          .map(function (shard) {
+            return fetch(searchIndexUrl + locale + '/' + shard.name + '.json')
+              .then(function (response) { return response.json() })
+              .then(function (data) {
+                for (var ref in data.store) {
+                  data.store[ref].url = siteBaseUrl + data.store[ref].url;
+                }
+                shards.push({ index: lunr.Index.load(data.index), store: data.store });
+                showResults();
+              })
+          }))
+      })
+      .catch(function (err) {
+        console.warn('Building the search index in the browser:', err);
+        shards = [storeIndex()];
+        showResults();
+      });
+  };
+
+  var showResults = function () {
     var resultdiv = document.querySelector('#results');
     var query = document.querySelector("input#lunr_search").value.toLowerCase();
-    var result =
-      idx.query(function (q) {
+    var result = [];
+    shards.forEach(function (shard) {
+      shard.index.query(function (q) {
         query.split(lunr.tokenizer.separator).forEach(function (term) {
           q.term(term, { boost: 100 })
           if(query.lastIndexOf(" ") != query.length-1){
@@ -41,43 +106,27 @@ var initQuery = function() {
             q.term(term, {  usePipeline: false, editDistance: 1, boost: 1 })
           }
         })
+      }).forEach(function (match) {
+        result.push({ score: match.score, entry: shard.store[match.ref] });
       });
+    });
+    result.sort(function (a, b) { return b.score - a.score });
 
-      // Empty the results div
-      while (resultdiv.firstChild) {
-        resultdiv.removeChild(resultdiv.firstChild);
-      }
+    // Empty the results div
+    while (resultdiv.firstChild) {
+      resultdiv.removeChild(resultdiv.firstChild);
+    }
 
     resultdiv.insertAdjacentHTML('afterbegin', '<p class="results__found">'+result.length+' Result(s) found</p>');
     for (var item in result) {
-      var ref = result[item].ref;
-      if(store[ref].teaser){
-        var searchitem =
-          '<div class="list__item">'+
-            '<article class="archive__item" itemscope itemtype="https://schema.org/CreativeWork">'+
-              '<h2 class="archive__item-title" itemprop="headline">'+
-                '<a href="'+store[ref].url+'" rel="permalink">'+store[ref].title+'</a>'+
-              '</h2>'+
-              '<div class="archive__item-teaser">'+
-                '<img src="'+store[ref].teaser+'" alt="">'+
-              '</div>'+
-              '<p class="archive__item-excerpt" itemprop="description">'+store[ref].excerpt.split(" ").splice(0,20).join(" ")+'...</p>'+
-            '</article>'+
-          '</div>';
-      }
-      else{
-    	  var searchitem =
-          '<div class="list__item">'+
-            '<article class="archive__item" itemscope itemtype="https://schema.org/CreativeWork">'+
-              '<h2 class="archive__item-title" itemprop="headline">'+
-                '<a href="'+store[ref].url+'" rel="permalink">'+store[ref].title+'</a>'+
-              '</h2>'+
-              '<p class="archive__item-excerpt" itemprop="description">'+store[ref].excerpt.split(" ").splice(0,20).join(" ")+'...</p>'+
-            '</article>'+
-          '</div>';
-      }
-      resultdiv.insertAdjacentHTML('beforeend', searchitem);
+      resultdiv.insertAdjacentHTML('beforeend', searchItem(result[item].entry));
     }
+  };
+
+  // Run search upon keyup
+  searchInput.addEventListener('keyup', function () {
+    loadShards();
+    showResults();
   });
 };
 
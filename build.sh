@@ -11,4 +11,5 @@ then
 fi
 
 bundle exec jekyll build --baseurl "${path}" 
+python3 scripts/optimize_html.py compress _site
 touch _site/.nojekyll
@@ -15,6 +15,69 @@ from IPython.display import display
 
 from qiskit_textbook.widgets._helpers import _img
 
+
+def _fwht(a):
+    # Fast Walsh-Hadamard transform along the last axis of `a`, whose length must be a power of two.
+
+    a = np.array(a)
+    d = a.shape[-1]
+    h = 1
+    while h < d:
+        b = a.reshape(a.shape[:-1] + (d//(2*h), 2, h))
+        lo = b[..., 0, :].copy()
+        b[..., 0, :] += b[..., 1, :]
+        b[..., 1, :] = lo - b[..., 1, :]
+        h *= 2
+    return a
+
+def _pauli_label(x, z, n):
+    # Label of the Pauli with X part `x` and Z part `z` (as bitmasks), with character j acting on qubit j.
+
+    return ''.join( 'IXZY'[((x>>j)&1) + 2*((z>>j)&1)] for j in range(n) )
+
+def pauli_expectations(state, num_qubits=None):
+    """
+    Returns a dict with the expectation values of all 4^n Pauli operators (except the identity) for the given state.
+
+    state
+        A statevector or density matrix, either as a qiskit.quantum_info object or as a numpy array.
+    num_qubits=None
+        Number of qubits. If not supplied, this is determined from the dimension of the state.
+
+    The labels follow the conventions of pauli_grid, with character j of a label acting on qubit j.
+    The expectation value of X^x Z^z is sum_k (-1)^(z.k) rho[k,k^x], so a single Walsh-Hadamard
+    transform over k gives the values for all z at once, and all of them are found in O(n 4^n).
+    """
+
+    state = np.asarray(getattr(state, 'data', state), dtype=complex)
+    dim = state.shape[0]
+    if num_qubits is None:
+        num_qubits = int(np.log2(dim))
+    if dim != 2**num_qubits:
+        raise ValueError("State dimension %i does not match %i qubits." % (dim, num_qubits))
+
+    k = np.arange(dim)
+    x = k[:,None]
+    # f[x,k] = rho[k,k^x]
+    if state.ndim == 1:
+        f = state[None,:]*np.conj(state[k[None,:]^x])
+    else:
+        f = state[k[None,:],k[None,:]^x]
+    f = _fwht(f)
+
+    # phase i^|x&z| turns X^x Z^z into the Pauli with Y wherever both x and z act
+    weight = np.zeros((dim,dim), dtype=int)
+    for j in range(num_qubits):
+        weight += ((x>>j)&1) & ((k[None,:]>>j)&1)
+    values = np.real(f*(1j)**weight)
+
+    expectations = {}
+    for xx in range(dim):
+        for zz in range(dim):
+            if xx or zz:
+                expectations[_pauli_label(xx, zz, num_qubits)] = values[xx,zz]
+    return expectations
+
 class run_game():
     # Implements a puzzle, which is defined by the given inputs.
 
@@ -247,36 +310,69 @@ class run_game():
 class pauli_grid():
     # Allows a quantum circuit to be created, modified and implemented, and visualizes the output in the style of 'Hello Quantum'.
 
-    def __init__(self,backend=Aer.get_backend('aer_simulator'),shots=1024,mode='circle',y_boxes=False):
+    def __init__(self,backend=Aer.get_backend('aer_simulator'),shots=1024,mode='circle',y_boxes=False,num_qubits=2,paulis=None):
         """
         backend=Aer.get_backend('aer_simulator')
             Backend to be used by Qiskit to calculate expectation values (defaults to local simulator).
+            If None, or if num_qubits is not 2, expectation values are calculated exactly from the statevector.
         shots=1024
             Number of shots used to to calculate expectation values.
         mode='circle'
             Either the standard 'Hello Quantum' visualization can be used (with mode='circle') or the alternative line based one (mode='line').
         y_boxes=True
             Whether to display full grid that includes Y expectation values.
+        num_qubits=2
+            Number of qubits. For anything other than 2, the grid is laid out automatically.
+        paulis=None
+            List of Pauli labels (such as 'XIZ', with character j acting on qubit j) for which boxes are drawn.
+            If None, the standard grid is used for 2 qubits, and single qubit X and Z with neighbouring
+            two qubit correlations are used otherwise.
         """
 
         self.backend = backend
         self.shots = shots
+        self.num_qubits = num_qubits
 
         self.y_boxes = y_boxes
         if self.y_boxes:
-            self.box = {'ZI':(-1, 2),'XI':(-3, 4),'IZ':( 1, 2),'IX':( 3, 4),'ZZ':( 0, 3),'ZX':( 2, 5),'XZ':(-2, 5),'XX':( 0, 7),
+            box = {'ZI':(-1, 2),'XI':(-3, 4),'IZ':( 1, 2),'IX':( 3, 4),'ZZ':( 0, 3),'ZX':( 2, 5),'XZ':(-2, 5),'XX':( 0, 7),
                         'YY':(0,5), 'YI':(-2,3), 'IY':(2,3), 'YZ':(-1,4), 'ZY':(1,4), 'YX':(1,6), 'XY':(-1,6) }
         else:
-            self.box = {'ZI':(-1, 2),'XI':(-2, 3),'IZ':( 1, 2),'IX':( 2, 3),'ZZ':( 0, 3),'ZX':( 1, 4),'XZ':(-1, 4),'XX':( 0, 5)}
+            box = {'ZI':(-1, 2),'XI':(-2, 3),'IZ':( 1, 2),'IX':( 2, 3),'ZZ':( 0, 3),'ZX':( 1, 4),'XZ':(-1, 4),'XX':( 0, 5)}
+
+        if num_qubits==2 and (paulis is None or all(pauli in box for pauli in paulis)):
+            if paulis is None:
+                self.box = box
+            else:
+                self.box = {pauli:box[pauli] for pauli in paulis}
+            if self.y_boxes:
+                self.limits = ([-4,4],[0,8])
+            else:
+                self.limits = ([-3,3],[0,6])
+            text_x = -3
+        else:
+            if paulis is None:
+                ps = 'XYZ' if self.y_boxes else 'XZ'
+                paulis = []
+                for j in range(num_qubits):
+                    for p in ps:
+                        paulis.append( 'I'*j + p + 'I'*(num_qubits-j-1) )
+                for j in range(num_qubits-1):
+                    for p in ps:
+                        for pp in ps:
+                            paulis.append( 'I'*j + p + pp + 'I'*(num_qubits-j-2) )
+            self.box, self.limits = self._layout(paulis)
+            text_x = self.limits[0][0]
 
         self.rho = {}
         for pauli in self.box:
-            self.rho[pauli] = 0.0
-        for pauli in ['ZI','IZ','ZZ']:
-            self.rho[pauli] = 1.0
+            if set(pauli)<=set('IZ'):
+                self.rho[pauli] = 1.0
+            else:
+                self.rho[pauli] = 0.0
 
-        self.qr = QuantumRegister(2)
-        self.cr = ClassicalRegister(2)
+        self.qr = QuantumRegister(num_qubits)
+        self.cr = ClassicalRegister(num_qubits)
         self.qc = QuantumCircuit(self.qr, self.cr)
 
         self.mode = mode
@@ -295,16 +391,49 @@ class pauli_grid():
         self.ax = self.fig.add_subplot(111)
         plt.axis('off')
 
-        self.bottom = self.ax.text(-3,1,"",size=9,va='top',color='w')
+        self.bottom = self.ax.text(text_x,1,"",size=9,va='top',color='w')
 
         self.points = {}
         for pauli in self.box:
             self.points[pauli] = [ self.ax.add_patch( Circle(self.box[pauli], 0.0, color=(0,0,0), zorder=10) ) ]
             self.points[pauli].append( self.ax.add_patch( Circle(self.box[pauli], 0.0, color=(1,1,1), zorder=10) ) )
 
-
-    def get_rho(self):
+    @staticmethod
+    def _layout(paulis):
+        # Places the boxes for the given Paulis in rows, with one block of rows for each weight.
+        # Returns the box positions and the (square) axis limits.
+
+        groups = {}
+        for pauli in paulis:
+            weight = len(pauli) - pauli.count('I')
+            groups.setdefault(weight,[]).append(pauli)
+        cols = max(1, int(np.ceil(np.sqrt(len(paulis)))))
+
+        box = {}
+        y = 2
+        for weight in sorted(groups):
+            group = groups[weight]
+            for start in range(0,len(group),cols):
+                row = group[start:start+cols]
+                for j,pauli in enumerate(row):
+                    box[pauli] = ( 2*j - (len(row)-1), y )
+                y += 2
+            y += 1
+
+        size = max(6, 2*cols+2, y)
+        limits = ([-size/2,size/2],[0,size])
+        return box, limits
+
+    def get_rho(self,state=None):
         # Runs the circuit specified by self.qc and determines the expectation values for 'ZI', 'IZ', 'ZZ', 'XI', 'IX', 'XX', 'ZX' and 'XZ' (and the ones with Ys too if needed).
+        # If a statevector or density matrix is given as `state`, or there is no backend, or the grid isn't for 2 qubits,
+        # the expectation values of all Paulis are instead calculated exactly using pauli_expectations.
+
+        if state is not None or self.backend==None or self.num_qubits!=2:
+            if state is None:
+                state = Statevector.from_instruction(self.qc)
+            self.rho = pauli_expectations(state, self.num_qubits)
+            return
 
         if self.y_boxes:
             corr = ['ZZ','ZX','XZ','XX','YY','YX','YZ','XY','ZY']
@@ -326,17 +455,12 @@ class pauli_grid():
                     temp_qc.sdg(self.qr[j])
                     temp_qc.h(self.qr[j])
                 
-            if self.backend==None:
-                ket = Statevector([1,0,0,0])
-                ket = ket.from_instruction(temp_qc)
-                results[basis] = ket.probabilities_dict()          
-            else:     
-                temp_qc.barrier(self.qr)
-                temp_qc.measure(self.qr,self.cr)
-                job = execute(temp_qc, backend=self.backend, shots=self.shots)
-                results[basis] = job.result().get_counts()
-                for string in results[basis]:
-                    results[basis][string] = results[basis][string]/self.shots
+            temp_qc.barrier(self.qr)
+            temp_qc.measure(self.qr,self.cr)
+            job = execute(temp_qc, backend=self.backend, shots=self.shots)
+            results[basis] = job.result().get_counts()
+            for string in results[basis]:
+                results[basis][string] = results[basis][string]/self.shots
 
         prob = {}
         # prob of expectation value -1 for single qubit observables
@@ -370,17 +494,17 @@ class pauli_grid():
     def update_grid(self,rho=None,labels=False,bloch=None,hidden=[],qubit=True,corr=True,message="",output=None):
         """
         rho = None
-            Dictionary of expectation values for 'ZI', 'IZ', 'ZZ', 'XI', 'IX', 'XX', 'ZX' and 'XZ'. If supplied, this will be visualized instead of the results of running self.qc.
+            Dictionary of expectation values for 'ZI', 'IZ', 'ZZ', 'XI', 'IX', 'XX', 'ZX' and 'XZ' (or whichever Paulis have boxes). If supplied, this will be visualized instead of the results of running self.qc.
         labels = False
             Determines whether basis labels are printed in the corresponding boxes.
         bloch = None
-            If a qubit name is supplied, and if mode='line', Bloch circles are displayed for this qubit
+            If a qubit name is supplied, and if mode='line', Bloch circles are displayed for this qubit (2 qubit grids only)
         hidden = []
             Which qubits have their circles hidden (empty list if both shown).
         qubit = True
             Whether both circles shown for each qubit (use True for qubit puzzles and False for bit puzzles).
         corr = True
-            Whether the correlation circles (the four in the middle) are shown.
+            Whether the correlation circles (the four in the middle, or all multi-qubit Paulis) are shown.
         message
             A string of text that is displayed below the grid.
         """
@@ -394,11 +518,11 @@ class pauli_grid():
                 unhidden = unhidden and (pauli[j]=='I')
             # second: does it contain something other than 'I' or 'Z' when only bits are shown
             if qubit==False:
-                for j in range(2):
+                for j in range(self.num_qubits):
                     unhidden = unhidden and (pauli[j] in ['I','Z'])
             # third: is it a correlation pauli when these are not allowed
             if corr==False:
-                unhidden = unhidden and ((pauli[0]=='I') or (pauli[1]=='I'))
+                unhidden = unhidden and (len(pauli)-pauli.count('I')<=1)
             # finally: is it actually in rho
             unhidden = unhidden and (pauli in self.rho)
             return unhidden
@@ -477,7 +601,7 @@ class pauli_grid():
 
         # update bars if required
         if self.mode=='line':
-            if bloch in ['0','1']:
+            if bloch in ['0','1'] and self.num_qubits==2:
                 for other in 'IXZ':
                     px = other*(bloch=='1') + 'X' + other*(bloch=='0')
                     pz = other*(bloch=='1') + 'Z' + other*(bloch=='0')
@@ -494,11 +618,11 @@ class pauli_grid():
                 for pauli in self.box:
                     for point in self.points[pauli]:
                         point.radius = 0.0
-                    if pauli in ['ZI','IZ','ZZ']:
+                    if set(pauli)<=set('IZ'):
                         add_line('Z',pauli,pauli)
-                    if pauli in ['XI','IX','XX']:
+                    elif set(pauli)<=set('IX'):
                         add_line('X',pauli,pauli)
-                    if pauli in ['XZ','ZX']:
+                    elif set(pauli)<=set('IXZ'):
                         add_line('ZX',pauli,pauli)
 
         self.bottom.set_text(message)
@@ -507,12 +631,8 @@ class pauli_grid():
             for pauli in self.box:
                 plt.text(self.box[pauli][0]-0.18,self.box[pauli][1]-0.85, pauli)
 
-        if self.y_boxes:
-            self.ax.set_xlim([-4,4])
-            self.ax.set_ylim([0,8])
-        else:
-            self.ax.set_xlim([-3,3])
-            self.ax.set_ylim([0,6])
+        self.ax.set_xlim(self.limits[0])
+        self.ax.set_ylim(self.limits[1])
 
         if output is None:
             self.fig.canvas.draw()
@@ -1,26 +1,61 @@
 #!/usr/bin/env python3
 
-from ipywidgets import widgets 
-from ipywidgets import Layout, HBox, VBox
-from IPython.display import display
+import asyncio
+import importlib.util
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# ipywidgets and IPython are imported when a screen is displayed, so the headless renderer works without them
+
+class HeadlessButton():
+    # Stands in for widgets.ToggleButton when the engine runs without a front end.
+    # Observers are called when the value changes, just as they are for the widget.
+
+    def __init__(self,description='',button_style='',layout=None,disabled=False,value=False):
+        self.description = description
+        self.button_style = button_style
+        self.layout = layout
+        self.disabled = disabled
+        self._value = value
+        self._observers = []
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self,value):
+        old = self._value
+        self._value = value
+        if value!=old:
+            for observer in self._observers:
+                observer({'name':'value','old':old,'new':value,'owner':self,'type':'change'})
+
+    def observe(self,handler):
+        self._observers.append(handler)
+
+    @contextmanager
+    def hold_sync(self):
+        yield
+
 
 class Pixel():
+
+    # button styles for each color, as used by set_color
+    styles = {'grey':'','gray':'','green':'success','blue':'info','orange':'warning','red':'danger'}
     
-    def __init__(self, layout, active=False):
+    def __init__(self, layout, active=False, button=None):
+        if button is None:
+            from ipywidgets import widgets
+            button = widgets.ToggleButton
         self.disabled = not active
-        self.button = widgets.ToggleButton(description='',button_style='',layout=layout,disabled=self.disabled)
+        self.button = button(description='',button_style='',layout=layout,disabled=self.disabled)
         
     def set_color(self,color):
-        if color in ['grey','gray']:
-            self.button.button_style = ''
-        elif color=='green':
-            self.button.button_style = 'success'
-        elif color=='blue':
-            self.button.button_style = 'info'
-        elif color=='orange':
-            self.button.button_style = 'warning'
-        elif color=='red':
-            self.button.button_style = 'danger'
+        if color in self.styles:
+            self.button.button_style = self.styles[color]
             
     def set_brightness(self,bright):
         if self.disabled:
@@ -28,54 +63,310 @@ class Pixel():
         
     def set_text(self,text):
         self.button.description = text
+
+    def get_color(self):
+        for color, style in self.styles.items():
+            if self.button.button_style==style:
+                return color
+
+
+class BufferButton():
+    # Stands in for the button of a pixel of a CanvasScreen. Its description, value and style are
+    # read from and written to the screen's framebuffer, as set_text, set_brightness and set_color do.
+
+    disabled = True
+    layout = None
+
+    def __init__(self, screen, pos):
+        self.screen = screen
+        self.pos = pos
+
+    @property
+    def description(self):
+        return self.screen.text[self.pos]
+
+    @description.setter
+    def description(self,text):
+        self.screen.text[self.pos] = text
+
+    @property
+    def value(self):
+        return not self.screen.brightness[self.pos]
+
+    @value.setter
+    def value(self,value):
+        self.screen.brightness[self.pos] = not value
+
+    @property
+    def button_style(self):
+        return Pixel.styles.get(self.screen.color[self.pos],'')
+
+    @button_style.setter
+    def button_style(self,style):
+        for color, color_style in Pixel.styles.items():
+            if color_style==style:
+                self.screen.color[self.pos] = color
+                return
+
+    @contextmanager
+    def hold_sync(self):
+        yield
+
+
+class BufferPixel():
+    # A pixel of a CanvasScreen. It has the same methods as Pixel, but only writes to the screen's framebuffer.
+
+    def __init__(self, screen, pos):
+        self.screen = screen
+        self.pos = pos
+        self.disabled = True
+        self.button = BufferButton(screen,pos)
+
+    def set_color(self,color):
+        self.screen.color[self.pos] = color
+
+    def set_brightness(self,bright):
+        self.screen.brightness[self.pos] = bright
+
+    def set_text(self,text):
+        self.screen.text[self.pos] = text
+
+    def get_color(self):
+        return self.screen.color[self.pos]
+
     
 class Screen():
     
-    def __init__(self,size,active,L=8):
-            
+    def __init__(self,size,active,L=8,button=None):
+        # with a button other than widgets.ToggleButton (such as HeadlessButton), no widgets are made
+
+        if button is None:
+            from ipywidgets import widgets
+            button = widgets.ToggleButton
+            self._layout, self._wide_layout, self._wider_layout = self._layouts(size,L)
+        else:
+            self._layout = self._wide_layout = self._wider_layout = None
+    
+        self.pixel = {}
+        for x in range(L):
+            for y in range(L):
+                self.pixel[x,y] = self._make_pixel((x,y),active,button)
+        self.pixel['text'] = Pixel(self._wider_layout,button=button)
+
+        # framebuffer: games can write into these arrays instead of calling the pixel methods,
+        # and only the pixels that differ from the last commit are sent to the front end
+        self.L = L
+        self.color = np.full((L,L),'grey',dtype=object)
+        self.brightness = np.ones((L,L),dtype=bool)
+        self._committed_color = self.color.copy()
+        self._committed_brightness = self.brightness.copy()
+
+        self.messages = 0
+        self.total_messages = 0
+        self.frame_messages = []
+
+    def _layouts(self,size,L):
+        # layouts of the pixel buttons and controller buttons, the 'Next' button and the text pixel
+        from ipywidgets import Layout
+
         width = int(size[0]/L)
         wide = str(7*width+24)+'px'
         wider = str(L*width+(L-1)*4)+'px'
         width = str(width)+'px'
         height = str(int(size[1]/L))+'px'
         width = str(int(50*8/L))+'px'
+        return Layout(width=width, height=height), Layout(width=wide, height=height), Layout(width=wider, height=height)
+
+    def _make_pixel(self,pos,active,button):
+        return Pixel(self._layout,active,button=button)
+
+    def commit(self):
+        """
+        Sends the pixels whose entries in `color` or `brightness` have changed since the last commit
+        to the front end. The changes to each pixel are batched with `hold_sync`, so that each
+        changed pixel costs a single message. Returns the number of messages sent.
+        """
+        changed = np.argwhere( (self.color!=self._committed_color) | (self.brightness!=self._committed_brightness) )
+        messages = self._push(changed)
+        self._committed_color[:] = self.color
+        self._committed_brightness[:] = self.brightness
+
+        self.messages = messages
+        self.total_messages += self.messages
+        self.frame_messages.append(self.messages)
+        return self.messages
+
+    def _push(self,changed):
+        for x,y in changed:
+            pixel = self.pixel[x,y]
+            with pixel.button.hold_sync():
+                pixel.set_color(self.color[x,y])
+                pixel.set_brightness(self.brightness[x,y])
+        return len(changed)
+
+    def snapshot(self):
+        """
+        Returns the current contents of the screen, as a dict with arrays (indexed like `pixel`) for
+        'color', 'brightness' and 'text', and the string shown on the text pixel as 'message'.
+        """
+        frame = {'color':np.full((self.L,self.L),'grey',dtype=object),
+                 'brightness':np.ones((self.L,self.L),dtype=bool),
+                 'text':np.full((self.L,self.L),'',dtype=object),
+                 'message':self.pixel['text'].button.description}
+        for x in range(self.L):
+            for y in range(self.L):
+                pixel = self.pixel[x,y]
+                frame['color'][x,y] = pixel.get_color()
+                frame['brightness'][x,y] = not pixel.button.value
+                frame['text'][x,y] = pixel.button.description
+        return frame
+
+
+class CanvasScreen(Screen):
+    # Draws the whole screen as a single ipycanvas.Canvas, rather than one widget per pixel, so that large screens stay usable.
+
+    # RGB values for the ipywidgets button styles used by Pixel
+    rgb = {'grey':(238,238,238),'gray':(238,238,238),'green':(76,175,80),'blue':(0,188,212),'orange':(255,152,0),'red':(244,67,54)}
+
+    def __init__(self,size,active,L=8):
+        try:
+            from ipycanvas import Canvas
+        except ImportError:
+            raise ImportError("The canvas renderer requires ipycanvas. Install it with 'pip install ipycanvas'.")
+
+        self.scale = max(1, int(size[0]/L))
+        self.canvas = Canvas(width=L*self.scale, height=L*self.scale)
+        super().__init__(size,active,L=L)
+
+        self.text = np.full((L,L),'',dtype=object)
+        # nothing has been drawn yet, so the first commit always draws
+        self._committed_color[:] = None
+        self._committed_text = self.text.copy()
+
+    def _layouts(self,size,L):
+        from ipywidgets import Layout
+
+        height = str(int(size[1]/8))+'px'
+        width = '50px'
+        wide = str(7*50+24)+'px'
+        wider = str(L*self.scale)+'px'
+        return Layout(width=width, height=height), Layout(width=wide, height=height), Layout(width=wider, height=height)
+
+    def _make_pixel(self,pos,active,button):
+        return BufferPixel(self,pos)
+
+    def commit(self):
+        """
+        Redraws the canvas if anything in `color`, `brightness` or `text` has changed since the
+        last commit. The whole screen is sent as a single message. Returns the number of messages sent.
+        """
+        if np.any(self.text!=self._committed_text):
+            self._committed_color[:] = None
+        return super().commit()
+
+    def _push(self,changed):
+        from ipycanvas import hold_canvas
+
+        if len(changed)==0:
+            return 0
+
+        rgb = np.array([[self.rgb.get(color,self.rgb['grey']) for color in row] for row in self.color],dtype=float)
+        rgb[~self.brightness] *= 0.6
+        # framebuffer is indexed [x,y], but images are [row,column]
+        image = np.repeat(np.repeat(rgb.transpose(1,0,2),self.scale,axis=0),self.scale,axis=1).astype(np.uint8)
+
+        with hold_canvas(self.canvas):
+            self.canvas.put_image_data(image,0,0)
+            self.canvas.fill_style = 'black'
+            self.canvas.text_align = 'center'
+            self.canvas.text_baseline = 'middle'
+            for (x,y),text in np.ndenumerate(self.text):
+                if text:
+                    self.canvas.fill_text(str(text),(x+0.5)*self.scale,(y+0.5)*self.scale)
+        self._committed_text[:] = self.text
+        return 1
+
+    def snapshot(self):
+        return {'color':self.color.copy(),
+                'brightness':self.brightness.copy(),
+                'text':self.text.copy(),
+                'message':self.pixel['text'].button.description}
+
+    def position(self,x,y):
+        # Returns the pixel at canvas coordinates (x,y).
+
+        return ( min(int(x//self.scale),self.L-1), min(int(y//self.scale),self.L-1) )
 
-        self._layout = Layout(width=width, height=height)
-        self._wide_layout = Layout(width=wide, height=height)
-        self._wider_layout = Layout(width=wider, height=height)
-    
-        self.pixel = {}
-        for x in range(L):
-            for y in range(L):
-                self.pixel[x,y] = Pixel(self._layout,active)
-        self.pixel['text'] = Pixel(self._wider_layout)
         
 
 class QiskitGameEngine():
     
-    def __init__(self,start,next_frame,L=8,active_screen=False):
-        
+    def __init__(self,start,next_frame,L=8,active_screen=False,renderer='auto'):
+        """
+        start
+            Function called with the engine to set up the game.
+        next_frame
+            Function called with the engine whenever a button is pressed.
+        L=8
+            Width and height of the screen in pixels.
+        active_screen=False
+            Whether pixels can be pressed to control the game.
+        renderer='auto'
+            Either 'widgets', for one button per pixel, or 'canvas', for a single ipycanvas.Canvas.
+            With 'auto', the canvas is used for L>=16 if ipycanvas is installed.
+            With 'headless', nothing is displayed and the buttons are plain objects. The game is then
+            played with `play`, and every frame is recorded in `frames`.
+
+        By default, next_frame is only called when a button is pressed. Use `run` to call it on a timer instead.
+        """
+
+        if renderer=='auto':
+            renderer = 'widgets'
+            if L>=16 and importlib.util.find_spec('ipycanvas') is not None:
+                renderer = 'canvas'
         
         self.start = start
         self.next_frame = next_frame
         self.L = L
         self.active_screen = active_screen
         self.pressed_pixels = []
+
+        # state of the timer-driven game loop (see `run`)
+        self.running = False
+        self.fps = None
+        self.frame_times = []
+        self.dropped_frames = 0
+        self._events = []
+        self._replaying = False
+        self._task = None
         
-        self.screen = Screen((400,400),active_screen,L=L)
+        self.renderer = renderer
+        self.frames = []
+        self.record = renderer=='headless'
+        if renderer=='headless':
+            button = HeadlessButton
+            self.screen = Screen((400,400),active_screen,L=L,button=button)
+        else:
+            from ipywidgets import widgets
+            from IPython.display import display
+            button = widgets.ToggleButton
+            if renderer=='canvas':
+                self.screen = CanvasScreen((400,400),active_screen,L=L)
+            else:
+                self.screen = Screen((400,400),active_screen,L=L)
         layout = self.screen._layout
 
         controller = {}
-        controller['blank'] = widgets.ToggleButton(description='',button_style='',layout=layout)
-        controller['up'] = widgets.ToggleButton(description='▲',button_style='',layout=layout)
-        controller['down'] = widgets.ToggleButton(description='▼',button_style='',layout=layout)
-        controller['left'] = widgets.ToggleButton(description='◀︎',button_style='',layout=layout)
-        controller['right'] = widgets.ToggleButton(description='►',button_style='',layout=layout)
-        controller['A'] = widgets.ToggleButton(description='A',button_style='',layout=layout)
-        controller['B'] = widgets.ToggleButton(description='B',button_style='',layout=layout)
-        controller['X'] = widgets.ToggleButton(description='X',button_style='',layout=layout)
-        controller['Y'] = widgets.ToggleButton(description='Y',button_style='',layout=layout)
-        controller['next'] = widgets.ToggleButton(description='Next',button_style='',layout=self.screen._wide_layout)
+        controller['blank'] = button(description='',button_style='',layout=layout)
+        controller['up'] = button(description='▲',button_style='',layout=layout)
+        controller['down'] = button(description='▼',button_style='',layout=layout)
+        controller['left'] = button(description='◀︎',button_style='',layout=layout)
+        controller['right'] = button(description='►',button_style='',layout=layout)
+        controller['A'] = button(description='A',button_style='',layout=layout)
+        controller['B'] = button(description='B',button_style='',layout=layout)
+        controller['X'] = button(description='X',button_style='',layout=layout)
+        controller['Y'] = button(description='Y',button_style='',layout=layout)
+        controller['next'] = button(description='Next',button_style='',layout=self.screen._wide_layout)
 
         [b,u,d,l,r,A,B,X,Y,c] = [controller['blank'],
                              controller['up'],
@@ -89,20 +380,32 @@ class QiskitGameEngine():
                              controller['next']]
 
         interface = []
-        interface.append( widgets.HBox([self.screen.pixel[x,0].button for x in range(L)]+[b,u,b,b,b,X,b]) )
-        interface.append( widgets.HBox([self.screen.pixel[x,1].button for x in range(L)]+[l,b,r,b,Y,b,A]) )
-        interface.append( widgets.HBox([self.screen.pixel[x,2].button for x in range(L)]+[b,d,b,b,b,B,b]) )
-        interface.append( widgets.HBox([self.screen.pixel[x,3].button for x in range(L)]+[c]) )
-        for y in range(4,L):
-            interface.append( widgets.HBox([self.screen.pixel[x,y].button for x in range(L)]) )
-        interface.append( self.screen.pixel['text'].button )
-            
+        if renderer=='headless':
+            pass
+        elif renderer=='canvas':
+            pad = widgets.VBox([widgets.HBox([b,u,b,b,b,X,b]),
+                                widgets.HBox([l,b,r,b,Y,b,A]),
+                                widgets.HBox([b,d,b,b,b,B,b]),
+                                widgets.HBox([c])])
+            interface.append( widgets.HBox([self.screen.canvas,pad]) )
+        else:
+            interface.append( widgets.HBox([self.screen.pixel[x,0].button for x in range(L)]+[b,u,b,b,b,X,b]) )
+            interface.append( widgets.HBox([self.screen.pixel[x,1].button for x in range(L)]+[l,b,r,b,Y,b,A]) )
+            interface.append( widgets.HBox([self.screen.pixel[x,2].button for x in range(L)]+[b,d,b,b,b,B,b]) )
+            interface.append( widgets.HBox([self.screen.pixel[x,3].button for x in range(L)]+[c]) )
+            for y in range(4,L):
+                interface.append( widgets.HBox([self.screen.pixel[x,y].button for x in range(L)]) )
         self.controller = controller
             
         # run user-supplied setup function
         start(self)
+        self.screen.commit()
+        if self.record:
+            self.frames.append(self.screen.snapshot())
             
-        display(widgets.VBox(interface))
+        if renderer!='headless':
+            interface.append( self.screen.pixel['text'].button )
+            display(widgets.VBox(interface))
         
         b.observe(self.given_blank)
         
@@ -111,8 +414,11 @@ class QiskitGameEngine():
                 self.controller[button].observe(self.given_button)
                 
         if active_screen:
-            for pixel in self.screen.pixel.values():
-                pixel.button.observe(self.given_screen)
+            if renderer=='canvas':
+                self.screen.canvas.on_mouse_down(self.given_canvas)
+            else:
+                for pixel in self.screen.pixel.values():
+                    pixel.button.observe(self.given_screen)
         
         
     def given_blank(self,obs_b):
@@ -120,11 +426,25 @@ class QiskitGameEngine():
             self.controller['blank'].value = False
     
     
+    def update(self):
+        # run user-supplied frame function, and send any changes it made to the framebuffer
+        self.next_frame(self)
+        self.screen.commit()
+        if self.record:
+            self.frames.append(self.screen.snapshot())
+    
     def given_button(self,obs_n):
 
-        for button in self.controller.values():
+        # buttons pressed by the game loop itself, to replay queued events
+        if self._replaying:
+            return
+
+        for name, button in self.controller.items():
             if button.value:
-                self.next_frame(self)
+                if self.running:
+                    self._events.append(name)
+                else:
+                    self.update()
             button.value = False
             
     def given_screen(self,obs_s):
@@ -133,5 +453,119 @@ class QiskitGameEngine():
             for pos, pixel in self.screen.pixel.items():
                 if pixel.button.value:
                     self.pressed_pixels.append(pos)
-                    self.next_frame(self)
-                pixel.button.value = False              
\ No newline at end of file
+                    if not self.running:
+                        self.update()
+                pixel.button.value = False
+
+    def given_canvas(self,x,y):
+
+        if self.active_screen:
+            self.pressed_pixels.append(self.screen.position(x,y))
+            if not self.running:
+                self.update()
+
+    def run(self,fps=10):
+        """
+        Starts a game loop on the kernel's asyncio event loop, which calls next_frame `fps` times per second
+        whether or not anything was pressed. Button presses are queued between frames, and each different
+        button pressed since the last frame gets a frame with its `value` set to True (so holding a button
+        doesn't cause extra frames). If next_frame takes too long, the frames that were missed are dropped
+        rather than caught up. Returns the asyncio task running the loop.
+        """
+        self.stop()
+        self.fps = fps
+        self.running = True
+        self._task = asyncio.ensure_future(self._loop())
+        return self._task
+
+    def stop(self):
+        # Stops the game loop, so that next_frame is called when a button is pressed again.
+
+        self.running = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        loop = asyncio.get_event_loop()
+        period = 1/self.fps
+        next_tick = loop.time()
+        try:
+            while self.running:
+                t0 = time.perf_counter()
+                self.tick()
+                self.frame_times.append(time.perf_counter()-t0)
+
+                next_tick += period
+                now = loop.time()
+                if now>next_tick:
+                    missed = int((now-next_tick)//period)+1
+                    self.dropped_frames += missed
+                    next_tick += missed*period
+                await asyncio.sleep(next_tick-now)
+        finally:
+            # `run` may already have started another loop, which this one mustn't stop
+            if self._task is asyncio.current_task():
+                self.running = False
+
+    def tick(self):
+        # Runs a single frame of the game loop, using the buttons pressed since the last one.
+
+        events = []
+        for name in self._events:
+            if name not in events:
+                events.append(name)
+        self._events = []
+
+        if not events:
+            self.update()
+            return
+        self._replaying = True
+        try:
+            for name in events:
+                self.controller[name].value = True
+                try:
+                    self.update()
+                finally:
+                    self.controller[name].value = False
+        finally:
+            self._replaying = False
+
+    def frame_stats(self):
+        """
+        Returns a dict with the number of frames run by the game loop, the mean, 99th percentile and
+        maximum time taken to compute them (in seconds), and the number of frames dropped.
+        """
+        times = np.array(self.frame_times)
+        stats = {'frames':len(times),'dropped':self.dropped_frames}
+        if len(times):
+            stats['mean'] = float(times.mean())
+            stats['p99'] = float(np.percentile(times,99))
+            stats['max'] = float(times.max())
+        return stats
+
+    def play(self,inputs):
+        """
+        Plays the game with a scripted sequence of inputs, as fast as possible. Each input is either
+        the name of a controller button (such as 'up' or 'A'), an (x,y) tuple for a press of that pixel
+        (only with active_screen=True, otherwise a ValueError is raised before anything is played), or None
+        for a frame in which nothing is pressed. The time taken for each frame is added to `frame_times`.
+        Returns the list of recorded frames.
+        """
+        inputs = list(inputs)
+        if not self.active_screen and any(isinstance(event,tuple) for event in inputs):
+            raise ValueError("Pixels can only be pressed when the engine is made with active_screen=True.")
+        for event in inputs:
+            t0 = time.perf_counter()
+            if event is None:
+                self.update()
+            elif isinstance(event,tuple):
+                if self.renderer=='canvas':
+                    scale = self.screen.scale
+                    self.given_canvas(event[0]*scale,event[1]*scale)
+                else:
+                    self.screen.pixel[event].button.value = True
+            else:
+                self.controller[event].value = True
+            self.frame_times.append(time.perf_counter()-t0)
+        return self.frames
@@ -1,7 +1,9 @@
 from qiskit import QuantumCircuit
 import numpy as np
 from qiskit.circuit.library import Diagonal
+from qiskit_textbook.problems.oracle_cache import cached_oracle
 
+@cached_oracle()
 def dj_problem_oracle(problem, to_gate=True):
     """Returns a 5-qubit Deutsch-Joza Oracle"""
     qc = QuantumCircuit(5)
@@ -28,6 +30,7 @@ def dj_problem_oracle(problem, to_gate=True):
     else:
         return qc
 
+@cached_oracle()
 def hsp_oracle(
     seed: int, 
     output: bool=False, 
@@ -45,8 +48,8 @@ def hsp_oracle(
         QuantumCircuit: oracle circuit with 4-qubit if ouput==False, 5-qubit if output==True.
     """
     
-    np.random.seed(seed)
-    s = f'{np.random.randint(0, 2**4):4b}'
+    rng = np.random.RandomState(seed)
+    s = f'{rng.randint(0, 2**4):4b}'
     s = s[::-1]
     n = 4
     oracle = QuantumCircuit(4+output)
@@ -84,14 +87,15 @@ def hsp_oracle(
     
     return oracle.to_gate()
 
+@cached_oracle()
 def grover_problem_oracle(n, variant=0, print_solutions=False):
-    np.random.seed(variant)
+    rng = np.random.RandomState(variant)
     if n < 3:
         nsolutions = 1
     else:
-        nsolutions = np.random.randint(1, np.ceil((2**n)/4))
+        nsolutions = rng.randint(1, np.ceil((2**n)/4))
     diagonal_elements = [-1]*nsolutions + [1]*((2**n) - nsolutions)
-    np.random.shuffle(diagonal_elements)
+    rng.shuffle(diagonal_elements)
     oracle_gate = Diagonal(diagonal_elements)
     oracle_gate.name = "Oracle\nn=%i, var=%i" % (n, variant)
     if print_solutions:
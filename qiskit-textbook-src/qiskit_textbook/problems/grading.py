@@ -0,0 +1,206 @@
+"""Fast checking of student oracles against the oracles in `qiskit_textbook.problems`.
+
+The oracles of the problems (`dj_problem_oracle`, `hsp_oracle`, `grover_problem_oracle`)
+are built from X, CX, CCX, Z-type and diagonal gates, so they map each basis state to a
+single basis state times a phase: U|x> = phase[x]|perm[x]>. Their action on all 2^n basis
+states at once is worked out with bit operations on integer NumPy arrays, and two oracles
+are the same if their permutations are equal and their phases agree up to a global phase.
+Circuits with any other gates (e.g. H) are compared by their unitaries instead.
+"""
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.circuit import ControlledGate, Instruction
+
+# gates with no effect on the action of an oracle
+_IGNORED = {'id', 'barrier', 'delay'}
+
+# phase gates as the angle of the phase they give |1>
+_PHASES = {
+    'z': lambda params: np.pi,
+    's': lambda params: np.pi/2,
+    'sdg': lambda params: -np.pi/2,
+    't': lambda params: np.pi/4,
+    'tdg': lambda params: -np.pi/4,
+    'p': lambda params: float(params[0]),
+    'u1': lambda params: float(params[0]),
+}
+
+
+class NotMonomialError(Exception):
+    """Raised for circuits that don't map basis states to basis states."""
+
+
+def _bit(perm, qubit):
+    return (perm >> qubit) & 1
+
+
+def _apply_base(name, params, qubits, mask, perm, phase):
+    """Applies a single-target gate, or a swap, where `mask` is set."""
+    if name == 'x':
+        perm ^= mask << qubits[0]
+    elif name == 'y':
+        phase *= np.where(mask, np.where(_bit(perm, qubits[0]) == 1, -1j, 1j), 1)
+        perm ^= mask << qubits[0]
+    elif name in _PHASES:
+        angle = _PHASES[name](params)
+        phase *= np.where(mask & _bit(perm, qubits[0]) == 1, np.exp(1j*angle), 1)
+    elif name == 'rz':
+        angle = float(params[0])
+        phase *= np.where(mask == 1, np.exp(1j*angle/2*(2*_bit(perm, qubits[0]) - 1)), 1)
+    elif name == 'swap':
+        differ = mask & (_bit(perm, qubits[0]) ^ _bit(perm, qubits[1]))
+        perm ^= (differ << qubits[0]) | (differ << qubits[1])
+    else:
+        return False
+    return True
+
+
+def _apply(operation, qubits, perm, phase):
+    """Applies `operation` on `qubits` to the action (`perm`, `phase`), in place."""
+    name = operation.name
+    if getattr(operation, 'condition', None) is not None or name == 'measure' or name == 'reset':
+        raise NotMonomialError(f"'{name}' isn't a unitary gate")
+    if name in _IGNORED:
+        return
+    all_states = np.ones_like(perm)
+    if isinstance(operation, ControlledGate) and \
+            operation.num_qubits == operation.num_ctrl_qubits + operation.base_gate.num_qubits:
+        controls = qubits[:operation.num_ctrl_qubits]
+        mask = all_states
+        for k, control in enumerate(controls):
+            mask = mask & (_bit(perm, control) == (operation.ctrl_state >> k) & 1)
+        if _apply_base(operation.base_gate.name, operation.base_gate.params,
+                       qubits[operation.num_ctrl_qubits:], mask.astype(perm.dtype), perm, phase):
+            return
+    elif _apply_base(name, operation.params, qubits, all_states, perm, phase):
+        return
+    if name == 'diagonal':
+        index = np.zeros_like(perm)
+        for k, qubit in enumerate(qubits):
+            index |= _bit(perm, qubit) << k
+        phase *= np.asarray(operation.params, dtype=complex)[index]
+        return
+    if operation.definition is None:
+        raise NotMonomialError(f"'{name}' isn't a permutation or diagonal gate")
+    _apply_circuit(operation.definition, qubits, perm, phase)
+
+
+def _apply_circuit(circuit, qubits, perm, phase):
+    indices = {bit: qubits[i] for i, bit in enumerate(circuit.qubits)}
+    for instruction in circuit.data:
+        _apply(instruction.operation, [indices[q] for q in instruction.qubits], perm, phase)
+    if circuit.global_phase:
+        phase *= np.exp(1j*float(circuit.global_phase))
+
+
+def _as_circuit(oracle):
+    if isinstance(oracle, QuantumCircuit):
+        return oracle
+    if isinstance(oracle, Instruction):
+        circuit = QuantumCircuit(oracle.num_qubits)
+        circuit.append(oracle, range(oracle.num_qubits))
+        return circuit
+    raise TypeError(f"expected a QuantumCircuit or a gate, got {type(oracle).__name__}")
+
+
+def oracle_action(oracle):
+    """Returns the action of a permutation or phase oracle on all basis states.
+
+    Args:
+        oracle (QuantumCircuit or Gate): the oracle.
+    Returns:
+        (np.ndarray, np.ndarray): `perm` and `phase`, with oracle|x> = phase[x]|perm[x]>.
+    Raises:
+        NotMonomialError: if the oracle has gates that aren't permutations or diagonal.
+    """
+    circuit = _as_circuit(oracle)
+    if circuit.num_clbits and any(instruction.operation.name == 'measure' for instruction in circuit.data):
+        raise NotMonomialError("the oracle has measurements")
+    perm = np.arange(2**circuit.num_qubits, dtype=np.int64)
+    phase = np.ones(2**circuit.num_qubits, dtype=complex)
+    _apply_circuit(circuit, list(range(circuit.num_qubits)), perm, phase)
+    return perm, phase
+
+
+def _same_action(action, reference_action, atol=1e-8):
+    perm, phase = action
+    reference_perm, reference_phase = reference_action
+    if not np.array_equal(perm, reference_perm):
+        return False
+    # equal up to a global phase
+    ratio = phase*np.conj(reference_phase)
+    return bool(np.allclose(ratio, ratio[0], atol=atol))
+
+
+def _same_unitary(oracle, reference):
+    from qiskit.quantum_info import Operator
+    try:
+        return Operator(oracle).equiv(Operator(reference))
+    except Exception:
+        return False
+
+
+def grade(submission, reference):
+    """Checks whether a student's oracle acts the same as a reference oracle.
+
+    Args:
+        submission (QuantumCircuit or Gate): the student's oracle.
+        reference (QuantumCircuit or Gate): the oracle it should match, e.g.
+            `dj_problem_oracle(1)`.
+    Returns:
+        bool: True if the two are the same up to a global phase.
+    """
+    return grade_batch([submission], reference)[0]
+
+
+def grade_batch(submissions, reference):
+    """Checks a list of student oracles against the same reference oracle.
+
+    The action of the reference is only worked out once, so this is the quickest way to
+    grade a whole class.
+
+    Args:
+        submissions (list): the students' oracles (QuantumCircuits or Gates).
+        reference (QuantumCircuit or Gate): the oracle they should match.
+    Returns:
+        list(bool): whether each submission matches the reference.
+    """
+    reference = _as_circuit(reference)
+    try:
+        reference_action = oracle_action(reference)
+    except NotMonomialError:
+        reference_action = None
+    results = []
+    for submission in submissions:
+        try:
+            submission = _as_circuit(submission)
+        except TypeError:
+            results.append(False)
+            continue
+        if submission.num_qubits != reference.num_qubits:
+            results.append(False)
+            continue
+        try:
+            action = oracle_action(submission)
+        except NotMonomialError:
+            action = None
+        if action is not None and reference_action is not None:
+            results.append(_same_action(action, reference_action))
+        else:
+            results.append(_same_unitary(submission, reference))
+    return results
+
+
+def wrong_inputs(submission, reference):
+    """Returns the basis states (as integers) a student's oracle gets wrong.
+
+    Phases are compared relative to those of |0...0>, so a global phase doesn't count.
+    Only works for permutation and phase oracles.
+    """
+    perm, phase = oracle_action(submission)
+    reference_perm, reference_phase = oracle_action(reference)
+    if len(perm) != len(reference_perm):
+        raise ValueError("the oracles have different numbers of qubits")
+    ratio = phase*np.conj(reference_phase)
+    wrong = (perm != reference_perm) | ~np.isclose(ratio, ratio[0])
+    return np.flatnonzero(wrong).tolist()
@@ -0,0 +1,198 @@
+"""Generates many random instances of the problems, e.g. one for each student of a class.
+
+Each instance gets its own `numpy.random.Generator`, spawned from a `SeedSequence` of the
+seed, the family and the number of qubits, so instance i is the same however many
+instances are generated and however many processes generate them. Instances are stored in
+NumPy structured arrays (one record per instance, holding what the oracle is built from,
+which is also the expected answer) that `save_instances` writes to a .npy file and
+`load_instances` memory-maps, so an autograder only reads the records it grades.
+
+Usage: python -m qiskit_textbook.problems.instances <family> <count> <path> [--qubits N] [--seed SEED] [--jobs N]
+"""
+import os
+
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.circuit.library import Diagonal
+
+from qiskit_textbook.tools import simon_oracle
+
+FAMILIES = ['dj', 'simon', 'hsp', 'grover']
+DEFAULT_QUBITS = {'dj': 4, 'simon': 3, 'hsp': 4, 'grover': 4}
+
+
+def instance_dtype(family, n):
+    """The structured dtype of the instances of `family` on `n` qubits."""
+    fields = [('index', '<u4'), ('n', 'u1')]
+    if family == 'dj':
+        # f(x) = mask·x XOR flip, constant if mask is 0
+        fields += [('constant', '?'), ('mask', '<u8'), ('flip', 'u1')]
+    elif family == 'simon':
+        fields += [('secret', '<u8')]
+    elif family == 'hsp':
+        fields += [('shift', '<u8')]
+    elif family == 'grover':
+        fields += [('nsolutions', '<u4'), ('solutions', 'u1', ((2**n + 7)//8,))]
+    else:
+        raise ValueError(f"unknown family '{family}', expected one of {FAMILIES}")
+    return np.dtype(fields)
+
+
+def family_of(instances):
+    """The family of a structured array of instances, from its fields."""
+    for family in FAMILIES:
+        if instances.dtype.names == instance_dtype(family, 1).names:
+            return family
+    raise ValueError("not an array of problem instances")
+
+
+def _check_qubits(family, n):
+    if not 1 <= n <= 63:
+        raise ValueError("the number of qubits must be between 1 and 63")
+    if family == 'hsp' and n % 2:
+        raise ValueError("hidden shift instances need an even number of qubits")
+    if family == 'grover' and n > 16:
+        raise ValueError("grover instances store all 2^n states, so can have at most 16 qubits")
+
+
+def _fields(family, n, rng):
+    """The fields of a random instance after its index and number of qubits."""
+    if family == 'dj':
+        constant = rng.integers(2) == 0
+        return constant, 0 if constant else rng.integers(1, 2**n, dtype=np.uint64), rng.integers(2)
+    if family == 'simon':
+        return rng.integers(1, 2**n, dtype=np.uint64),
+    if family == 'hsp':
+        return rng.integers(0, 2**n, dtype=np.uint64),
+    # as many solutions as grover_problem_oracle picks
+    nsolutions = 1 if n < 3 else rng.integers(1, np.ceil((2**n)/4))
+    marked = np.zeros(2**n, dtype=bool)
+    marked[rng.choice(2**n, nsolutions, replace=False)] = True
+    return nsolutions, np.packbits(marked, bitorder='little')
+
+
+def _generate_chunk(family, n, entropy, start, stop):
+    # the same as SeedSequence(entropy).spawn(stop)[start:], without making the others
+    rngs = (np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(i,))) for i in range(start, stop))
+    return np.array([(i, n) + _fields(family, n, rng) for i, rng in zip(range(start, stop), rngs)],
+                    dtype=instance_dtype(family, n))
+
+
+def generate_instances(family, count, n=None, seed=0, jobs=None, chunksize=2048):
+    """Returns `count` random instances of a problem family.
+
+    Args:
+        family (str): one of 'dj', 'simon', 'hsp' or 'grover'.
+        count (int): the number of instances.
+        n (int): the number of input qubits, by default that of the textbook's problems.
+        seed (int): the seed the instances are generated from.
+        jobs (int): the number of processes, by default the number of CPUs. Use 1 to
+            generate the instances in this process.
+        chunksize (int): the number of instances each process generates at a time.
+    Returns:
+        np.ndarray: a structured array with one record per instance.
+    """
+    if family not in FAMILIES:
+        raise ValueError(f"unknown family '{family}', expected one of {FAMILIES}")
+    n = DEFAULT_QUBITS[family] if n is None else n
+    _check_qubits(family, n)
+    entropy = [seed, FAMILIES.index(family), n]
+    starts = list(range(0, count, chunksize))
+    stops = [min(start + chunksize, count) for start in starts]
+    if jobs == 1 or len(starts) <= 1:
+        parts = [_generate_chunk(family, n, entropy, start, stop) for start, stop in zip(starts, stops)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            parts = list(pool.map(_generate_chunk, [family]*len(starts), [n]*len(starts),
+                                  [entropy]*len(starts), starts, stops))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=instance_dtype(family, n))
+
+
+def save_instances(path, instances):
+    """Writes `instances` to the .npy file `path`."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.save(path, instances, allow_pickle=False)
+
+
+def load_instances(path):
+    """Memory-maps the instances written by `save_instances` to `path`."""
+    return np.load(path, mmap_mode='r', allow_pickle=False)
+
+
+def _bitstring(value, n):
+    return format(int(value), f'0{n}b')
+
+
+def expected_answer(record, family=None):
+    """The answer to an instance, as the textbook's algorithms measure it.
+
+    'constant' or 'balanced' for 'dj', the secret (or shift) bitstring for 'simon' and
+    'hsp', and the list of marked bitstrings for 'grover'.
+    """
+    family = family or family_of(record)
+    n = int(record['n'])
+    if family == 'dj':
+        return 'constant' if record['constant'] else 'balanced'
+    if family == 'simon':
+        return _bitstring(record['secret'], n)
+    if family == 'hsp':
+        return _bitstring(record['shift'], n)
+    marked = np.unpackbits(record['solutions'], count=2**n, bitorder='little')
+    return [_bitstring(state, n) for state in np.flatnonzero(marked)]
+
+
+def instance_oracle(record, family=None):
+    """Builds the oracle of an instance.
+
+    'dj' oracles have n input qubits and an output qubit, 'simon' oracles n input and n
+    output qubits, 'hsp' oracles are the shifted phase oracle g of `hsp_oracle` on n
+    qubits, and 'grover' oracles the Diagonal gate of `grover_problem_oracle`.
+    """
+    family = family or family_of(record)
+    n = int(record['n'])
+    if family == 'simon':
+        return simon_oracle(_bitstring(record['secret'], n))
+    if family == 'grover':
+        marked = np.unpackbits(record['solutions'], count=2**n, bitorder='little')
+        oracle = Diagonal(list(1 - 2*marked.astype(int)))
+        oracle.name = "Oracle\nn=%i, instance=%i" % (n, record['index'])
+        return oracle
+    if family == 'dj':
+        oracle = QuantumCircuit(n+1)
+        if record['flip']:
+            oracle.x(n)
+        for q in range(n):
+            if int(record['mask']) >> q & 1:
+                oracle.cx(q, n)
+        return oracle
+    shift = [q for q in range(n) if int(record['shift']) >> q & 1]
+    oracle = QuantumCircuit(n)
+    if shift:
+        oracle.x(shift)
+    for q in range(n//2):
+        oracle.cz(q, q + n//2)
+    if shift:
+        oracle.x(shift)
+    oracle.name = 'Oracle g'
+    return oracle
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('family', choices=FAMILIES)
+    parser.add_argument('count', type=int)
+    parser.add_argument('path', help="the .npy file to write")
+    parser.add_argument('--qubits', '-n', type=int, help="number of input qubits")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help="number of processes")
+    args = parser.parse_args()
+
+    instances = generate_instances(args.family, args.count, args.qubits, args.seed, max(1, args.jobs))
+    save_instances(args.path, instances)
+    answers = {str(expected_answer(record, args.family)) for record in instances}
+    print(f"Wrote {len(instances)} '{args.family}' instances ({len(answers)} different answers) "
+          f"to {args.path} ({os.path.getsize(args.path) / 1024:.0f} kB) in {time.time() - t0:.2f} seconds")
@@ -0,0 +1,171 @@
+"""Caches the oracles built by `dj_problem_oracle`, `hsp_oracle`, `grover_problem_oracle` and
+`simon_oracle`, which notebooks often ask for again and again with the same arguments.
+
+Each function keeps its most recently used oracles, keyed on all of its arguments, in an
+`OracleEntry`, which also works out the forms derived from the oracle (its gate, unitary and
+truth table) the first time each is asked for. Callers are given copies of the cached oracle,
+so changing them doesn't change the cache. The gates in a copy don't share their definitions
+with the cache either: those a gate class makes itself (such as the definition of a `CXGate`)
+are dropped, and made again the first time they're used, and those that were set directly
+(such as that of a gate made by `to_gate`) are copied in the same way as the oracle.
+The derived arrays are read-only and shared.
+"""
+import copy
+import functools
+import inspect
+import io
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import redirect_stdout
+
+from qiskit import QuantumCircuit
+from qiskit.circuit import Instruction
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def _copy_gate(gate):
+    copied = copy.copy(gate)
+    copied.params = list(gate.params)
+    if gate._definition is not None:
+        if type(gate)._define is Instruction._define:
+            copied._definition = _copy_circuit(gate._definition)
+        else:
+            # the copy makes its own definition when it's first asked for
+            copied._definition = None
+    return copied
+
+
+def _copy_circuit(circuit):
+    # QuantumCircuit.copy also copies the definition of every gate, which for the large
+    # gates of e.g. Diagonal takes longer than building the oracle again
+    if not hasattr(circuit, 'copy_empty_like'):
+        return circuit.copy()
+    copied = circuit.copy_empty_like()
+    for instruction in circuit.data:
+        copied._append(instruction.replace(operation=_copy_gate(instruction.operation)))
+    return copied
+
+
+class OracleEntry():
+    """An oracle, with its gate, unitary and truth table made when they're first used."""
+
+    def __init__(self, oracle, output=''):
+        self._oracle = oracle
+        # what the function printed while building the oracle, printed again on every call
+        self.output = output
+        self._gate = None
+        self._unitary = None
+        self._action = None
+
+    @property
+    def oracle(self):
+        """A copy of the oracle, as the function returned it."""
+        if isinstance(self._oracle, QuantumCircuit):
+            return _copy_circuit(self._oracle)
+        return _copy_gate(self._oracle)
+
+    @property
+    def gate(self):
+        """A copy of the oracle as a gate."""
+        if self._gate is None:
+            self._gate = self._oracle.to_gate() if isinstance(self._oracle, QuantumCircuit) else self._oracle
+        return _copy_gate(self._gate)
+
+    @property
+    def unitary(self):
+        """The unitary matrix of the oracle (read-only)."""
+        if self._unitary is None:
+            from qiskit.quantum_info import Operator
+            self._unitary = _read_only(Operator(self._oracle).data)
+        return self._unitary
+
+    def _oracle_action(self):
+        if self._action is None:
+            from qiskit_textbook.problems.grading import oracle_action
+            self._action = tuple(_read_only(array) for array in oracle_action(self._oracle))
+        return self._action
+
+    @property
+    def truth_table(self):
+        """The basis state each basis state is mapped to (read-only), for oracles that map
+        basis states to basis states (see `qiskit_textbook.problems.grading`)."""
+        return self._oracle_action()[0]
+
+    @property
+    def phases(self):
+        """The phase each basis state picks up (read-only), for the same oracles."""
+        return self._oracle_action()[1]
+
+
+def cached_oracle(maxsize=128):
+    """Decorator that caches the oracles made by a function, keeping the `maxsize` most
+    recently used.
+
+    The decorated function gets `entry(*args, **kwargs)`, which returns the `OracleEntry`
+    of the arguments, and `cache_info()` and `cache_clear()`, like `functools.lru_cache`.
+    Calls with unhashable arguments aren't cached.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+        entries = OrderedDict()
+        lock = threading.Lock()
+        stats = {'hits': 0, 'misses': 0}
+
+        def build(args, kwargs):
+            output = io.StringIO()
+            with redirect_stdout(output):
+                oracle = function(*args, **kwargs)
+            return OracleEntry(oracle, output.getvalue())
+
+        def entry(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = tuple(bound.arguments.items())
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+            if key is None:
+                return build(args, kwargs)
+            with lock:
+                found = entries.get(key)
+                if found is not None:
+                    entries.move_to_end(key)
+                    stats['hits'] += 1
+                    return found
+            found = build(args, kwargs)
+            with lock:
+                stats['misses'] += 1
+                entries[key] = found
+                while len(entries) > maxsize:
+                    entries.popitem(last=False)
+            return found
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            found = entry(*args, **kwargs)
+            if found.output:
+                sys.stdout.write(found.output)
+            return found.oracle
+
+        def cache_info():
+            with lock:
+                return CacheInfo(stats['hits'], stats['misses'], maxsize, len(entries))
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+                stats.update(hits=0, misses=0)
+
+        wrapper.entry = entry
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
@@ -4,6 +4,7 @@ from qiskit import QuantumCircuit
 import numpy as np
 import math
 from fractions import Fraction
+from qiskit_textbook.problems.oracle_cache import cached_oracle
 
 def vector2latex(vector, precision=5, pretext="", display_output=True):
     """replace with array_to_latex"""
@@ -23,6 +24,7 @@ def vector2latex(vector, precision=5, pretext="", display_output=True):
     else:
         return out_latex
 
+@cached_oracle()
 def simon_oracle(b):
     """returns a Simon oracle for bitstring b"""
     b = b[::-1] # reverse b for easy iteration
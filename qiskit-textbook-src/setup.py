@@ -18,5 +18,8 @@ setup(
     'numpy',
     'matplotlib',
     'numexpr'
-  ]
+  ],
+  extras_require={
+    'canvas': ['ipycanvas']
+  }
 )
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it works out which notebooks in <content-dir> could be
+affected by a set of changed files, so run_notebooks_soft.py only has to run those.
+
+The code cells of each notebook are parsed to find the qiskit_textbook symbols (functions,
+classes and modules) and the data files they use. qiskit_textbook is parsed too, to find
+which of its symbols use which others. A notebook is affected if:
+  - the notebook itself changed,
+  - one of the qiskit_textbook symbols it uses changed, or uses a symbol that changed,
+  - a data file (or folder) it opens changed,
+  - requirements.txt, environment.yml or the qiskit_textbook packaging changed,
+  - or its code couldn't be parsed, and anything in qiskit_textbook changed.
+Given a list of paths, a changed qiskit_textbook module counts as every symbol in it having
+changed. With --since REF, the lines changed since the git revision REF are used to find
+the symbols that changed.
+
+Usage: python3 affected_notebooks.py <content-dir> [--toc <toc-filepath>] (--since REF | <path> ...)
+       python3 affected_notebooks.py <content-dir> --index
+"""
+
+import ast
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import nbformat
+import yaml
+
+path_root = Path(__file__).parent.parent
+package = 'qiskit_textbook'
+package_path = path_root.joinpath('qiskit-textbook-src', package)
+
+# changes to these (relative to the repository) could affect every notebook
+environment_files = ['requirements.txt', 'environment.yml', 'runtime.txt',
+                     'qiskit-textbook-src/setup.py']
+
+
+def relative_path(filepath):
+    return os.path.relpath(os.path.abspath(filepath), path_root)
+
+
+def toc_urls(toc_filepath):
+    '''
+    The urls of all the pages in the toc file that aren't external links, without the leading '/'.
+    '''
+    with open(toc_filepath) as f:
+        entries = yaml.safe_load(f) or []
+    urls = []
+    while entries:
+        entry = entries.pop(0)
+        if not isinstance(entry, dict):
+            continue
+        if entry.get('url') and not entry.get('external'):
+            urls.append(entry['url'].strip().strip('/'))
+        entries.extend(entry.get('sections') or [])
+        entries.extend(entry.get('subsections') or [])
+    return urls
+
+
+def in_toc(filepath, urls):
+    '''
+    Returns True if the notebook at `filepath` is one of the pages `urls` (from `toc_urls`).
+    '''
+    page = os.path.splitext(os.path.abspath(filepath))[0].replace(os.sep, '/')
+    return any(page.endswith('/' + url) for url in urls)
+
+
+def _code(source):
+    '''
+    The Python in a code cell, with IPython magics and shell commands turned into plain Python.
+    '''
+    try:
+        from IPython.core.inputtransformer2 import TransformerManager
+        return TransformerManager().transform_cell(source)
+    except ImportError:
+        return '\n'.join('' if line.lstrip().startswith(('%', '!')) else line
+                         for line in source.split('\n'))
+
+
+def _dotted(node):
+    '''
+    'a.b.c' for the expression a.b.c, or None if it isn't a chain of names.
+    '''
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+def _resolve_import(node, module, is_package):
+    '''
+    Returns the module a `from ... import` statement in `module` imports from.
+    '''
+    if not node.level:
+        return node.module
+    base = module.split('.')
+    if not is_package:
+        base = base[:-1]
+    base = base[:len(base) - (node.level - 1)]
+    return '.'.join(base + ([node.module] if node.module else []))
+
+
+def _imports(tree, module=None, is_package=False):
+    '''
+    Returns a dict from the names bound by the import statements in `tree` to what they refer to.
+    Star imports are stored under '*'.
+    '''
+    aliases = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for name in node.names:
+                if name.asname:
+                    aliases[name.asname] = name.name
+                else:
+                    aliases[name.name.split('.')[0]] = name.name.split('.')[0]
+        elif isinstance(node, ast.ImportFrom):
+            source = _resolve_import(node, module, is_package)
+            if source is None:
+                continue
+            for name in node.names:
+                if name.name == '*':
+                    aliases.setdefault('*', []).append(source)
+                else:
+                    aliases[name.asname or name.name] = source + '.' + name.name
+    return aliases
+
+
+def _uses(tree, aliases):
+    '''
+    The dotted names that `tree` refers to through the names in `aliases`.
+    '''
+    uses = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Name)):
+            dotted = _dotted(node)
+            if dotted is None:
+                continue
+            root, _, rest = dotted.partition('.')
+            if root in aliases:
+                uses.add(aliases[root] + ('.' + rest if rest else ''))
+    return uses
+
+
+def _string(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if sys.version_info < (3, 8) and isinstance(node, ast.Str):
+        return node.s
+    return None
+
+
+def _data_files(tree, directory):
+    '''
+    Repository-relative paths of the existing files and folders named by string constants
+    in `tree`, relative to `directory`. For a string like 'results/raw_' the folder is used.
+    '''
+    found = set()
+    for node in ast.walk(tree):
+        value = _string(node)
+        if value is None:
+            continue
+        value = value.strip()
+        if not value or '\n' in value or len(value) > 200:
+            continue
+        filepath = os.path.normpath(os.path.join(directory, value))
+        if not filepath.startswith(str(path_root) + os.sep):
+            continue
+        if os.path.isfile(filepath):
+            found.add(relative_path(filepath))
+        elif os.path.isdir(os.path.dirname(filepath)):
+            folder = os.path.dirname(filepath)
+            # the notebook's own folder, or one above it, would match almost any change
+            if not (directory + os.sep).startswith(folder + os.sep):
+                found.add(relative_path(folder) + '/')
+    return found
+
+
+def notebook_dependencies(filepath):
+    '''
+    Returns a dict with the qiskit_textbook names the notebook uses ('symbols'), the data
+    files and folders it uses ('data') and whether all of its code could be parsed ('parsed').
+    '''
+    with open(filepath) as f:
+        nb = nbformat.read(f, as_version=4)
+    symbols, data, parsed = set(), set(), True
+    directory = os.path.dirname(os.path.abspath(filepath))
+    aliases = {}
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        try:
+            tree = ast.parse(_code(cell.source))
+        except SyntaxError:
+            parsed = False
+            continue
+        # names imported in earlier cells are still bound in later ones
+        aliases.update({name: target for name, target in _imports(tree).items() if name != '*'})
+        for source in _imports(tree).get('*', []):
+            if source.split('.')[0] == package:
+                symbols.add(source)
+        symbols |= {use for use in _uses(tree, aliases) if use.split('.')[0] == package}
+        data |= _data_files(tree, directory)
+    return {'symbols': sorted(symbols), 'data': sorted(data), 'parsed': parsed}
+
+
+def module_name(filepath):
+    parts = list(Path(filepath).relative_to(package_path.parent).with_suffix('').parts)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def _first_line(node):
+    return min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+
+
+def _line_range(node, tree, lines):
+    '''
+    The first and last line of the top-level statement `node` of `tree`, a module of `lines`
+    lines. It ends where the next statement starts, as `end_lineno` is Python 3.8+ only.
+    '''
+    following = [_first_line(other) for other in tree.body if _first_line(other) > node.lineno]
+    return _first_line(node), (min(following) - 1 if following else lines)
+
+
+def package_index():
+    '''
+    Returns (symbols, dependencies): `symbols` maps each module file (repository-relative) to
+    a list of (symbol, first line, last line) for its top-level definitions, and
+    `dependencies` maps each symbol to the set of qiskit_textbook names it uses.
+    '''
+    symbols, dependencies = {}, {}
+    for filepath in sorted(package_path.rglob('*.py')):
+        module = module_name(filepath)
+        with open(filepath) as f:
+            source = f.read()
+        tree = ast.parse(source)
+        lines = len(source.splitlines())
+        aliases = _imports(tree, module, filepath.name == '__init__.py')
+        for source in aliases.pop('*', []):
+            dependencies.setdefault(module, set()).add(source)
+        definitions = []
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                definitions.append((node.name, node))
+            elif isinstance(node, ast.Assign):
+                definitions.extend((target.id, node) for target in node.targets if isinstance(target, ast.Name))
+        # names defined in the module refer to its own symbols
+        aliases.update({name: module + '.' + name for name, _ in definitions})
+        symbols[relative_path(filepath)] = [(module + '.' + name,) + _line_range(node, tree, lines)
+                                            for name, node in definitions]
+        for name, node in definitions:
+            uses = {use for use in _uses(node, aliases) if use.split('.')[0] == package}
+            dependencies.setdefault(module + '.' + name, set()).update(uses - {module + '.' + name})
+    return symbols, dependencies
+
+
+def _overlaps(name, other):
+    # one is the other, or contains it (a module and one of its functions, a class and its method)
+    return name == other or name.startswith(other + '.') or other.startswith(name + '.')
+
+
+def changed_symbols(filepath, lines, symbols):
+    '''
+    The symbols of the qiskit_textbook module `filepath` that contain any of `lines`
+    (all of them if `lines` is None). A change outside any definition changes the whole module.
+    '''
+    definitions = symbols.get(filepath)
+    module = module_name(path_root.joinpath(filepath))
+    if definitions is None or lines is None:
+        return {module}
+    changed = set()
+    for line in lines:
+        containing = [name for name, first, last in definitions if first <= line <= last]
+        if not containing:
+            return {module}
+        changed.update(containing)
+    return changed
+
+
+def diff_lines(since):
+    '''
+    Returns a dict from each file (repository-relative) changed since the git revision `since`
+    to the set of changed line numbers in its current version (None if it was deleted).
+    '''
+    diff = subprocess.run(['git', 'diff', '-U0', since, '--'], cwd=path_root, capture_output=True,
+                          text=True, check=True).stdout
+    changes, filepath, old_path = {}, None, None
+    for line in diff.split('\n'):
+        if line.startswith('--- '):
+            old_path = line[6:] if line.startswith('--- a/') else None
+        elif line.startswith('+++ '):
+            filepath = line[6:] if line.startswith('+++ b/') else old_path
+            changes[filepath] = None if not line.startswith('+++ b/') else set()
+        elif line.startswith('@@') and changes.get(filepath) is not None:
+            start, _, count = re.match(r'@@ -\S+ \+(\d+)(,(\d+))? @@', line).groups()
+            start, count = int(start), int(count) if count is not None else 1
+            changes[filepath].update(range(start, start + max(count, 1)))
+    return changes
+
+
+def affected_notebooks(filepaths, changes):
+    '''
+    Returns the notebooks in `filepaths` that could be affected by `changes`, a dict from
+    repository-relative paths to the changed line numbers in them (or None if not known).
+    '''
+    if any(path in environment_files for path in changes):
+        return list(filepaths)
+    symbols, dependencies = package_index()
+    package_prefix = relative_path(package_path) + '/'
+    changed = set()
+    for path, lines in changes.items():
+        if path.startswith(package_prefix) and path.endswith('.py'):
+            changed |= changed_symbols(path, lines, symbols)
+
+    # add the symbols that use changed ones, until there are no more
+    while True:
+        users = {name for name, uses in dependencies.items() if name not in changed
+                 and any(_overlaps(use, other) for use in uses for other in changed)}
+        if not users:
+            break
+        changed |= users
+
+    affected = []
+    for filepath in filepaths:
+        path = relative_path(filepath)
+        dependencies = notebook_dependencies(filepath)
+        if (path in changes
+                or any(_overlaps(name, other) for name in dependencies['symbols'] for other in changed)
+                or any(other == data or (data.endswith('/') and other.startswith(data))
+                       for data in dependencies['data'] for other in changes)
+                or (not dependencies['parsed'] and changed)):
+            affected.append(filepath)
+    return affected
+
+
+def find_notebooks(base_dir, toc_filepath=None):
+    urls = toc_urls(toc_filepath) if toc_filepath is not None else None
+    filepaths = []
+    for (dirpath, _, filenames) in os.walk(base_dir):
+        for name in filenames:
+            if name.endswith(".ipynb"):
+                filepath = os.path.join(dirpath, name)
+                if urls is None or in_toc(filepath, urls):
+                    filepaths.append(filepath)
+    return filepaths
+
+
+def changes_from(paths=None, since=None):
+    '''
+    The `changes` for `affected_notebooks`, from a list of changed paths and/or a git revision.
+    '''
+    changes = diff_lines(since) if since is not None else {}
+    for path in paths or []:
+        changes[relative_path(path)] = None
+    return changes
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('base_dir')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--toc', metavar='TOC_FILEPATH')
+    parser.add_argument('--since', metavar='REF')
+    parser.add_argument('--index', action='store_true', help="print what each notebook depends on")
+    args = parser.parse_intermixed_args()
+    filepaths = find_notebooks(args.base_dir, args.toc)
+
+    if args.index:
+        index = {relative_path(filepath): notebook_dependencies(filepath) for filepath in sorted(filepaths)}
+        print(json.dumps(index, indent=1))
+        sys.exit(os.EX_OK)
+    if not args.paths and args.since is None:
+        parser.error("give the changed paths or --since REF")
+
+    for filepath in sorted(affected_notebooks(filepaths, changes_from(args.paths, args.since))):
+        print(filepath)
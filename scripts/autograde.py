@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it grades a folder of submitted exercise notebooks
+(e.g. copies of content/ch-ex/ex1.ipynb, or challenges built on qiskit_textbook.problems).
+
+What is graded is described in an assignment file (YAML):
+
+    timeout: 120        # seconds each submission may run for, in total
+    memory: 2048        # MiB of memory each submission's kernel may use
+    instances: simon.npy   # optional, from `python -m qiskit_textbook.problems.instances`
+    checks:
+      - name: not_gate
+        type: function  # calls the notebook's function with each case's arguments
+        target: NOT
+        cases: [[['0'], '1'], [['1'], '0']]
+      - name: dj_oracle
+        type: oracle    # compares the oracle with qiskit_textbook.problems.grading
+        target: oracle
+        reference: dj_problem_oracle(1)
+        points: 2
+      - name: secret
+        type: answer    # compares the value with the expected one
+        target: secret
+        expected: expected_answer(instance)
+
+`target` is evaluated in the notebook's namespace once all its cells have run, by a cell
+added to the end, which sends its value (or, for function checks, the value it returns for
+the arguments of each case) back to this script: as JSON, with NumPy arrays, complex
+numbers and dicts tagged, and oracles as QPY. The kernel is only given the targets and the
+arguments, and the values are scored here, as the submission could change anything that
+runs in its kernel. `reference` and `expected` are evaluated with the names of
+qiskit_textbook.problems, qiskit_textbook.problems.instances and qiskit_textbook.tools,
+and, if the assignment has `instances`, `instance`: the record whose index is the
+"instance" key of the notebook's metadata (checks that use it fail if there's no such key).
+Each check is worth `points` (1 by default), and scores between 0 and `points`; function
+checks get a share for each case they get right, and answers are compared to within
+`tolerance` if it's given.
+
+Every submission is run in its own kernel, in an empty temporary folder, with --jobs
+submissions at a time. Cells that raise errors don't stop the run, so the checks of the
+parts that work still score. The memory limit is set with setrlimit in a setup cell (see
+notebook_execution.add_setup_cell). A submission that runs out of time scores 0, and one
+whose kernel runs out of memory (or dies) scores what it sent back before that, if anything.
+
+Grades are cached under a hash of the submission's code and instance, the assignment (and
+its instances file), this script and the environment (see exec_cache.py), so only new or
+changed submissions are run again.
+Pass --no-cache to run every submission. The scores, and the time and peak memory each
+submission took, are written to a CSV file.
+
+Usage: python3 autograde.py <assignment> <submissions-dir> [--output PATH] [--jobs N] [--no-cache]
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+# this module is also imported by the kernels running the submissions, so only the
+# standard library is imported here; the rest is imported where it's used
+
+path_root = Path(__file__).parent.parent
+grades_path = path_root.joinpath('_build', '.exec_cache', 'autograde.sqlite')
+results_mimetype = 'application/vnd.textbook.autograde+json'
+check_types = ['function', 'oracle', 'answer']
+
+# set by `configure` in the kernel running a submission
+_targets = None
+
+
+def kernel_targets(checks):
+    '''
+    What the kernel is given of each check: its name, type and target, and the arguments
+    of the cases of function checks, but not the values they're compared with.
+    '''
+    targets = []
+    for check in checks:
+        target = {'name': check['name'], 'type': check['type'], 'target': check['target']}
+        if check['type'] == 'function':
+            target['args'] = [args for args, _ in check['cases']]
+        targets.append(target)
+    return targets
+
+
+def setup_code(checks, memory=None):
+    '''
+    Lines for notebook_execution.add_setup_cell that limit the memory of the kernel to
+    `memory` MiB and give it the targets of the `checks` for the `report_code` cell.
+    '''
+    return ['import autograde',
+            f'autograde.configure({kernel_targets(checks)!r}, memory={memory!r})']
+
+
+def report_code():
+    '''
+    Lines for the cell added to the end of a submission, which sends back the values of
+    the targets.
+    '''
+    return ['import autograde',
+            'autograde.report(globals())']
+
+
+def configure(targets, memory=None):
+    global _targets
+    if memory:
+        import resource
+        limit = int(memory * 2**20)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    _targets = targets
+
+
+def encode_value(value):
+    '''
+    `value` as JSON: NumPy arrays, complex numbers and dicts are tagged (so every JSON
+    object is a tag), and tuples become lists.
+    '''
+    import numpy as np
+    if isinstance(value, np.ndarray):
+        return {'ndarray': encode_value(value.tolist())}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, complex):
+        return {'complex': [value.real, value.imag]}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {'dict': [[encode_value(key), encode_value(item)] for key, item in value.items()]}
+    raise TypeError(f"can't send a {type(value).__name__} to the grader")
+
+
+def decode_value(data):
+    '''
+    The value encoded by `encode_value` (with lists as keys of dicts made into tuples).
+    '''
+    import numpy as np
+    if isinstance(data, list):
+        return [decode_value(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    if 'ndarray' in data:
+        return np.array(decode_value(data['ndarray']))
+    if 'complex' in data:
+        return complex(*data['complex'])
+    if 'dict' in data:
+        return {_hashable(decode_value(key)): decode_value(item) for key, item in data['dict']}
+    raise ValueError(f"unknown value {data!r}")
+
+
+def _hashable(key):
+    return tuple(_hashable(item) for item in key) if isinstance(key, list) else key
+
+
+def encode_oracle(oracle):
+    '''
+    A circuit or gate as QPY, in base64.
+    '''
+    import base64
+    import io
+    from qiskit import QuantumCircuit, qpy
+    if not isinstance(oracle, QuantumCircuit):
+        circuit = QuantumCircuit(oracle.num_qubits)
+        circuit.append(oracle, range(oracle.num_qubits))
+        oracle = circuit
+    buffer = io.BytesIO()
+    qpy.dump(oracle, buffer)
+    return {'qpy': base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+
+def decode_oracle(data):
+    import base64
+    import io
+    from qiskit import qpy
+    return qpy.load(io.BytesIO(base64.b64decode(data['qpy'])))[0]
+
+
+def report(namespace):
+    '''
+    Evaluates the targets given to `configure` in the notebook's `namespace`, and displays
+    their values for the grader to score. Nothing is scored here.
+    '''
+    from IPython.display import display
+    results = []
+    for target in _targets:
+        result = {'name': target['name']}
+        try:
+            value = eval(target['target'], namespace)
+            if target['type'] == 'function':
+                result['values'] = [encode_value(value(*args)) for args in target['args']]
+            elif target['type'] == 'oracle':
+                result['value'] = encode_oracle(value)
+            else:
+                result['value'] = encode_value(value)
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+        results.append(result)
+    display({results_mimetype: results}, raw=True)
+
+
+def reference_namespace(instances=None, index=None):
+    '''
+    The names `reference` and `expected` are evaluated with.
+    '''
+    import qiskit_textbook.problems
+    import qiskit_textbook.problems.instances
+    import qiskit_textbook.tools
+    namespace = {}
+    for module in [qiskit_textbook.tools, qiskit_textbook.problems, qiskit_textbook.problems.instances]:
+        namespace.update({name: value for name, value in vars(module).items() if not name.startswith('_')})
+    if instances is not None and index is not None:
+        namespace['instance'] = qiskit_textbook.problems.instances.load_instances(instances)[index]
+    return namespace
+
+
+def _same(value, expected, tolerance=None):
+    import numpy as np
+    if tolerance is not None:
+        return bool(np.allclose(value, expected, atol=tolerance))
+    if isinstance(value, np.ndarray) or isinstance(expected, np.ndarray):
+        return bool(np.array_equal(value, expected))
+    if isinstance(expected, list) and not isinstance(value, list):
+        value = list(value)
+    return bool(value == expected)
+
+
+def run_check(check, result, references):
+    '''
+    Returns the fraction of the points `check` scores, from the `result` the kernel sent
+    back for it.
+    '''
+    if check['type'] == 'function':
+        values = result['values']
+        if len(values) != len(check['cases']):
+            raise ValueError(f"expected {len(check['cases'])} values, got {len(values)}")
+        right = 0
+        for data, (_, expected) in zip(values, check['cases']):
+            right += _same(decode_value(data), expected, check.get('tolerance'))
+        return right / len(check['cases'])
+    if check['type'] == 'oracle':
+        from qiskit_textbook.problems.grading import grade
+        return float(grade(decode_oracle(result['value']), eval(check['reference'], references)))
+    if check['type'] == 'answer':
+        expected = eval(check['expected'], references)
+        return float(_same(decode_value(result['value']), expected, check.get('tolerance')))
+    raise ValueError(f"unknown check type '{check['type']}'")
+
+
+def score_checks(assignment, results, index=None):
+    '''
+    Scores the `results` a submission's kernel sent back against the checks of the
+    assignment, with `index` the instance of the submission. Returns a dict for each check,
+    with its name, score (between 0 and its points), points and any error message.
+    '''
+    try:
+        references, error = reference_namespace(assignment.get('instances'), index), None
+    except Exception as e:
+        references, error = None, f"{type(e).__name__}: {e}"
+    sent = {}
+    for result in results if isinstance(results, list) else []:
+        if isinstance(result, dict) and result.get('name') not in sent:
+            sent[result.get('name')] = result
+    scores = []
+    for check in assignment['checks']:
+        points, result = check.get('points', 1), sent.get(check['name'])
+        if error or result is None or 'error' in result:
+            score, message = 0, error or ("no value was sent back" if result is None else str(result['error']))
+        else:
+            try:
+                score, message = points * min(max(run_check(check, result, references), 0), 1), ''
+            except Exception as e:
+                score, message = 0, f"{type(e).__name__}: {e}"
+        scores.append({'name': check['name'], 'score': score, 'points': points, 'message': message})
+    return scores
+
+
+def load_assignment(filepath):
+    import yaml
+    with open(filepath, encoding='utf8') as f:
+        assignment = yaml.safe_load(f)
+    for check in assignment.get('checks', []):
+        if check.get('type') not in check_types:
+            raise ValueError(f"check '{check.get('name')}' has an unknown type, expected one of {check_types}")
+    if assignment.get('instances'):
+        # relative to the assignment file
+        assignment['instances'] = os.path.abspath(os.path.join(os.path.dirname(filepath), assignment['instances']))
+    return assignment
+
+
+def _file_hash(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def grading_mode(assignment):
+    '''
+    Hash of what a submission is graded with, apart from its notebook: this script, the
+    checks of the assignment and the contents of its instances file.
+    '''
+    mode = hashlib.sha256(_file_hash(__file__).encode())
+    mode.update(json.dumps(assignment['checks'], sort_keys=True, default=str).encode())
+    if assignment.get('instances'):
+        mode.update(_file_hash(assignment['instances']).encode())
+    return 'autograde-' + mode.hexdigest()
+
+
+def grading_key(nb, env_hash, mode, index=None):
+    '''
+    Hash of a submission with its setup and report cells added, `env_hash`, `mode` (see
+    `grading_mode`) and `index`, the instance the submission is scored against (from its
+    metadata, which notebook_key leaves out).
+    '''
+    from exec_cache import notebook_key
+    return notebook_key(nb, env_hash, f'{mode}-instance-{json.dumps(index)}')
+
+
+class GradeCache():
+    '''
+    SQLite store of the results of grading submissions, keyed on `grading_key`.
+    '''
+
+    def __init__(self, path=grades_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS grades (
+                                           key TEXT PRIMARY KEY,
+                                           submission TEXT,
+                                           created REAL,
+                                           result TEXT)''')
+
+    def get(self, key):
+        row = self.connection.execute('SELECT result FROM grades WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, submission, result):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?)',
+                                    (key, submission, time.time(), json.dumps(result)))
+
+
+def _check_results(nb):
+    for output in nb.cells[-1].get('outputs', []):
+        if results_mimetype in output.get('data', {}):
+            return output['data'][results_mimetype]
+    return None
+
+
+def grade_submission(filepath, assignment, env_hash=None, mode=None):
+    '''
+    Runs the submission at `filepath` and scores its checks. Returns a dict with its status
+    ('ok', 'timeout', 'memory' if it ran out of memory, or 'error' if its targets couldn't
+    be sent back), the results of the checks, the time taken, the peak memory of the kernel,
+    and whether the result came from the cache (which is used if `env_hash` is given, with
+    `mode` from `grading_mode`, worked out here if it isn't given).
+    '''
+    import tempfile
+    import nbformat
+    from notebook_execution import TextbookExecutePreprocessor, add_setup_cell, error_summary
+    try:
+        from nbclient.exceptions import DeadKernelError
+    except ImportError:  # nbconvert < 6
+        from nbconvert.preprocessors.execute import DeadKernelError
+    t0 = time.time()
+    result = {'submission': os.path.relpath(filepath), 'status': 'ok', 'checks': [], 'message': '',
+              'seconds': 0, 'peak_rss_mb': None, 'cached': False}
+    try:
+        with open(filepath, encoding='utf8') as f:
+            nb = nbformat.read(f, as_version=4)
+    except Exception as e:
+        return dict(result, status='error', message=f"can't read the notebook: {e}")
+    index = nb.metadata.get('instance')
+    add_setup_cell(nb, setup_code(assignment['checks'], assignment.get('memory')))
+    add_setup_cell(nb, report_code(), position=len(nb.cells))
+
+    if env_hash is not None:
+        cache = GradeCache()
+        key = grading_key(nb, env_hash, mode or grading_mode(assignment), index)
+        cached = cache.get(key)
+        if cached is not None:
+            return dict(cached, submission=result['submission'], cached=True)
+
+    ep = TextbookExecutePreprocessor(timeout=None, kernel_name='python3', allow_errors=True,
+                                     notebook_timeout=assignment.get('timeout'))
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            ep.preprocess(nb, {'metadata': {'path': workdir}})
+            sent = _check_results(nb)
+            if sent is None:
+                result.update(status='error', message="the targets weren't sent back")
+        except TimeoutError as e:
+            # the notebook's time ran out, during a cell or between cells
+            result.update(status='timeout', message=error_summary(e))
+        except DeadKernelError as e:
+            # e.g. killed by the kernel's memory limit
+            result.update(status='memory', message=error_summary(e))
+        except Exception as e:
+            result.update(status='error', message=error_summary(e))
+    peaks = [timing['peak_rss_mb'] for timing in ep.cell_timings if timing['peak_rss_mb'] is not None]
+    result.update(seconds=time.time() - t0, peak_rss_mb=max(peaks) if peaks else None)
+    errors = [output.get('ename') for cell in nb.cells for output in cell.get('outputs', [])
+              if output.get('output_type') == 'error']
+    if 'MemoryError' in errors:
+        result['status'] = 'memory'
+    if result['status'] != 'timeout':
+        result['checks'] = score_checks(assignment, _check_results(nb), index)
+    # a timeout can depend on how busy the machine was, so it isn't cached
+    if env_hash is not None and result['status'] in ['ok', 'memory']:
+        cache.put(key, result['submission'], result)
+    return result
+
+
+def score(result):
+    return sum(check['score'] for check in result['checks']) if result['status'] != 'timeout' else 0
+
+
+def write_grades(results, assignment, filepath):
+    '''
+    Writes one row per submission, with its total score, the score of each check, its
+    status, time and peak memory, and the error messages of the checks.
+    '''
+    import csv
+    names = [check['name'] for check in assignment['checks']]
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    with open(filepath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['submission', 'score', 'out_of'] + names
+                        + ['status', 'seconds', 'peak_rss_mb', 'cached', 'messages'])
+        out_of = sum(check.get('points', 1) for check in assignment['checks'])
+        for result in sorted(results, key=lambda result: result['submission']):
+            scores = {check['name']: check['score'] for check in result['checks']}
+            messages = [f"{check['name']}: {check['message']}" for check in result['checks'] if check['message']]
+            peak = '' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+            writer.writerow([result['submission'], f"{score(result):g}", f"{out_of:g}"]
+                            + [f"{scores[name]:g}" if name in scores and result['status'] != 'timeout' else 0
+                               for name in names]
+                            + [result['status'], f"{result['seconds']:.1f}", peak, int(result['cached']),
+                               '; '.join([result['message']] * bool(result['message']) + messages)])
+
+
+if __name__ == '__main__':
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from exec_cache import environment_hash
+    from notebook_execution import timestamp
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('assignment')
+    parser.add_argument('submissions_dir')
+    parser.add_argument('--output', '-o', default='grades.csv', help="the CSV file to write the grades to")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="number of submissions to run at the same time")
+    parser.add_argument('--no-cache', action='store_true', help="run submissions even if they were graded before")
+    args = parser.parse_args()
+    assignment = load_assignment(args.assignment)
+    env_hash = None if args.no_cache else environment_hash()
+    mode = None if args.no_cache else grading_mode(assignment)
+
+    filepaths = sorted(str(path) for path in Path(args.submissions_dir).rglob('*.ipynb')
+                       if '.ipynb_checkpoints' not in path.parts)
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(grade_submission, filepath, assignment, env_hash, mode) for filepath in filepaths]
+        for future in as_completed(futures):
+            result = future.result()
+            status = 'cached' if result['cached'] else f"{result['status']}, {result['seconds']:.1f}s"
+            print(timestamp() + f"{result['submission']}: {score(result):g} ({status})")
+            results.append(result)
+    write_grades(results, assignment, args.output)
+    print(f"Graded {len(results)} submissions ({sum(result['cached'] for result in results)} cached) "
+          f"in {time.time() - t0:.2f} seconds, see {args.output}")
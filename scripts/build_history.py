@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it keeps the history of how long each notebook
+took to run, which run_notebooks.py and run_notebooks_soft.py add to after every run.
+
+The runners' --compare-baseline PCT option fails the run if a notebook took more than
+PCT percent longer than the median of its previous runs (at other commits).
+
+Usage: python3 build_history.py trend [--runner soft|full] [--last N]
+       python3 build_history.py clear
+"""
+
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+path_root = Path(__file__).parent.parent
+history_path = path_root.joinpath('_build', '.exec_cache', 'history.sqlite')
+
+# number of previous runs the baseline median is taken over
+baseline_window = 10
+# differences smaller than this many seconds are never reported as regressions
+min_slowdown = 1.0
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def relative_notebook_path(filepath):
+    return os.path.relpath(os.path.abspath(filepath), path_root)
+
+
+class BuildHistory():
+    '''
+    SQLite store of notebook run times, keyed on git commit.
+    '''
+
+    def __init__(self, path=history_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS durations (
+                                           commit_id TEXT,
+                                           notebook TEXT,
+                                           runner TEXT,
+                                           seconds REAL,
+                                           recorded REAL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS durations_notebook ON durations (notebook, runner)')
+
+    def record(self, durations, runner, commit=None):
+        '''
+        Adds the run times in `durations`, a dict from notebook path to seconds.
+        '''
+        commit = commit or current_commit()
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT INTO durations VALUES (?, ?, ?, ?, ?)',
+                                        [(commit, relative_notebook_path(filepath), runner, seconds, now)
+                                         for filepath, seconds in durations.items()])
+
+    def previous(self, notebook, runner, exclude_commit=None, limit=baseline_window):
+        '''
+        The most recent run times of `notebook`, newest first, leaving out runs at `exclude_commit`.
+        '''
+        rows = self.connection.execute('''SELECT seconds FROM durations
+                                          WHERE notebook = ? AND runner = ? AND commit_id != ?
+                                          ORDER BY recorded DESC LIMIT ?''',
+                                       (notebook, runner, exclude_commit or '', limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def compare(self, durations, runner, threshold, commit=None):
+        '''
+        Returns (notebook, seconds, baseline) for every notebook in `durations` that
+        took more than `threshold` percent longer than its baseline, which is the
+        median of its previous runs at other commits.
+        '''
+        commit = commit or current_commit()
+        regressions = []
+        for filepath, seconds in sorted(durations.items()):
+            previous = self.previous(relative_notebook_path(filepath), runner, exclude_commit=commit)
+            if not previous:
+                continue
+            baseline = statistics.median(previous)
+            if seconds > baseline * (1 + threshold / 100) and seconds - baseline > min_slowdown:
+                regressions.append((filepath, seconds, baseline))
+        return regressions
+
+    def trend(self, runner, last=baseline_window):
+        '''
+        Returns (notebook, runs, median, latest, history) for each notebook, where
+        history holds the per-commit mean of the last `last` commits, oldest first.
+        '''
+        notebooks = [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT notebook FROM durations WHERE runner = ? ORDER BY notebook', (runner,))]
+        rows = []
+        for notebook in notebooks:
+            per_commit = self.connection.execute('''SELECT AVG(seconds), MAX(recorded) FROM durations
+                                                    WHERE notebook = ? AND runner = ?
+                                                    GROUP BY commit_id ORDER BY MAX(recorded) DESC LIMIT ?''',
+                                                 (notebook, runner, last)).fetchall()
+            history = [seconds for seconds, _ in reversed(per_commit)]
+            all_runs = self.previous(notebook, runner, limit=-1)
+            rows.append((notebook, len(all_runs), statistics.median(all_runs), history[-1], history))
+        return rows
+
+    def clear(self):
+        with self.connection:
+            return self.connection.execute('DELETE FROM durations').rowcount
+
+
+def print_regressions(regressions, threshold):
+    if not regressions:
+        print(f"No notebook was more than {threshold:g}% slower than its baseline.")
+        return
+    print(f"{len(regressions)} notebooks were more than {threshold:g}% slower than their baseline:")
+    for filepath, seconds, baseline in regressions:
+        print(f"  {filepath}: {seconds:.1f}s (baseline {baseline:.1f}s, +{100 * (seconds / baseline - 1):.0f}%)")
+
+
+def sparkline(values):
+    bars = '▁▂▃▄▅▆▇█'
+    low, high = min(values), max(values)
+    if high - low < 1e-9:
+        return bars[0] * len(values)
+    return ''.join(bars[int((value - low) / (high - low) * (len(bars) - 1))] for value in values)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('command', choices=['trend', 'clear'])
+    parser.add_argument('--runner', choices=['soft', 'full'], default='soft')
+    parser.add_argument('--last', type=int, default=baseline_window, metavar='N')
+    args = parser.parse_args()
+    history = BuildHistory()
+
+    if args.command == 'clear':
+        print(f"Removed {history.clear()} recorded runs")
+        sys.exit(os.EX_OK)
+
+    rows = history.trend(args.runner, args.last)
+    width = max([len('Notebook')] + [len(row[0]) for row in rows])
+    print(f"{'Notebook':<{width}}  {'Runs':>5}  {'Median':>8}  {'Latest':>8}  {'Change':>7}  Last {args.last} commits")
+    for notebook, runs, median, latest, trend in rows:
+        change = 100 * (latest / median - 1) if median else 0
+        print(f"{notebook:<{width}}  {runs:>5}  {median:>7.1f}s  {latest:>7.1f}s  {change:>+6.0f}%  {sparkline(trend)}")
+    budget = sum(row[2] for row in rows)
+    latest = sum(row[3] for row in rows)
+    print(f"Total: median {budget:.0f}s, latest {latest:.0f}s over {len(rows)} notebooks")
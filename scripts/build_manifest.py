@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it lets `make book` and `make build` only convert the
+pages whose inputs changed since the last build.
+
+Without --overwrite, jupyter-book skips any page whose HTML is newer than its notebook or
+markdown file, which misses changes to the toc, the configuration or jupyter-book itself,
+and rebuilds pages whose files were only touched (e.g. by git). Instead, each page is given
+a hash of everything jupyter-book writes into it: its source file, its toc entry, its
+position and the pages before and after it (for the page navigation), the configuration
+files, and the versions of jupyter-book and nbconvert. `prepare`, run before
+`jupyter-book build`, deletes the HTML of pages whose hash is different from the last
+build's (and of pages no longer in the toc), and makes the HTML of the others newer than
+their sources, so jupyter-book converts exactly the changed pages. `commit`, run after the
+build succeeds, records the hashes in _build/.exec_cache/build_manifest.json.
+
+Redirections and the sidebar navigation (which Jekyll renders from the toc) don't depend on
+the pages, so they are made as before. postprocess_html.py only rereads pages that changed.
+
+Usage: python3 build_manifest.py prepare [--config PATH] [--toc PATH]
+       python3 build_manifest.py commit [--config PATH] [--toc PATH]
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import yaml
+
+path_root = Path(__file__).parent.parent
+manifest_path = path_root.joinpath('_build', '.exec_cache', 'build_manifest.json')
+source_suffixes = ['.ipynb', '.md', '.markdown', '.Rmd', '.py']
+
+
+def flatten_toc(toc):
+    '''
+    The pages of `toc` in the order jupyter-book numbers them (as its `_prepare_toc` does).
+    '''
+    pages = []
+    for chapter in toc:
+        pages.append(chapter)
+        for section in chapter.get('sections', []):
+            pages.append(section)
+            pages.extend(section.get('subsections', []))
+    return [page for page in pages if 'url' in page and not page.get('external', False)]
+
+
+def _page_url(url):
+    return os.path.splitext('/' + url.lstrip('/'))[0] + '.html'
+
+
+def _file_hash(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def template_hash(config_path):
+    '''
+    Hash of the inputs that are the same for every page: the configuration files and the
+    versions of the packages that convert the pages.
+    '''
+    import importlib
+    digest = hashlib.sha256()
+    for filepath in sorted({os.path.abspath(path_root.joinpath('_config.yml')), os.path.abspath(config_path)}):
+        digest.update(_file_hash(filepath).encode())
+    for package in ['jupyter_book', 'nbconvert']:
+        try:
+            digest.update(f"{package}=={importlib.import_module(package).__version__}".encode())
+        except ImportError:
+            pass
+    return digest.hexdigest()
+
+
+def page_hashes(config_path, toc_path):
+    '''
+    Returns a dict of the path of each page's HTML (relative to the repository) to the
+    path of its source file and the hash of its inputs.
+    '''
+    with open(config_path, encoding='utf8') as f:
+        content_folder = yaml.safe_load(f)['content_folder_name'].strip('/')
+    with open(toc_path, encoding='utf8') as f:
+        pages = flatten_toc(yaml.safe_load(f))
+    shared = template_hash(config_path)
+    hashes = {}
+    for ix, page in enumerate(pages):
+        base = os.path.join(content_folder, page['url'].lstrip('/'))
+        source = next((base + suffix for suffix in source_suffixes if path_root.joinpath(base + suffix).exists()), None)
+        if source is None:
+            continue
+        entry = {key: value for key, value in page.items() if key not in ['sections', 'subsections']}
+        neighbours = [_page_url(pages[ix - 1]['url']) if ix > 0 else '',
+                      _page_url(pages[ix + 1]['url']) if ix < len(pages) - 1 else '']
+        inputs = json.dumps([shared, _file_hash(path_root.joinpath(source)), entry, ix, neighbours], sort_keys=True)
+        output = os.path.join('_build', os.path.splitext(page['url'].lstrip('/'))[0] + '.html')
+        hashes[output] = {'source': source, 'hash': hashlib.sha256(inputs.encode()).hexdigest()}
+    return hashes
+
+
+def load_manifest(path=manifest_path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def prepare(config_path, toc_path, path=manifest_path):
+    '''
+    Deletes the HTML of the pages whose inputs changed, or that are no longer in the toc,
+    and makes the HTML of the others newer than their sources. Returns the pages to build.
+    '''
+    built = load_manifest(path).get(os.path.relpath(os.path.abspath(toc_path), path_root), {})
+    hashes = page_hashes(config_path, toc_path)
+    changed = []
+    for output, page in hashes.items():
+        output_path = path_root.joinpath(output)
+        if not output_path.exists():
+            changed.append(output)
+        elif built.get(output, {}).get('hash') != page['hash']:
+            output_path.unlink()
+            changed.append(output)
+        else:
+            source_mtime = os.stat(path_root.joinpath(page['source'])).st_mtime
+            if os.stat(output_path).st_mtime <= source_mtime:
+                os.utime(output_path, (source_mtime + 1, source_mtime + 1))
+    for output in set(built) - set(hashes):
+        if path_root.joinpath(output).exists():
+            path_root.joinpath(output).unlink()
+    return changed
+
+
+def commit(config_path, toc_path, path=manifest_path):
+    '''
+    Records the hashes of the pages that were built.
+    '''
+    manifest = load_manifest(path)
+    manifest[os.path.relpath(os.path.abspath(toc_path), path_root)] = {
+        output: page for output, page in page_hashes(config_path, toc_path).items()
+        if path_root.joinpath(output).exists()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('command', choices=['prepare', 'commit'])
+    parser.add_argument('--config', default=str(path_root.joinpath('_config.yml')))
+    parser.add_argument('--toc', default=str(path_root.joinpath('_data', 'toc.yml')))
+    args = parser.parse_args()
+
+    if args.command == 'prepare':
+        changed = prepare(args.config, args.toc)
+        for output in changed:
+            print(f"To build: {output}")
+        print(f"{len(changed)} pages in {args.toc} need building")
+    else:
+        pages = commit(args.config, args.toc)[os.path.relpath(os.path.abspath(args.toc), path_root)]
+        print(f"Recorded {len(pages)} built pages of {args.toc}")
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it builds the search index of the site from the pages
+jupyter-book wrote to <build-dir>, so readers' browsers don't have to.
+
+The text of each page (its title, headings and the text of its markdown cells, rather than
+the first 100 words jupyter-book puts in its front matter) is indexed with lunr.py, whose
+serialized indexes lunr.js can load as they are. There is one index per chapter (the first
+folder of the page's path), so the search page only downloads the chapters it searches,
+and shows results as each one arrives (see _includes/search/lunr/lunr-en.js). The indexes
+and a manifest listing them are written to assets/search/<locale>/. Their URLs are relative
+to the root of the site, without its baseurl, which the search page adds.
+
+Maths is left out. English pages go through lunr's stop word filter and stemmer; other
+locales are only trimmed of punctuation, as the stemmer is English only.
+
+Usage: python3 build_search_index.py <build-dir> [--locale LOCALE] [--exclude DIR...] [--jobs N]
+"""
+
+import importlib.util
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from html.parser import HTMLParser
+from pathlib import Path
+
+import yaml
+
+path_root = Path(__file__).parent.parent
+output_path = path_root.joinpath('assets', 'search')
+fields = [('title', 10), ('headings', 5), ('body', 1)]
+excerpt_words = 30
+math = re.compile(r'\$\$.*?\$\$|\$[^$]*\$', re.DOTALL)
+
+void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+skipped_tags = {'script', 'style', 'svg', 'math'}
+
+
+class PageText(HTMLParser):
+    '''
+    Collects the text of the markdown cells of a page, and separately that of its headings.
+    Pages without markdown cells have all their text collected.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.body = []
+        self.headings = []
+        self.everything = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in void_tags:
+            return
+        classes = (dict(attrs).get('class') or '').split()
+        self.stack.append((tag, 'text_cell_render' in classes))
+
+    def handle_endtag(self, tag):
+        if tag in void_tags or tag not in [name for name, _ in self.stack]:
+            return
+        while self.stack.pop()[0] != tag:
+            pass
+
+    def handle_data(self, data):
+        tags = [name for name, _ in self.stack]
+        if any(name in skipped_tags for name in tags):
+            return
+        self.everything.append(data)
+        if any(is_markdown for _, is_markdown in self.stack):
+            self.body.append(data)
+            if any(name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6'] for name in tags):
+                self.headings.append(data)
+
+    def text(self):
+        # LaTeX would only add tokens nobody searches for
+        return ' '.join(math.sub(' ', ' '.join(self.body or self.everything)).replace('\xb6', ' ').split())
+
+
+def read_page(filepath):
+    '''
+    Returns the front matter and the HTML of a page written by jupyter-book, or None if it
+    has no front matter (e.g. redirections).
+    '''
+    with open(filepath, encoding='utf-8') as f:
+        content = f.read()
+    if not content.startswith('---\n'):
+        return None
+    front_matter, _, html = content[4:].partition('\n---\n')
+    try:
+        return yaml.safe_load(front_matter) or {}, html
+    except yaml.YAMLError:
+        return None
+
+
+def page_document(filepath, url):
+    '''
+    The document lunr indexes for the page at `filepath`, or None if it isn't searchable.
+    '''
+    page = read_page(filepath)
+    if page is None or page[0].get('search') is False:
+        return None
+    front_matter, html = page
+    parser = PageText()
+    parser.feed(html)
+    body = parser.text()
+    return {'id': url,
+            'title': str(front_matter.get('title') or os.path.splitext(os.path.basename(url))[0]).strip(),
+            'headings': ' '.join(math.sub(' ', ' '.join(parser.headings)).replace('\xb6', ' ').split()),
+            'body': body}
+
+
+def build_shard(documents, locale='en'):
+    '''
+    Returns the serialized lunr index of `documents`, and the store of titles, URLs and
+    excerpts that the search page shows for them.
+    '''
+    from lunr.builder import Builder
+    from lunr.stemmer import stemmer
+    from lunr.stop_word_filter import stop_word_filter
+    from lunr.trimmer import trimmer
+    builder = Builder()
+    builder.pipeline.add(trimmer)
+    if locale == 'en':
+        builder.pipeline.add(stop_word_filter, stemmer)
+        builder.search_pipeline.add(stemmer)
+    builder.ref('id')
+    for name, boost in fields:
+        builder.field(name, boost=boost)
+    for document in documents:
+        builder.add(document)
+    store = {document['id']: {'title': document['title'], 'url': document['id'],
+                              'excerpt': ' '.join(document['body'].split()[:excerpt_words])}
+             for document in documents}
+    return {'index': builder.build().serialize(), 'store': store}
+
+
+def find_pages(build_dir, exclude=()):
+    '''
+    Returns the HTML pages in `build_dir`, grouped by chapter, with their URLs relative to
+    the site.
+    '''
+    site_root = os.path.join(path_root, '_build')
+    chapters = {}
+    for (dirpath, dirnames, filenames) in os.walk(build_dir):
+        if os.path.samefile(dirpath, build_dir):
+            dirnames[:] = [name for name in dirnames if name not in exclude]
+        for name in sorted(filenames):
+            if not name.endswith('.html'):
+                continue
+            filepath = os.path.join(dirpath, name)
+            relpath = Path(os.path.relpath(filepath, build_dir))
+            chapter = relpath.parts[0] if len(relpath.parts) > 1 else 'index'
+            url = '/' + Path(os.path.relpath(os.path.abspath(filepath), site_root)).as_posix()
+            chapters.setdefault(chapter, []).append((filepath, url))
+    return chapters
+
+
+def _build_chapter(task):
+    chapter, pages, locale, path = task
+    documents = [document for document in (page_document(filepath, url) for filepath, url in pages) if document]
+    if not documents:
+        return chapter, 0, 0
+    with open(os.path.join(path, f'{chapter}.json'), 'w', encoding='utf-8') as f:
+        json.dump(build_shard(documents, locale), f, ensure_ascii=False, separators=(',', ':'))
+    return chapter, len(documents), os.path.getsize(os.path.join(path, f'{chapter}.json'))
+
+
+def build_search_index(build_dir, locale='en', exclude=(), jobs=None):
+    '''
+    Writes the index of each chapter in `build_dir`, and the manifest, to
+    assets/search/<locale>/. Returns the manifest.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    path = output_path.joinpath(locale)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    tasks = [(chapter, pages, locale, path) for chapter, pages in sorted(find_pages(build_dir, exclude).items())]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        shards = [{'name': chapter, 'pages': pages, 'size': size}
+                  for chapter, pages, size in pool.map(_build_chapter, tasks) if pages]
+    manifest = {'locale': locale, 'fields': [name for name, _ in fields], 'shards': shards}
+    with open(path.joinpath('manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('build_dir')
+    parser.add_argument('--locale', default='en', help="the language of the pages, and the folder the index is written to")
+    parser.add_argument('--exclude', nargs='*', default=[], help="folders of build-dir to leave out, e.g. the locales")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="number of chapters to index at the same time")
+    args = parser.parse_args()
+    if importlib.util.find_spec('lunr') is None:
+        sys.exit("lunr isn't installed, run `pip install -r requirements-dev.txt`")
+
+    manifest = build_search_index(args.build_dir, args.locale, args.exclude, max(1, args.jobs))
+    for shard in manifest['shards']:
+        print(f"  {shard['name']}: {shard['pages']} pages, {shard['size'] / 1024:.0f} kB")
+    print(f"Built the '{args.locale}' search index of {sum(shard['pages'] for shard in manifest['shards'])} pages "
+          f"in {len(manifest['shards'])} chapters ({sum(shard['size'] for shard in manifest['shards']) / 2**20:.1f} MiB) "
+          f"in {time.time() - t0:.2f} seconds")
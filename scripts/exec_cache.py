@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it is the on-disk execution cache used by
+run_notebooks.py and run_notebooks_soft.py.
+
+A notebook run is cached under a hash of:
+  - the source of the code cells the runner executes,
+  - the source of the installed qiskit_textbook package,
+  - the installed versions of the packages in requirements.txt,
+so it is only reused if none of these have changed.
+
+Usage: python3 exec_cache.py list [<notebook> ...]
+       python3 exec_cache.py invalidate <notebook> [<notebook> ...]
+       python3 exec_cache.py clear
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from pathlib import Path
+
+import nbformat
+
+path_root = Path(__file__).parent.parent
+cache_path = path_root.joinpath('_build', '.exec_cache', 'cache.sqlite')
+
+
+def package_source_hash(package='qiskit_textbook'):
+    '''
+    Hash of all the Python source of the installed `package`.
+    '''
+    digest = hashlib.sha256()
+    spec = importlib.util.find_spec(package)
+    if spec is None or not spec.submodule_search_locations:
+        return 'missing'
+    for location in spec.submodule_search_locations:
+        for dirpath, dirnames, filenames in sorted(os.walk(location)):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith('.py'):
+                    filepath = os.path.join(dirpath, name)
+                    digest.update(os.path.relpath(filepath, location).encode())
+                    with open(filepath, 'rb') as f:
+                        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def installed_version(name):
+    '''
+    The installed version of the distribution `name`, or None if it isn't installed.
+    '''
+    try:
+        from importlib import metadata  # Python 3.8+
+    except ImportError:
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+    if metadata is not None:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return None
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def requirement_versions(requirements=path_root.joinpath('requirements.txt')):
+    '''
+    Returns a dict with the installed version of each package named in `requirements`.
+    '''
+    versions = {}
+    with open(requirements) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line or line.startswith('-'):
+                continue
+            name = re.split(r'[<>=!~\[; ]', line, maxsplit=1)[0]
+            versions[name] = installed_version(name)
+    return versions
+
+
+def environment_hash():
+    '''
+    Hash of everything outside the notebook that the cached runs depend on.
+    '''
+    environment = {'qiskit_textbook': package_source_hash(),
+                   'requirements': requirement_versions()}
+    return hashlib.sha256(json.dumps(environment, sort_keys=True).encode()).hexdigest()
+
+
+def notebook_key(nb, env_hash, mode):
+    '''
+    Cache key for running `nb` with the runner `mode` ('soft' or 'full').
+    Runners should remove any cells they don't execute before calling this.
+    '''
+    digest = hashlib.sha256()
+    digest.update(mode.encode())
+    digest.update(env_hash.encode())
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        digest.update(hashlib.sha256(cell.source.encode()).digest())
+    return digest.hexdigest()
+
+
+def graft_outputs(source_nb, target_nb):
+    '''
+    Copies the outputs and execution counts of the code cells in `source_nb` into
+    the code cells of `target_nb`, in order. Returns True if anything changed.
+    '''
+    source_cells = [cell for cell in source_nb.cells if cell.cell_type == 'code']
+    target_cells = [cell for cell in target_nb.cells if cell.cell_type == 'code']
+    changed = False
+    for source, target in zip(source_cells, target_cells):
+        if target.outputs != source.outputs or target.execution_count != source.execution_count:
+            target.outputs = source.outputs
+            target.execution_count = source.execution_count
+            changed = True
+    return changed
+
+
+def relative_notebook_path(filepath):
+    return os.path.relpath(os.path.abspath(filepath), path_root)
+
+
+class ExecutionCache():
+    '''
+    SQLite store of executed notebooks, keyed on `notebook_key`.
+    '''
+
+    def __init__(self, path=cache_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS runs (
+                                           key TEXT PRIMARY KEY,
+                                           notebook TEXT,
+                                           mode TEXT,
+                                           created REAL,
+                                           seconds REAL,
+                                           nb BLOB)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_notebook ON runs (notebook)')
+
+    def has(self, key):
+        return self.connection.execute('SELECT 1 FROM runs WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key):
+        '''
+        Returns the executed notebook stored under `key`, or None.
+        '''
+        row = self.connection.execute('SELECT nb FROM runs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return nbformat.reads(zlib.decompress(row[0]).decode('utf-8'), as_version=4)
+
+    def put(self, key, filepath, mode, nb, seconds):
+        data = zlib.compress(nbformat.writes(nb).encode('utf-8'))
+        with self.connection:
+            # only the latest run of each notebook in each mode is kept
+            self.connection.execute('DELETE FROM runs WHERE notebook = ? AND mode = ?',
+                                    (relative_notebook_path(filepath), mode))
+            self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                                    (key, relative_notebook_path(filepath), mode, time.time(), seconds, data))
+
+    def entries(self, filepaths=None):
+        '''
+        Returns (notebook, mode, created, seconds, size) for every entry, or only those for `filepaths`.
+        '''
+        rows = self.connection.execute('SELECT notebook, mode, created, seconds, length(nb) FROM runs ORDER BY notebook, mode').fetchall()
+        if filepaths:
+            notebooks = {relative_notebook_path(filepath) for filepath in filepaths}
+            rows = [row for row in rows if row[0] in notebooks]
+        return rows
+
+    def invalidate(self, filepaths):
+        with self.connection:
+            count = 0
+            for filepath in filepaths:
+                count += self.connection.execute('DELETE FROM runs WHERE notebook = ?',
+                                                 (relative_notebook_path(filepath),)).rowcount
+        return count
+
+    def clear(self):
+        with self.connection:
+            return self.connection.execute('DELETE FROM runs').rowcount
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ['list', 'invalidate', 'clear']:
+        sys.exit(__doc__.split('\n\n')[-1].strip())
+    command, filepaths = sys.argv[1], sys.argv[2:]
+    cache = ExecutionCache()
+
+    if command == 'list':
+        rows = cache.entries(filepaths)
+        for notebook, mode, created, seconds, size in rows:
+            created = time.strftime('%Y-%m-%d %H:%M', time.localtime(created))
+            print(f"{notebook}  {mode:<4}  {created}  ran in {seconds:.1f}s  {size/1024:.0f} KiB")
+        print(f"{len(rows)} cached runs in {cache_path}")
+    elif command == 'invalidate':
+        if not filepaths:
+            sys.exit("Usage: python3 exec_cache.py invalidate <notebook> [<notebook> ...]")
+        print(f"Removed {cache.invalidate(filepaths)} cached runs")
+    else:
+        print(f"Removed {cache.clear()} cached runs")
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it moves the images in the outputs of notebooks into
+a store of image files shared by all the notebooks (and locales), and puts them back.
+
+`externalize` writes each PNG, JPEG, GIF or SVG output to output_images/ under the hash of
+its contents, so an image that appears several times (e.g. in a notebook and its
+translation, see graft_outputs.py) is only stored once. The output is given an HTML <img>
+pointing at the stored file in its place, and the name of the file is recorded in the
+output's metadata, with how its base64 text was laid out (line length and final newline).
+With --max-width or --max-bytes, raster images wider or larger than
+that are scaled down, and PNGs are recompressed, before they are stored (this needs Pillow).
+
+`restore` embeds the stored images in the notebooks again, laid out as they were, so the
+notebooks are byte for byte what they were before (unless the images were scaled down).
+The book is built from the embedded images, so notebooks that were externalized must be
+restored before `make book` (`make restore-images` restores content/ and i18n/). `report` lists the size of each notebook, and of the images embedded in it
+and referenced from it.
+
+Usage: python3 externalize_images.py externalize <dir>... [--max-width PX] [--max-bytes N] [--jobs N]
+       python3 externalize_images.py restore <dir>... [--jobs N]
+       python3 externalize_images.py report <dir>...
+"""
+
+import base64
+import hashlib
+import importlib.util
+import io
+import os
+import sys
+import time
+from pathlib import Path
+
+import nbformat
+
+path_root = Path(__file__).parent.parent
+store_path = path_root.joinpath('output_images')
+extensions = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/svg+xml': '.svg'}
+metadata_key = 'externalized'
+layout_key = 'externalized_layout'
+
+
+def _image_bytes(mimetype, data):
+    if isinstance(data, list):
+        data = ''.join(data)
+    if mimetype == 'image/svg+xml':
+        return data.encode('utf-8')
+    return base64.b64decode(data)
+
+
+def _image_layout(data):
+    # the length of the lines base64 text is wrapped at (0 if it isn't), and whether it ends
+    # with a newline, as it does in most notebooks
+    if isinstance(data, list):
+        data = ''.join(data)
+    lines = data.rstrip('\n').split('\n')
+    return {'wrap': len(lines[0]) if len(lines) > 1 else 0, 'newline': data.endswith('\n')}
+
+
+def _image_data(mimetype, content, layout=None):
+    if mimetype == 'image/svg+xml':
+        return content.decode('utf-8')
+    data = base64.b64encode(content).decode('ascii')
+    layout = layout or {}
+    if layout.get('wrap'):
+        data = '\n'.join(data[i:i + layout['wrap']] for i in range(0, len(data), layout['wrap']))
+    return data + '\n' if layout.get('newline') else data
+
+
+def shrink_image(mimetype, content, max_width=None, max_bytes=None):
+    '''
+    Returns `content` scaled down to at most `max_width` pixels wide, and further until it
+    is no larger than `max_bytes` (or a quarter of its width), and PNGs recompressed, if
+    that makes it smaller. Returns `content` as is if it isn't a PNG or JPEG, or Pillow
+    isn't installed.
+    '''
+    if mimetype not in ['image/png', 'image/jpeg'] or not (max_width or max_bytes):
+        return content
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+    image = Image.open(io.BytesIO(content))
+    image_format = image.format
+    width, height = image.size
+    scale = min(1, max_width / width) if max_width else 1
+    while True:
+        resized = image
+        if scale < 1:
+            resized = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if image_format == 'PNG':
+            resized.save(buffer, 'PNG', optimize=True)
+        else:
+            resized.save(buffer, image_format, quality=85, optimize=True)
+        shrunk = buffer.getvalue()
+        if not max_bytes or len(shrunk) <= max_bytes or scale <= 0.25:
+            break
+        scale *= 0.75
+    return shrunk if len(shrunk) < len(content) else content
+
+
+def store_image(mimetype, content, store=store_path):
+    '''
+    Writes `content` to the store, if it isn't there already, and returns its file name.
+    '''
+    name = hashlib.sha256(content).hexdigest() + extensions[mimetype]
+    filepath = os.path.join(store, name[:2], name)
+    if not os.path.exists(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + f'.{os.getpid()}.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(filepath + f'.{os.getpid()}.tmp', filepath)
+    return name
+
+
+def _stored_path(name, store=store_path):
+    return os.path.join(store, name[:2], name)
+
+
+def _outputs(nb):
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            yield from cell.outputs
+
+
+def externalize_notebook(nb, filepath, store=store_path, max_width=None, max_bytes=None):
+    '''
+    Replaces the images in the outputs of `nb`, the notebook at `filepath`, with links to
+    the stored images. Returns the number of images moved.
+    '''
+    moved = 0
+    for output in _outputs(nb):
+        data = output.get('data', {})
+        for mimetype in [mimetype for mimetype in extensions if mimetype in data]:
+            original = data.pop(mimetype)
+            content = shrink_image(mimetype, _image_bytes(mimetype, original), max_width, max_bytes)
+            name = store_image(mimetype, content, store)
+            output.metadata.setdefault(metadata_key, {})[mimetype] = name
+            if mimetype != 'image/svg+xml':
+                output.metadata.setdefault(layout_key, {})[mimetype] = _image_layout(original)
+            src = os.path.relpath(_stored_path(name, store), os.path.dirname(os.path.abspath(filepath)))
+            size = output.metadata.get(mimetype, {})
+            attributes = ''.join(f' {key}="{size[key]}"' for key in ['width', 'height'] if key in size)
+            data.setdefault('text/html', f'<img src="{Path(src).as_posix()}"{attributes}>')
+            moved += 1
+    return moved
+
+
+def restore_notebook(nb, store=store_path):
+    '''
+    Embeds the stored images linked from the outputs of `nb` again. Returns the number of
+    images restored.
+    '''
+    restored = 0
+    for output in _outputs(nb):
+        names = output.get('metadata', {}).pop(metadata_key, {})
+        layouts = output.get('metadata', {}).pop(layout_key, {})
+        for mimetype, name in names.items():
+            # the <img> added by externalize_notebook, rather than HTML the output already had
+            if name in output.data.get('text/html', '') and output.data['text/html'].startswith('<img src='):
+                del output.data['text/html']
+            with open(_stored_path(name, store), 'rb') as f:
+                output.data[mimetype] = _image_data(mimetype, f.read(), layouts.get(mimetype))
+            restored += 1
+    return restored
+
+
+def _process(task):
+    command, filepath, options = task
+    with open(filepath) as f:
+        nb = nbformat.read(f, as_version=4)
+    if command == 'externalize':
+        count = externalize_notebook(nb, filepath, **options)
+    else:
+        count = restore_notebook(nb)
+    if count:
+        with open(filepath, 'w', encoding='utf-8') as f:
+            nbformat.write(nb, f)
+    return count
+
+
+def notebook_report(filepath, store=store_path):
+    '''
+    Returns a dict with the size of the notebook at `filepath`, the number and size of the
+    images embedded in it, and those of the stored images it links to.
+    '''
+    with open(filepath) as f:
+        nb = nbformat.read(f, as_version=4)
+    report = {'notebook': filepath, 'size': os.path.getsize(filepath),
+              'embedded': 0, 'embedded_bytes': 0, 'linked': [], 'missing': 0}
+    for output in _outputs(nb):
+        for mimetype in extensions:
+            if mimetype in output.get('data', {}):
+                report['embedded'] += 1
+                report['embedded_bytes'] += len(_image_bytes(mimetype, output.data[mimetype]))
+        for name in output.get('metadata', {}).get(metadata_key, {}).values():
+            if os.path.exists(_stored_path(name, store)):
+                report['linked'].append(name)
+            else:
+                report['missing'] += 1
+    return report
+
+
+def find_notebooks(dirs):
+    return [os.path.join(dirpath, name) for base_dir in dirs for (dirpath, _, filenames) in os.walk(base_dir)
+            for name in sorted(filenames) if name.endswith('.ipynb') and '.ipynb_checkpoints' not in dirpath]
+
+
+def print_report(filepaths, store=store_path):
+    reports = [notebook_report(filepath, store) for filepath in filepaths]
+    stored = {name: os.path.getsize(_stored_path(name, store))
+              for report in reports for name in report['linked']}
+    print(f"{'notebook':60} {'size':>10} {'embedded':>16} {'linked':>16}")
+    for report in reports:
+        linked_bytes = sum(stored[name] for name in report['linked'])
+        missing = f" ({report['missing']} missing)" if report['missing'] else ''
+        print(f"{report['notebook']:60} {report['size'] / 1024:8.0f}kB {report['embedded']:4} {report['embedded_bytes'] / 1024:8.0f}kB"
+              f" {len(report['linked']):4} {linked_bytes / 1024:8.0f}kB{missing}")
+    total_linked = sum(len(report['linked']) for report in reports)
+    print(f"{len(reports)} notebooks, {sum(report['size'] for report in reports) / 2**20:.1f} MiB, "
+          f"{sum(report['embedded'] for report in reports)} embedded images "
+          f"({sum(report['embedded_bytes'] for report in reports) / 2**20:.1f} MiB), "
+          f"{total_linked} linked images stored in {len(stored)} files ({sum(stored.values()) / 2**20:.1f} MiB)")
+
+
+if __name__ == '__main__':
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('command', choices=['externalize', 'restore', 'report'])
+    parser.add_argument('dirs', nargs='+')
+    parser.add_argument('--max-width', type=int, help="scale raster images down to at most this many pixels wide")
+    parser.add_argument('--max-bytes', type=int, help="scale raster images down until they are at most this large")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="number of notebooks to process at the same time")
+    args = parser.parse_args()
+
+    filepaths = find_notebooks(args.dirs)
+    if args.command == 'report':
+        print_report(filepaths)
+        sys.exit(os.EX_OK)
+    if args.max_width or args.max_bytes:
+        if importlib.util.find_spec('PIL') is None:
+            print("Pillow isn't installed, images will be stored as they are")
+    options = {'max_width': args.max_width, 'max_bytes': args.max_bytes} if args.command == 'externalize' else {}
+    size_before = sum(os.path.getsize(filepath) for filepath in filepaths)
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        counts = list(pool.map(_process, [(args.command, filepath, options) for filepath in filepaths]))
+    for filepath, count in zip(filepaths, counts):
+        if count:
+            print(f"{args.command.capitalize()}d {count} images in {filepath}")
+    size_after = sum(os.path.getsize(filepath) for filepath in filepaths)
+    print("Finished in %.2f seconds" % (time.time() - t0))
+    print(f"{sum(counts)} images in {sum(1 for count in counts if count)} notebooks, "
+          f"notebooks went from {size_before / 2**20:.1f} MiB to {size_after / 2**20:.1f} MiB")
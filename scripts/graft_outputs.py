@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it copies the outputs of the executed notebooks in
+<base-dir> into the translated notebooks in <target-dir>, so the translations don't need
+running again.
+
+Code cells are matched by a hash of their code without comments (see notebook_cells.py),
+so cells whose comments were translated still match. If every code cell of a translated
+notebook matches, its outputs are all copied from the English notebook. If any cell's code
+really is different, or an English code cell is missing from the translation, the cells
+after it could behave differently too, so the translated notebook is run in full instead
+(with hardware jobs replayed, see hardware_stand_in.py), unless --no-execute is given, in
+which case it is only reported.
+
+Notebooks are only written if their outputs changed, and notebooks whose English and
+translated files haven't changed since their outputs were last copied are skipped (see
+translation_index.py).
+
+With --output-dir, the translated notebooks are left as they are: <target-dir> is copied to
+<output-dir> (only the files that changed since the last copy), and the outputs are copied
+into the notebooks there, skipping the copies that haven't changed since then. This is how
+the translated books are built, so building them doesn't change the translations.
+
+Usage: python3 graft_outputs.py <base-dir> <target-dir> [--no-execute] [--no-cache] [--output-dir DIR]
+"""
+
+import os
+import shutil
+import sys
+import time
+
+import nbformat
+
+from notebook_cells import code_cells, source_hash, align
+from notebook_execution import timestamp
+from translation_index import TranslationIndex, repo_path
+
+exclude = ['ch-labs']  # filepaths containing these strings will be skipped
+
+
+def graft_notebook(base_nb, target_nb):
+    '''
+    Copies the outputs of the code cells in `base_nb` into the matching code cells of
+    `target_nb`, if they all match. Returns the positions of the cells that didn't match
+    (among the code cells of `target_nb`, and of `base_nb` for English cells missing from
+    the translation), and whether anything in `target_nb` changed.
+    '''
+    base_cells, target_cells = code_cells(base_nb), code_cells(target_nb)
+    pairs = align([source_hash(cell.source) for cell in base_cells],
+                  [source_hash(cell.source) for cell in target_cells])
+    matched = {target_idx for _, target_idx in pairs}
+    diverged = [idx for idx in range(len(target_cells)) if idx not in matched]
+    base_matched = {base_idx for base_idx, _ in pairs}
+    missing = [idx for idx in range(len(base_cells)) if idx not in base_matched]
+    if diverged or missing:
+        return (diverged, missing), False
+    changed = False
+    for base_idx, target_idx in pairs:
+        source, target = base_cells[base_idx], target_cells[target_idx]
+        if target.outputs != source.outputs or target.execution_count != source.execution_count:
+            target.outputs = source.outputs
+            target.execution_count = source.execution_count
+            changed = True
+    return ([], []), changed
+
+
+def graft_file(base_filepath, target_filepath):
+    '''
+    Returns 'grafted' (outputs changed), 'unchanged' or 'diverged', and the positions of
+    the translated and English code cells that didn't match.
+    '''
+    with open(base_filepath) as f:
+        base_nb = nbformat.read(f, as_version=4)
+    with open(target_filepath) as f:
+        target_nb = nbformat.read(f, as_version=4)
+    (diverged, missing), changed = graft_notebook(base_nb, target_nb)
+    if diverged or missing:
+        return 'diverged', (diverged, missing)
+    if changed:
+        with open(target_filepath, 'w', encoding='utf-8') as f:
+            nbformat.write(target_nb, f)
+        return 'grafted', ([], [])
+    return 'unchanged', ([], [])
+
+
+def copy_tree(source_dir, output_dir):
+    '''
+    Makes `output_dir` a copy of `source_dir`, copying only the files changed since they
+    were last copied (so a notebook whose outputs were copied in there is left alone
+    unless its translation changed), and removing the files no longer in `source_dir`.
+    '''
+    copied = set()
+    for (dirpath, _, filenames) in os.walk(source_dir):
+        for name in filenames:
+            source = os.path.join(dirpath, name)
+            output = os.path.join(output_dir, os.path.relpath(source, source_dir))
+            copied.add(os.path.abspath(output))
+            if not os.path.exists(output) or os.path.getmtime(source) > os.path.getmtime(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                shutil.copy2(source, output)
+    for (dirpath, _, filenames) in os.walk(output_dir):
+        for name in filenames:
+            if os.path.abspath(os.path.join(dirpath, name)) not in copied:
+                os.remove(os.path.join(dirpath, name))
+
+
+if __name__ == '__main__':
+    import argparse
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('base_dir')
+    parser.add_argument('target_dir')
+    parser.add_argument('--no-execute', action='store_true', help="only report translated notebooks whose code differs")
+    parser.add_argument('--no-cache', action='store_true', help="don't use the execution caches when running notebooks")
+    parser.add_argument('--output-dir', help="copy the translated notebooks here, and the outputs into the copies")
+    args = parser.parse_args()
+
+    if args.output_dir:
+        copy_tree(args.target_dir, args.output_dir)
+    statuses = {}
+    to_run = []
+    index = TranslationIndex()
+    for (dirpath, _, filenames) in os.walk(args.base_dir):
+        for name in filenames:
+            if not name.endswith(".ipynb"):
+                continue
+            base_filepath = os.path.join(dirpath, name)
+            target_filepath = os.path.join(args.output_dir or args.target_dir, os.path.relpath(base_filepath, args.base_dir))
+            if any(e in target_filepath for e in exclude) or not os.path.exists(target_filepath):
+                continue
+            # with --output-dir, the index tracks the copies, which copy_tree only replaces
+            # when their translation changed
+            if not index.stage_needed(repo_path(target_filepath), 'graft', repo_path(base_filepath)):
+                statuses['unchanged'] = statuses.get('unchanged', 0) + 1
+                continue
+            status, (diverged, missing) = graft_file(base_filepath, target_filepath)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status != 'diverged':
+                index.stage_done(repo_path(target_filepath), 'graft', repo_path(base_filepath))
+            if status == 'diverged':
+                cells = ["code cells " + ', '.join(map(str, diverged))] if diverged else []
+                cells += ["English code cells %s are missing" % ', '.join(map(str, missing))] if missing else []
+                print(timestamp() + "Code differs in '%s', %s" % (target_filepath, '; '.join(cells)))
+                to_run.append(target_filepath)
+
+    ran, failed = 0, 0
+    if to_run and not args.no_execute:
+        from run_notebooks import run_notebook
+        from exec_cache import environment_hash
+        env_hash = None if args.no_cache else environment_hash()
+        for filepath in to_run:
+            print(timestamp() + filepath)
+            # the outputs of these translations are out of date, so the replayed ones are saved
+            if run_notebook(filepath, env_hash, hardware='replay', save=True) == 1:
+                ran += 1
+            else:
+                failed += 1
+
+    print("Finished in %.2f seconds" % (time.time() - t0))
+    print("%i notebooks had their outputs copied, %i were already up to date and %i have different code (%i were run, %i failed)."
+          % (statuses.get('grafted', 0), statuses.get('unchanged', 0), statuses.get('diverged', 0), ran, failed))
+    if failed:
+        sys.exit(os.EX_SOFTWARE)
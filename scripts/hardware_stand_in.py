@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it lets run_notebooks.py and run_notebooks_soft.py
+run the `uses-hardware` cells of a notebook without sending jobs to IBMQ.
+
+The runners add a setup cell (see notebook_execution.add_setup_cell) to the start of the
+notebook that calls `install` in the kernel:
+  - In 'record' mode, jobs are sent to IBMQ as usual, and the result of every job is saved
+    to hardware_recordings/, keyed on a hash of its circuits and the name of its backend.
+  - In 'replay' mode, IBMQ is replaced by a stand-in provider whose backends are qiskit's
+    fake backends. A job is answered with its recorded result if there is one; otherwise
+    (or if the circuits changed) it is simulated on the noisy fake backend instead.
+The setup cell is removed again before the notebook is saved.
+
+Usage: python3 hardware_stand_in.py list
+"""
+
+import copy
+import hashlib
+import json
+import os
+import sys
+import time
+import types
+import warnings
+from pathlib import Path
+
+path_root = Path(__file__).parent.parent
+recordings_path = path_root.joinpath('hardware_recordings')
+
+# state of the stand-in in this kernel, set by `install`
+_session = None
+
+
+def setup_code(mode, notebook, path=recordings_path):
+    '''
+    Lines for notebook_execution.add_setup_cell that install the stand-in in `mode`
+    ('record' or 'replay'). `notebook` is the path of the notebook, relative to the repository.
+    '''
+    return ['import hardware_stand_in',
+            f'hardware_stand_in.install({mode!r}, notebook={notebook!r}, path={str(path)!r})']
+
+
+def backend_name(backend):
+    name = backend.name
+    return name() if callable(name) else name
+
+
+def _serialize(circuit):
+    if hasattr(circuit, 'to_dict'):
+        # an assembled Qobj; leave out the parts that are different every time
+        data = copy.deepcopy(circuit.to_dict())
+        data.pop('qobj_id', None)
+        for experiment in data.get('experiments', []):
+            experiment.get('header', {}).pop('name', None)
+        return json.dumps(data, sort_keys=True, default=str)
+    try:
+        return circuit.qasm()
+    except Exception:
+        pass
+    try:
+        from qiskit import qasm2
+        return qasm2.dumps(circuit)
+    except Exception:
+        return str(circuit)
+
+
+def job_hash(circuits, shots=None):
+    '''
+    Hash of the circuits (or Qobj) of a job and the number of shots asked for.
+    '''
+    if not isinstance(circuits, (list, tuple)):
+        circuits = [circuits]
+    digest = hashlib.sha256(repr(shots).encode())
+    for circuit in circuits:
+        digest.update(hashlib.sha256(_serialize(circuit).encode()).digest())
+    return digest.hexdigest()
+
+
+class Recordings():
+    '''
+    The recorded jobs in `path`, one JSON file each.
+    '''
+
+    def __init__(self, path=recordings_path):
+        self.path = Path(path)
+        self.jobs = []
+        if self.path.is_dir():
+            for filepath in sorted(self.path.glob('*.json')):
+                with open(filepath) as f:
+                    self.jobs.append(json.load(f))
+
+    def find(self, key, backend, notebook=None, sequence=None):
+        '''
+        Returns the recorded job with hash `key` on `backend`. If the circuits have changed
+        since (e.g. because transpiling isn't deterministic), the `sequence`-th job that
+        `notebook` ran on `backend` is used instead. Returns None if neither was recorded.
+        '''
+        for job in self.jobs:
+            if job['hash'] == key and job['backend'] == backend:
+                return job
+        if notebook is not None:
+            for job in self.jobs:
+                if job['notebook'] == notebook and job['backend'] == backend and job['sequence'] == sequence:
+                    return job
+        return None
+
+    def job(self, job_id):
+        for job in self.jobs:
+            if job['job_id'] == job_id:
+                return job
+        return None
+
+    def backend_names(self, notebook=None):
+        '''
+        Names of the backends jobs were recorded on, most used (by `notebook`, if given) first.
+        '''
+        counts = {}
+        for job in self.jobs:
+            if notebook is None or job['notebook'] == notebook:
+                counts[job['backend']] = counts.get(job['backend'], 0) + 1
+        return sorted(counts, key=lambda name: (-counts[name], name))
+
+    def add(self, job):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.path.joinpath(f"{job['hash'][:16]}-{job['backend']}.json"), 'w') as f:
+            json.dump(job, f, indent=1, default=str)
+        self.jobs = [other for other in self.jobs
+                     if (other['hash'], other['backend']) != (job['hash'], job['backend'])]
+        self.jobs.append(job)
+
+
+class Session():
+    def __init__(self, recordings, mode, notebook):
+        self.recordings = recordings
+        self.mode = mode
+        self.notebook = notebook
+        self._sequence = {}
+
+    def next_sequence(self, backend):
+        '''
+        Number of jobs run on `backend` so far in this kernel.
+        '''
+        sequence = self._sequence.get(backend, 0)
+        self._sequence[backend] = sequence + 1
+        return sequence
+
+
+class ReplayJob():
+    '''
+    A finished job whose result was recorded earlier.
+    '''
+
+    def __init__(self, backend, job_id, result):
+        self._backend = backend
+        self._job_id = job_id
+        self._result = result
+
+    def job_id(self):
+        return self._job_id
+
+    def backend(self):
+        return self._backend
+
+    def result(self, *args, **kwargs):
+        return self._result
+
+    def status(self):
+        from qiskit.providers import JobStatus
+        return JobStatus.DONE
+
+    def done(self):
+        return True
+
+    def queue_position(self, *args, **kwargs):
+        return None
+
+    def wait_for_final_state(self, *args, **kwargs):
+        pass
+
+
+def _replayed_result(job, circuits):
+    from qiskit.result import Result
+    data = copy.deepcopy(job['result'])
+    # the circuits are named differently on every run, and get_counts(circuit) looks them up by name
+    if not isinstance(circuits, (list, tuple)):
+        circuits = [circuits]
+    names = [getattr(circuit, 'name', None) for circuit in circuits]
+    if len(names) == len(data['results']):
+        for name, experiment in zip(names, data['results']):
+            if name is not None:
+                experiment.setdefault('header', {})['name'] = name
+    return Result.from_dict(data)
+
+
+def _stand_in_run(backend, circuits, **kwargs):
+    name = backend_name(backend)
+    sequence = _session.next_sequence(name)
+    job = _session.recordings.find(job_hash(circuits, kwargs.get('shots')), name, _session.notebook, sequence)
+    if job is None:
+        warnings.warn(f"No recorded result for this job on {name}, so it is simulated on a noisy fake backend", stacklevel=2)
+        return type(backend).run(backend, circuits, **kwargs)
+    return ReplayJob(backend, job['job_id'], _replayed_result(job, circuits))
+
+
+def _stand_in_retrieve_job(backend, job_id):
+    from qiskit.exceptions import QiskitError
+    job = _session.recordings.job(job_id)
+    if job is None:
+        raise QiskitError(f"Job {job_id} was not recorded")
+    return ReplayJob(backend, job_id, _replayed_result(job, []))
+
+
+def fake_backends():
+    try:
+        from qiskit.providers.fake_provider import FakeProvider
+    except ImportError:
+        from qiskit.test.mock import FakeProvider
+    return FakeProvider().backends()
+
+
+def _stand_in(fake, name=None):
+    '''
+    Copy of the fake backend `fake`, named `name`, that replays recorded jobs.
+    '''
+    backend = copy.copy(fake)
+    if name is not None:
+        backend._configuration = copy.copy(fake.configuration())
+        backend._configuration.backend_name = name
+    backend.run = types.MethodType(_stand_in_run, backend)
+    backend.retrieve_job = types.MethodType(_stand_in_retrieve_job, backend)
+    return backend
+
+
+def _matching_fake(name, fakes):
+    '''
+    The fake backend modelled on the device `name` (e.g. fake_vigo for ibmq_vigo),
+    or the largest fake backend if there is none.
+    '''
+    device = name.split('_')[-1]
+    for fake in fakes:
+        if backend_name(fake).split('_')[-1] == device:
+            return fake
+    return max(fakes, key=lambda fake: fake.configuration().n_qubits)
+
+
+def _matches(backend, key, value):
+    for source in (backend.configuration(), backend.status()):
+        if hasattr(source, key):
+            return getattr(source, key) == value
+    return False
+
+
+class StandInProvider():
+    '''
+    Stands in for an IBMQ provider. It has a backend for each of qiskit's fake backends,
+    and one for each device that jobs were recorded on.
+    '''
+
+    def __init__(self, recordings):
+        fakes = fake_backends()
+        self._backends = [_stand_in(fake) for fake in fakes]
+        names = {backend_name(backend) for backend in self._backends}
+        for name in recordings.backend_names():
+            if name not in names:
+                self._backends.append(_stand_in(_matching_fake(name, fakes), name))
+
+    def backends(self, name=None, filters=None, **kwargs):
+        backends = [backend for backend in self._backends if name is None or backend_name(backend) == name]
+        backends = [backend for backend in backends if all(_matches(backend, key, value) for key, value in kwargs.items())]
+        if filters is not None:
+            backends = [backend for backend in backends if filters(backend)]
+        return backends
+
+    def get_backend(self, name=None, **kwargs):
+        from qiskit.providers.exceptions import QiskitBackendNotFoundError
+        backends = self.backends(name, **kwargs)
+        if not backends:
+            raise QiskitBackendNotFoundError(f"No backend matches the criteria: {name}")
+        return backends[0]
+
+
+class StandInIBMQ():
+    '''
+    Stands in for qiskit.IBMQ, handing out a StandInProvider instead of logging in.
+    '''
+
+    def __init__(self, provider):
+        self._provider = provider
+
+    def load_account(self):
+        return self._provider
+
+    def enable_account(self, *args, **kwargs):
+        return self._provider
+
+    def save_account(self, *args, **kwargs):
+        pass
+
+    def disable_account(self):
+        pass
+
+    def active_account(self):
+        return None
+
+    def providers(self, hub=None, group=None, project=None):
+        return [self._provider]
+
+    def get_provider(self, hub=None, group=None, project=None):
+        return self._provider
+
+
+def least_busy(backends, reservation_lookahead=None):
+    '''
+    Stands in for qiskit.providers.ibmq.least_busy. Picks the backend the notebook's jobs
+    were recorded on if there is one, so they can be replayed, and the smallest otherwise.
+    '''
+    from qiskit.exceptions import QiskitError
+    if not backends:
+        raise QiskitError('Unable to find the least busy backend from an empty list.')
+    recorded = _session.recordings.backend_names(_session.notebook)
+
+    def rank(backend):
+        name = backend_name(backend)
+        return (recorded.index(name) if name in recorded else len(recorded),
+                backend.configuration().n_qubits, name)
+    return min(backends, key=rank)
+
+
+def job_monitor(job, interval=None, quiet=False, output=None, line_discipline='\r'):
+    '''
+    Stands in for qiskit.tools.monitor.job_monitor, which polls IBMQ.
+    '''
+    job.result()
+    if not quiet:
+        print(line_discipline + 'Job Status: job has successfully run', file=output or sys.stdout)
+
+
+def _recording_run(original_run):
+    def run(backend, circuits, **kwargs):
+        job = original_run(backend, circuits, **kwargs)
+        name = backend_name(backend)
+        recording = {'notebook': _session.notebook, 'backend': name,
+                     'hash': job_hash(circuits, kwargs.get('shots')),
+                     'sequence': _session.next_sequence(name), 'job_id': job.job_id()}
+        result = job.result
+
+        def recorded_result(*args, **kw):
+            value = result(*args, **kw)
+            if 'result' not in recording:
+                recording.update(recorded=time.time(), result=value.to_dict())
+                _session.recordings.add(recording)
+            return value
+        job.result = recorded_result
+        return job
+    return run
+
+
+def install(mode='replay', notebook=None, path=recordings_path):
+    '''
+    Sets up this kernel to record ('record') or replay ('replay') hardware jobs.
+    `notebook` is the path of the notebook being run, relative to the repository.
+    '''
+    global _session
+    _session = Session(Recordings(path), mode, notebook)
+    import qiskit
+
+    if mode == 'record':
+        from qiskit.providers.ibmq import IBMQBackend
+        IBMQBackend.run = _recording_run(IBMQBackend.run)
+        return _session
+
+    ibmq = StandInIBMQ(StandInProvider(_session.recordings))
+    qiskit.IBMQ = ibmq
+    try:
+        import qiskit.providers.ibmq as ibmq_module
+    except ImportError:
+        # qiskit-ibmq-provider isn't needed to replay jobs
+        ibmq_module = types.ModuleType('qiskit.providers.ibmq')
+        sys.modules['qiskit.providers.ibmq'] = ibmq_module
+    ibmq_module.IBMQ = ibmq
+    ibmq_module.least_busy = least_busy
+    try:
+        import qiskit.tools.monitor
+        qiskit.tools.monitor.job_monitor = job_monitor
+    except ImportError:
+        pass
+    return _session
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['list']:
+        sys.exit(__doc__.split('Usage: ')[-1].strip())
+    recordings = Recordings()
+    for job in sorted(recordings.jobs, key=lambda job: (job['notebook'] or '', job['sequence'])):
+        recorded = time.strftime('%Y-%m-%d %H:%M', time.localtime(job['recorded']))
+        print(f"{job['notebook']}  job {job['sequence']} on {job['backend']}  {recorded}  {job['job_id']}")
+    print(f"{len(recordings.jobs)} recorded jobs in {recordings.path}")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it keeps a pool of kernels for run_notebooks.py and
+run_notebooks_soft.py that are started, and have imported the modules most notebooks use,
+before they are needed. A notebook is then handed a warm kernel instead of waiting for
+one to start and import qiskit.
+
+Kernels are never reused between notebooks: as soon as a kernel is handed out, a fresh
+one starts warming up in the background, so it's ready by the time the notebook is done,
+and the used kernel is shut down on its own once it's handed back. (Forking a warm kernel
+isn't safe, as it holds open ZMQ sockets and threads, so warming kernels ahead of time is
+the closest we can get to a fork server.)
+"""
+
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jupyter_client import KernelManager
+
+# imported in a throwaway namespace, so notebooks still start with an empty one
+preload_modules = ['numpy', 'matplotlib.pyplot', 'qiskit', 'qiskit.visualization',
+                   'qiskit_textbook.tools', 'qiskit_textbook.widgets']
+
+preload_code = '''
+def _preload(modules):
+    import importlib
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+_preload({!r})
+del _preload
+'''
+
+
+class KernelPool():
+    '''
+    Keeps `size` warm kernels ready, starting a replacement in a background thread as each
+    one is handed out.
+    '''
+
+    def __init__(self, size=1, kernel_name='python3', modules=preload_modules, cwd=None):
+        self.kernel_name = kernel_name
+        self.modules = modules
+        self.cwd = cwd or os.getcwd()
+        self._ready = queue.Queue()
+        self._warmers = ThreadPoolExecutor(max_workers=size)
+        self._stoppers = ThreadPoolExecutor(max_workers=1)
+        # for the last kernel handed out: the start-up and import time done ahead of time,
+        # and the time still spent waiting for it
+        self.last_warmup = 0
+        self.last_wait = 0
+        # and the same, summed over every kernel handed out
+        self.acquired = 0
+        self.warmup_seconds = 0
+        self.wait_seconds = 0
+        for _ in range(size):
+            self._warmers.submit(self._warm)
+
+    def _warm(self):
+        t0 = time.time()
+        try:
+            km = KernelManager(kernel_name=self.kernel_name)
+            km.start_kernel(cwd=self.cwd)
+            kc = km.client()
+            kc.start_channels()
+            try:
+                kc.wait_for_ready(timeout=120)
+                kc.execute_interactive(preload_code.format(self.modules), store_history=False, timeout=300)
+            finally:
+                kc.stop_channels()
+        except Exception as e:
+            self._ready.put((None, e))
+            return
+        self._ready.put((km, time.time() - t0))
+
+    def acquire(self):
+        '''
+        Returns the KernelManager of a warm kernel, waiting for one if none are ready.
+        '''
+        t0 = time.time()
+        km, warmup = self._ready.get()
+        # start the replacement now, so it warms up while this kernel is used (and so the
+        # pool doesn't shrink if warming up failed)
+        self._warmers.submit(self._warm)
+        if km is None:
+            raise RuntimeError(f"Could not start a warm kernel: {warmup}")
+        self.last_wait = time.time() - t0
+        self.last_warmup = warmup
+        self.acquired += 1
+        self.warmup_seconds += warmup
+        self.wait_seconds += self.last_wait
+        return km
+
+    def release(self, km):
+        '''
+        Hands a used kernel back, to be shut down in the background. (A fresh manager is
+        warmed up instead of restarting it, which can hang once the executor has finished
+        with it.)
+        '''
+        self._stoppers.submit(km.shutdown_kernel, now=True)
+
+    def shutdown(self):
+        self._warmers.shutdown(wait=True)
+        self._stoppers.shutdown(wait=True)
+        while not self._ready.empty():
+            km, _ = self._ready.get()
+            if km is not None:
+                km.shutdown_kernel(now=True)
+
+
+def print_pool_stats(kernels, warmup_seconds, wait_seconds):
+    print("%i warm kernels were used, saving %.1f seconds of kernel start-up and imports (%.1f seconds were spent waiting for them)"
+          % (kernels, max(0, warmup_seconds - wait_seconds), wait_seconds))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it holds the helpers for matching up code cells
+between notebooks, e.g. an English notebook and its translation, whose code is the same
+apart from the comments.
+"""
+
+import difflib
+import hashlib
+import io
+import tokenize
+
+
+def _strip_comments(source):
+    lines = source.split('\n')
+    try:
+        comments = [token.start for token in tokenize.generate_tokens(io.StringIO(source).readline)
+                    if token.type == tokenize.COMMENT]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        # not valid Python (e.g. an exercise with blanks); only whole-line comments are removed
+        return [line for line in lines if not line.strip().startswith('#')]
+    for row, col in reversed(comments):
+        lines[row - 1] = lines[row - 1][:col]
+    return lines
+
+
+def normalize_source(source):
+    '''
+    The code in `source` without comments, trailing whitespace or blank lines, so code
+    cells that only differ in those (as translations do) normalize to the same string.
+    '''
+    return '\n'.join(line.rstrip() for line in _strip_comments(source) if line.strip())
+
+
+def source_hash(source):
+    return hashlib.sha256(normalize_source(source).encode('utf-8')).hexdigest()
+
+
+def code_cells(nb):
+    return [cell for cell in nb.cells if cell.cell_type == 'code']
+
+
+def align(base_hashes, target_hashes):
+    '''
+    Matches up two lists of cell hashes, returning (base index, target index) pairs
+    for the longest runs of cells that are the same in both, in order.
+    '''
+    matcher = difflib.SequenceMatcher(None, base_hashes, target_hashes, autojunk=False)
+    return [(block.a + offset, block.b + offset)
+            for block in matcher.get_matching_blocks() for offset in range(block.size)]
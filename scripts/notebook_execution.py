@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it holds the notebook execution code shared by
+run_notebooks.py and run_notebooks_soft.py.
+"""
+
+import csv
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import nbformat
+from nbconvert.preprocessors import ExecutePreprocessor
+
+setup_tag = 'build-setup'
+
+# runs lines of code in the kernel with the scripts folder on sys.path, without
+# leaving any names behind in the notebook's namespace
+setup_template = '''\
+def _build_setup():
+    import sys
+    sys.path.insert(0, {scripts_dir!r})
+    try:
+{code}
+    finally:
+        sys.path.remove({scripts_dir!r})
+_build_setup()
+del _build_setup'''
+
+
+class NotebookTimeoutError(TimeoutError):
+    pass
+
+
+def kernel_pid(km):
+    '''
+    Process id of the kernel started by the KernelManager `km`, or None if it can't be found.
+    '''
+    kernel = getattr(km, 'kernel', None)  # jupyter_client < 7
+    if kernel is None:
+        kernel = getattr(getattr(km, 'provisioner', None), 'process', None)
+    return getattr(kernel, 'pid', None)
+
+
+def rss(pid):
+    '''
+    Resident set size of process `pid` in bytes, or None if it can't be measured.
+    Uses psutil if it is installed, and /proc otherwise.
+    '''
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakMemorySampler():
+    '''
+    Polls the memory use of a process in a background thread, keeping the largest value seen.
+    '''
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            value = rss(self.pid)
+            if value is not None and (self.peak is None or value > self.peak):
+                self.peak = value
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if self.pid is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.pid is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+class TextbookExecutePreprocessor(ExecutePreprocessor):
+    '''
+    ExecutePreprocessor that also gives up once the cells of the notebook have been running
+    for more than `notebook_timeout` seconds in total (kernel start-up is not counted).
+
+    The wall time and peak kernel memory of each code cell are recorded in `cell_timings`.
+    '''
+
+    def __init__(self, notebook_timeout=None, **kw):
+        super().__init__(**kw)
+        self.notebook_timeout = notebook_timeout
+        self.deadline = None
+        self.cell_timings = []
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.deadline = None
+        self.cell_timings = []
+        return super().preprocess(nb, resources, km=km)
+
+    def preprocess_cell(self, cell, resources, cell_index):
+        if self.notebook_timeout and cell.cell_type == 'code':
+            if self.deadline is None:
+                self.deadline = time.time() + self.notebook_timeout
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise NotebookTimeoutError(f"Notebook took longer than {self.notebook_timeout} seconds\n")
+            self.timeout = math.ceil(remaining)
+        if cell.cell_type != 'code':
+            return super().preprocess_cell(cell, resources, cell_index)
+
+        t0 = time.time()
+        with PeakMemorySampler(kernel_pid(self.km)) as sampler:
+            try:
+                return super().preprocess_cell(cell, resources, cell_index)
+            finally:
+                peak = sampler.peak
+                self.cell_timings.append({'cell': cell_index,
+                                          'tags': list(cell.metadata.get('tags', [])),
+                                          'seconds': time.time() - t0,
+                                          'peak_rss_mb': None if peak is None else peak / 2**20})
+
+
+def add_setup_cell(nb, code, position=0):
+    '''
+    Inserts a cell that runs `code`, a list of lines, at `position` in `nb` (by default its
+    start). Used to load the scripts in this folder that change how notebooks behave in the
+    kernel during the build.
+    '''
+    cell = nbformat.v4.new_code_cell(setup_template.format(
+        scripts_dir=str(Path(__file__).parent.resolve()),
+        code='\n'.join(' ' * 8 + line for line in code)))
+    cell.metadata['tags'] = [setup_tag]
+    nb.cells.insert(position, cell)
+
+
+def remove_setup_cell(nb):
+    '''
+    Removes the cell added by `add_setup_cell`, and renumbers the execution counts of the
+    other cells so the notebook looks as if it had been run without it.
+    '''
+    cells = [cell for cell in nb.cells if setup_tag not in cell.metadata.get('tags', [])]
+    if len(cells) == len(nb.cells):
+        return
+    nb.cells = cells
+    for cell in nb.cells:
+        if cell.cell_type != 'code' or not cell.get('execution_count'):
+            continue
+        cell.execution_count -= 1
+        for output in cell.outputs:
+            if output.get('execution_count'):
+                output.execution_count -= 1
+
+
+def timestamp():
+    return "[" + datetime.now().time().strftime('%H:%M') + "] "
+
+
+def error_summary(e):
+    '''
+    Returns the last line of the error message, which for a CellExecutionError
+    is the exception raised in the notebook. Timeouts are described by their first line.
+    '''
+    if isinstance(e, TimeoutError):
+        return str(e).split('\n')[0]
+    lines = [line for line in str(e).split('\n') if line.strip()]
+    return lines[-1] if lines else type(e).__name__
+
+
+def print_summary(results):
+    '''
+    Prints a table with one row per notebook, from a list of result dicts with
+    'notebook', 'error', 'seconds' and 'cached' keys.
+    '''
+    width = max([len('Notebook')] + [len(result['notebook']) for result in results])
+    print(f"{'Notebook':<{width}}  {'Status':<7}  {'Seconds':>8}")
+    print(f"{'-'*width}  {'-'*7}  {'-'*8}")
+    for result in sorted(results, key=lambda result: result['notebook']):
+        if result['error'] is not None:
+            status = 'FAILED'
+        elif result.get('cached'):
+            status = 'CACHED'
+        else:
+            status = 'OK'
+        print(f"{result['notebook']:<{width}}  {status:<7}  {result['seconds']:>8.1f}")
+
+
+def write_cell_report(rows, filepath):
+    '''
+    Writes the cell timings in `rows` (dicts with 'notebook', 'cell', 'tags', 'seconds' and
+    'peak_rss_mb' keys) to `filepath`, as CSV if it ends in '.csv' and as JSON otherwise.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    if filepath.endswith('.csv'):
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['notebook', 'cell', 'tags', 'seconds', 'peak_rss_mb'])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(dict(row, tags=' '.join(row['tags'])))
+    else:
+        with open(filepath, 'w') as f:
+            json.dump(rows, f, indent=1)
+
+
+def print_slowest_cells(rows, n=10):
+    if not rows or n <= 0:
+        return
+    print(f"The {min(n, len(rows))} slowest cells were:")
+    for row in sorted(rows, key=lambda row: row['seconds'], reverse=True)[:n]:
+        memory = '' if row['peak_rss_mb'] is None else f"  {row['peak_rss_mb']:.0f} MiB"
+        tags = f"  [{', '.join(row['tags'])}]" if row['tags'] else ''
+        print(f"{row['seconds']:>8.1f}s{memory}  {row['notebook']} cell {row['cell']}{tags}")
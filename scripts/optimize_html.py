@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it makes the built pages lighter to download.
+
+`images`, run on <build-dir> after postprocess_html.py, changes the <img> tags of the pages
+jupyter-book wrote:
+- images embedded as data URIs larger than `inline_limit` bytes are moved to files in
+  images/inline/, so the page doesn't have to be downloaded with them
+- images get loading="lazy" and decoding="async", so they're only fetched when scrolled to
+- PNG and JPEG images are wrapped in a <picture> offering WebP versions, at their own width
+  and scaled down to each of `widths` narrower than that, in a srcset, so browsers pick
+  the smallest that fits (this needs Pillow; browsers without WebP get the original)
+Tags that already have a `loading` attribute were done by an earlier run and are skipped,
+as are existing WebP files, so the stage is quick when only a few pages changed.
+
+`compress`, run on <site-dir> after `jekyll build`, writes a .gz (and, if the brotli
+package is installed, a .br) file next to every HTML, CSS, JS, JSON (e.g. the search
+indexes) and SVG file for the web server to send as is. As Jekyll rewrites the whole site,
+compressed files are cached under the hash of their contents in
+_build/.exec_cache/compressed/, so only files that changed are compressed again.
+
+Both stages process files in parallel and print the bytes saved on each page.
+
+Usage: python3 optimize_html.py images <build-dir> [--jobs N]
+       python3 optimize_html.py compress <site-dir> [--jobs N]
+"""
+
+import base64
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+
+path_root = Path(__file__).parent.parent
+compressed_cache_path = path_root.joinpath('_build', '.exec_cache', 'compressed')
+inline_limit = 4096
+widths = [480, 960]
+compressed_suffixes = ['.html', '.css', '.js', '.json', '.svg']
+min_compress_size = 1024
+
+img_tag = re.compile(rb'<img\b[^>]*>', re.IGNORECASE)
+attribute = re.compile(rb'\s([\w-]+)\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)')
+data_uri = re.compile(rb'data:image/(png|jpeg|gif);base64,([A-Za-z0-9+/=\s]+)')
+
+
+def _attributes(tag):
+    return {name.lower(): value.strip(b'"\'') for name, value in attribute.findall(tag)}
+
+
+def _set_src(tag, src):
+    return re.sub(rb'(\ssrc\s*=\s*)("[^"]*"|\'[^\']*\'|[^\s>]+)', lambda match: match.group(1) + b'"' + src + b'"', tag, count=1)
+
+
+def extract_inline_image(tag, page_path, build_dir):
+    '''
+    Writes the image of a data URI `src` to images/inline/ in `build_dir`, if it is larger
+    than `inline_limit`, and returns the tag linking to it and the bytes taken off the page.
+    '''
+    src = _attributes(tag).get(b'src', b'')
+    match = data_uri.fullmatch(src)
+    if match is None or len(src) <= inline_limit:
+        return tag, 0
+    content = base64.b64decode(match.group(2))
+    extension = {b'jpeg': '.jpg'}.get(match.group(1), '.' + match.group(1).decode())
+    filepath = os.path.join(build_dir, 'images', 'inline', hashlib.sha256(content).hexdigest()[:32] + extension)
+    if not os.path.exists(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(content)
+    link = Path(os.path.relpath(filepath, os.path.dirname(page_path))).as_posix().encode()
+    new_tag = _set_src(tag, link)
+    return new_tag, len(tag) - len(new_tag)
+
+
+def webp_variants(image_path):
+    '''
+    Writes the WebP versions of the image at `image_path` (at its width and each of `widths`
+    narrower than that), unless they're already there. Returns a list of (path, width) of
+    those smaller than the image, and its width, or None if Pillow can't convert it.
+    '''
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        image = Image.open(image_path)
+        image.load()
+    except (OSError, ValueError):
+        return None
+    width, height = image.size
+    lossless = image.format == 'PNG'
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+    variants = []
+    for variant_width in [w for w in widths if w < width] + [width]:
+        variant_path = f'{os.path.splitext(image_path)[0]}-{variant_width}w.webp'
+        if not os.path.exists(variant_path) or os.path.getmtime(variant_path) < os.path.getmtime(image_path):
+            variant = image if variant_width == width else \
+                image.resize((variant_width, max(1, round(height * variant_width / width))), Image.LANCZOS)
+            variant.save(variant_path, 'WEBP', lossless=lossless, quality=80, method=4)
+        if os.path.getsize(variant_path) < os.path.getsize(image_path):
+            variants.append((variant_path, variant_width))
+    return variants, width
+
+
+def optimize_tag(tag, page_path, build_dir):
+    '''
+    Returns the optimized `tag` of the page at `page_path`, and the bytes saved, counting
+    the bytes taken off the page and those a browser downloading the largest WebP version
+    of the image saves.
+    '''
+    tag, saved = extract_inline_image(tag, page_path, build_dir)
+    attributes = _attributes(tag)
+    tag = tag[:-1].rstrip(b'/ ') + b' loading="lazy" decoding="async">'
+    src = attributes.get(b'src', b'').decode()
+    if not src or '://' in src or src.startswith(('data:', '/', '{')) \
+            or os.path.splitext(src)[1].lower() not in ['.png', '.jpg', '.jpeg']:
+        return tag, saved
+    image_path = os.path.normpath(os.path.join(os.path.dirname(page_path), src))
+    if not os.path.exists(image_path):
+        return tag, saved
+    converted = webp_variants(image_path)
+    if not converted or not converted[0]:
+        return tag, saved
+    variants, width = converted
+    display_width = attributes.get(b'width', b'').decode()
+    display_width = display_width if display_width.isdigit() else str(width)
+    srcset = ', '.join(f'{Path(os.path.relpath(path, os.path.dirname(page_path))).as_posix()} {variant_width}w'
+                       for path, variant_width in variants)
+    sizes = f'(max-width: {display_width}px) 100vw, {display_width}px'
+    saved += os.path.getsize(image_path) - os.path.getsize(variants[-1][0])
+    return (f'<picture><source type="image/webp" srcset="{srcset}" sizes="{sizes}">'.encode()
+            + tag + b'</picture>'), saved
+
+
+def optimize_page(page_path, build_dir):
+    '''
+    Optimizes the <img> tags of the page at `page_path`. Returns the number of images
+    changed and the bytes saved.
+    '''
+    with open(page_path, 'rb') as f:
+        content = f.read()
+    if b'<img' not in content and b'<IMG' not in content:
+        return 0, 0
+    changed, saved = 0, 0
+
+    def replace(match):
+        nonlocal changed, saved
+        tag = match.group(0)
+        if b'loading' in _attributes(tag):
+            return tag
+        new_tag, tag_saved = optimize_tag(tag, page_path, build_dir)
+        changed += 1
+        saved += tag_saved
+        return new_tag
+    optimized = img_tag.sub(replace, content)
+    if changed:
+        with open(page_path, 'wb') as f:
+            f.write(optimized)
+    return changed, saved
+
+
+def _compressors():
+    compressors = {'.gz': lambda content: gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        compressors['.br'] = lambda content: brotli.compress(content, quality=11)
+    except ImportError:
+        pass
+    return compressors
+
+
+def compress_file(filepath, cache=compressed_cache_path):
+    '''
+    Writes the compressed versions of the file at `filepath` next to it, from the cache if
+    it was compressed before, if they're smaller. Returns the hash of its contents, its size
+    and the size of the smallest version.
+    '''
+    with open(filepath, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if len(content) < min_compress_size:
+        return digest, len(content), len(content)
+    smallest = len(content)
+    for suffix, compress in _compressors().items():
+        cached = os.path.join(cache, digest[:2], digest + suffix)
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(cached + f'.{os.getpid()}.tmp', 'wb') as f:
+                f.write(compress(content))
+            os.replace(cached + f'.{os.getpid()}.tmp', cached)
+        size = os.path.getsize(cached)
+        if size < len(content):
+            shutil.copyfile(cached, filepath + suffix)
+            smallest = min(smallest, size)
+    return digest, len(content), smallest
+
+
+def prune_cache(digests, cache=compressed_cache_path):
+    '''
+    Removes the compressed files of contents that are no longer in the site.
+    '''
+    for (dirpath, _, filenames) in os.walk(cache):
+        for name in filenames:
+            if name.split('.')[0] not in digests:
+                os.remove(os.path.join(dirpath, name))
+
+
+def _find(base_dir, suffixes):
+    return [os.path.join(dirpath, name) for (dirpath, _, filenames) in os.walk(base_dir)
+            for name in sorted(filenames) if os.path.splitext(name)[1] in suffixes]
+
+
+if __name__ == '__main__':
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('command', choices=['images', 'compress'])
+    parser.add_argument('dir')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="number of processes")
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        if args.command == 'images':
+            pages = _find(args.dir, ['.html'])
+            results = list(pool.map(optimize_page, pages, [args.dir] * len(pages), chunksize=8))
+            for page, (count, saved) in zip(pages, results):
+                if count:
+                    print(f"  {page}: {count} images, {saved / 1024:.0f} kB saved")
+            print(f"Optimized {sum(count for count, _ in results)} images in {sum(1 for count, _ in results if count)} pages, "
+                  f"{sum(saved for _, saved in results) / 2**20:.1f} MiB saved")
+        else:
+            filepaths = _find(args.dir, compressed_suffixes)
+            results = list(pool.map(compress_file, filepaths, chunksize=16))
+            prune_cache({digest for digest, _, _ in results})
+            for filepath, (_, size, smallest) in zip(filepaths, results):
+                if filepath.endswith('.html') and smallest < size:
+                    print(f"  {filepath}: {size / 1024:.0f} kB, {smallest / 1024:.0f} kB compressed")
+            print(f"Compressed {len(filepaths)} files ({', '.join(_compressors())}), "
+                  f"{sum(size - smallest for _, size, smallest in results) / 2**20:.1f} MiB saved")
+    print("Finished in %.2f seconds" % (time.time() - t0))
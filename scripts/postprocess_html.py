@@ -1,33 +1,97 @@
 # This script santises the sympy latex in the HTML files prior to building the site
+#
+# Only files whose bytes contain both `output_latex` and `{{` can need changing, so the rest
+# are skipped without being parsed, and in the ones that do, only the text of the LaTeX
+# outputs is patched, leaving the rest of the file byte for byte as it was. Files are
+# processed in parallel. The files checked (and which of them were changed) are recorded in
+# _build/.exec_cache/postprocess_html.json, so files that haven't changed since, such as the
+# locale books seen again from the main build directory, aren't read again.
+import json
 import os
-import sys
-from bs4 import BeautifulSoup
+import re
+from pathlib import Path
+
+path_root = Path(__file__).parent.parent
+record_path = path_root.joinpath('_build', '.exec_cache', 'postprocess_html.json')
+
+latex_div = re.compile(rb'(<div\b[^>]*\bclass=["\'][^"\']*\boutput_latex\b[^>]*>)(.*?)(</div>)', re.DOTALL)
+tag = re.compile(rb'(<[^>]*>)')
+
+
+def _sanitize_text(match):
+    # only the text between tags is LaTeX; markup inside the output is left alone
+    parts = tag.split(match.group(2))
+    parts[::2] = [part.replace(b'{{', b'{ {') for part in parts[::2]]
+    return match.group(1) + b''.join(parts) + match.group(3)
+
 
 def sanitize_latex(filepath):
     '''
     Replace {{ with { { inside LaTeX outputs not to confuse Jekyll about what
-    should be interpolated.
+    should be interpolated. Returns whether the file was modified.
     '''
-    is_modified = False
-    soup = BeautifulSoup(open(filepath), 'html.parser')
-    for latex in soup.find_all('div', {'class': 'output_latex'}):
-        if r'{{' in latex.string:
-            sanitized_latex = latex.string.replace(r'{{', '{ {')
-            latex.string = sanitized_latex
-            is_modified = True
-    if is_modified:
-        print(f'sanitize_latex: `{filepath}`')
-        with open(filepath, 'w') as f:
-            f.write(str(soup))
+    with open(filepath, 'rb') as f:
+        content = f.read()
+    if b'output_latex' not in content or b'{{' not in content:
+        return False
+    sanitized = latex_div.sub(_sanitize_text, content)
+    if sanitized == content:
+        return False
+    print(f'sanitize_latex: `{filepath}`')
+    with open(filepath, 'wb') as f:
+        f.write(sanitized)
+    return True
+
+
+def _stat(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _key(filepath):
+    return os.path.relpath(os.path.abspath(filepath), path_root)
+
+
+def load_record(path=record_path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'checked': {}, 'touched': {}}
+
+
+def save_record(record, path=record_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.exit('Usage: python3 postprocess_html.py <build-dir>')
-    base_dir = sys.argv[1]
-    for (dirpath, _, filenames) in os.walk(base_dir):
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(usage='python3 postprocess_html.py <build-dir> [--jobs N] [--all]')
+    parser.add_argument('build_dir')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--all', action='store_true', help='check every file, even those unchanged since the last run')
+    args = parser.parse_args()
+
+    record = load_record()
+    filepaths = []
+    for (dirpath, _, filenames) in os.walk(args.build_dir):
         for name in filenames:
             if not name.endswith('.html'):
                 continue
             filepath = os.path.join(dirpath, name)
-            sanitize_latex(filepath)
+            if args.all or record['checked'].get(_key(filepath)) != _stat(filepath):
+                filepaths.append(filepath)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        modified = list(pool.map(sanitize_latex, filepaths, chunksize=32))
 
+    touched = [_key(filepath) for filepath, is_modified in zip(filepaths, modified) if is_modified]
+    record['checked'] = {key: value for key, value in record['checked'].items() if os.path.exists(path_root.joinpath(key))}
+    record['checked'].update({_key(filepath): _stat(filepath) for filepath in filepaths})
+    record['touched'][_key(args.build_dir)] = touched
+    save_record(record)
+    print(f'postprocess_html: checked {len(filepaths)} files, modified {len(touched)}')
@@ -7,19 +7,30 @@ This belongs in the "scripts" folder, it replaces all the code cells
 in notebooks in <target-dir> with the code cells in <base-dir>, but
 tries to preserve the comments from the cells in <target-dir>.
 
+Code cells are aligned with a diff of their code, ignoring comments and
+whitespace (see notebook_cells.py), so a cell added to or removed from
+either notebook doesn't throw off the cells after it. Base cells with no
+counterpart are added to the target notebook, and target cells with no
+counterpart are left alone; both are listed at the end, and in the JSON
+file given by --report PATH. Notebooks are synced in parallel, and only
+written if they changed. With --stale-only, only the notebooks that
+translation_index.py says are behind are synced.
+
 You will need to check each notebook individually afterwards as this
 doesn't deal with edge cases well (of which there are a few in the
 textbook).
 """
 
+import copy
+import difflib
 import time
 import nbformat
-import io
-from traitlets.config import Config
-from nbconvert.preprocessors import ExecutePreprocessor
+from notebook_cells import code_cells, normalize_source, source_hash
 content_basedir = "../content/"
 target_basedir = "../i18n/locales/ja/"
 exclude = []
+# changed cells less similar than this are not paired up
+min_similarity = 0.5
 
 def preserve_comments(base, target):
     base, target = base.split('\n'), target.split('\n')
@@ -45,65 +56,154 @@ def preserve_comments(base, target):
     return out.strip('\n')
 
 
+def _pair_changed(base_cells, target_cells):
+    '''
+    Pairs up a run of base cells with a run of target cells whose code differs: one-to-one
+    if there are as many of each, and otherwise each base cell with the most similar
+    remaining target cell, keeping them in order. Returns (base index, target index) pairs.
+    '''
+    if len(base_cells) == len(target_cells):
+        return list(zip(range(len(base_cells)), range(len(target_cells))))
+    pairs, start = [], 0
+    for base_idx, base in enumerate(base_cells):
+        scores = [(difflib.SequenceMatcher(None, normalize_source(base.source),
+                                           normalize_source(target_cells[idx].source)).ratio(), idx)
+                  for idx in range(start, len(target_cells))]
+        if scores:
+            score, target_idx = max(scores)
+            if score >= min_similarity:
+                pairs.append((base_idx, target_idx))
+                start = target_idx + 1
+    return pairs
+
+
+def align_cells(base_cells, target_cells):
+    '''
+    Aligns two lists of code cells, returning a list with the index of the target cell
+    paired with each base cell (or None). Cells with the same code apart from comments and
+    whitespace are matched first, and the cells between them are paired by `_pair_changed`.
+    '''
+    matcher = difflib.SequenceMatcher(None, [source_hash(cell.source) for cell in base_cells],
+                                      [source_hash(cell.source) for cell in target_cells], autojunk=False)
+    paired = [None] * len(base_cells)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for offset in range(i2 - i1):
+                paired[i1 + offset] = j1 + offset
+        elif tag == 'replace':
+            for base_idx, target_idx in _pair_changed(base_cells[i1:i2], target_cells[j1:j2]):
+                paired[i1 + base_idx] = j1 + target_idx
+    return paired
+
+
 def replace_code_cells(basefile, targetfile):
+    '''
+    Syncs the code cells of `targetfile` with those of `basefile`, writing it only if it
+    changed. Returns a dict reporting what was done, with the base cells that had no
+    counterpart (and were added) and the target cells that had none (and were left alone).
+    '''
+    report = {'notebook': targetfile, 'status': 'unchanged', 'replaced': 0, 'added': [], 'unmatched': []}
     with open(basefile) as f:
         basenb = nbformat.read(f, as_version=4)
-    # get all code cells from base file
-    base_code_cells = []
-    for cell in basenb.cells:
-        if cell.cell_type == 'code':
-            base_code_cells.append(cell)
-    # overwrite the target notebook's code cells
     try:
         with open(targetfile) as f:
             targetnb = nbformat.read(f, as_version=4)
-    except:
-        print(f"No match for '{basefile.split('/')[-1]}'")
-        return 1
-    for cell in targetnb.cells:
-        if cell.cell_type == 'code':
+    except FileNotFoundError:
+        report['status'] = 'missing'
+        return report
+    original = nbformat.writes(targetnb)
+    base_code_cells, target_code_cells = code_cells(basenb), code_cells(targetnb)
+    paired = align_cells(base_code_cells, target_code_cells)
+
+    # where each target code cell is in the notebook, and where the next new cell goes:
+    # before the first code cell, and then after the last cell that was synced
+    positions = [idx for idx, cell in enumerate(targetnb.cells) if cell.cell_type == 'code']
+    insert_at = positions[0] if positions else len(targetnb.cells)
+    inserted = 0
+    for base_idx, (base, target_idx) in enumerate(zip(base_code_cells, paired)):
+        if target_idx is None:
+            # a new cell goes after the target cell paired with the one before it
+            cell = nbformat.v4.new_code_cell(base.source, metadata=copy.deepcopy(base.metadata))
+            targetnb.cells.insert(insert_at, cell)
+            insert_at += 1
+            inserted += 1
+            report['added'].append({'base_cell': base_idx, 'source': base.source})
+            continue
+        target = target_code_cells[target_idx]
+        if source_hash(target.source) != source_hash(base.source):
             try:
-                cell.source = preserve_comments(base_code_cells[0].source, cell.source)
-                base_code_cells.pop(0)
-            except:
-                try:
-                    cell.source = base_code_cells.pop(0).source
-                except IndexError:
-                    base_code_cells = ['need to make list len > 0']
-                    break
-    if len(base_code_cells) == 0:
-        print(f"Replaced code cells in '{basefile.split('/')[-1]}'")
+                target.source = preserve_comments(base.source, target.source)
+            except IndexError:
+                target.source = base.source
+            report['replaced'] += 1
+        if target.metadata.get('tags', []) != base.metadata.get('tags', []):
+            target.metadata['tags'] = list(base.metadata.get('tags', []))
+        # target cells are paired in order, so every cell inserted so far is before this one
+        insert_at = positions[target_idx] + inserted + 1
+
+    matched = set(paired)
+    report['unmatched'] = [{'target_cell': idx, 'source': cell.source}
+                           for idx, cell in enumerate(target_code_cells) if idx not in matched]
+    if nbformat.writes(targetnb) != original:
         with open(targetfile, 'w', encoding='utf-8') as f:
             nbformat.write(targetnb, f)
-        return 0
-    else:
-        print(f"[Error] Number of code cells in '{basefile.split('/')[-1]}' didn't match, this needs doing manually.")
-        return 1
+        report['status'] = 'updated'
+    return report
+
 
 if __name__ == '__main__':
     import os
-    import sys
+    import json
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
     t0 = time.time()
-    total_files, replaced_files = 0, 0
-
-    if len(sys.argv) != 3:
-        sys.exit("Usage: python3 replace_code_cells.py <base-dir> <target-dir>")
-    base_dir = sys.argv[1]
-    target_dir = sys.argv[2]
-    
-    for (dirpath, _, filenames) in os.walk(base_dir):
+
+    parser = argparse.ArgumentParser(usage="python3 replace_code_cells.py <base-dir> <target-dir> [--jobs N] [--report PATH] [--stale-only]")
+    parser.add_argument('base_dir')
+    parser.add_argument('target_dir')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="number of notebooks to sync at the same time")
+    parser.add_argument('--report', metavar='PATH', help="write what was done to each notebook to a JSON file")
+    parser.add_argument('--stale-only', action='store_true', help="only sync the notebooks whose code is behind (see translation_index.py)")
+    args = parser.parse_args()
+
+    pairs = []
+    for (dirpath, _, filenames) in os.walk(args.base_dir):
         for name in filenames:
             if name.endswith(".ipynb"):
                 base_filepath = os.path.join(dirpath, name)
-                target_filepath = os.path.join(target_dir + dirpath.lstrip(base_dir), name)
-                if any(e in filepath for e in exclude):
+                target_filepath = os.path.join(args.target_dir, os.path.relpath(base_filepath, args.base_dir))
+                if any(e in base_filepath for e in exclude):
                     print("SKIPPING:" + name)
                     continue
-                total_files += 1
-                if replace_code_cells(base_filepath, target_filepath) == 0:
-                    replaced_files += 1
+                pairs.append((base_filepath, target_filepath))
+
+    if args.stale_only:
+        from translation_index import TranslationIndex, repo_path
+        index = TranslationIndex()
+        index.update(args.base_dir, args.target_dir)
+        stale = index.stale('code')
+        pairs = [(base_filepath, target_filepath) for base_filepath, target_filepath in pairs
+                 if repo_path(target_filepath) in stale]
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        reports = list(pool.map(replace_code_cells, *zip(*pairs))) if pairs else []
+    for report in reports:
+        name = report['notebook'].split('/')[-1]
+        if report['status'] == 'missing':
+            print(f"No match for '{name}'")
+            continue
+        if report['status'] == 'updated':
+            print(f"Replaced code cells in '{name}'")
+        if report['added'] or report['unmatched']:
+            print(f"[Check] '{name}': {len(report['added'])} code cells added, "
+                  f"{len(report['unmatched'])} translated code cells have no match")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports, f, indent=1, ensure_ascii=False)
     t1 = time.time()
     running_time = t1-t0
 
+    updated = sum(report['status'] == 'updated' for report in reports)
+    unmatched = sum(report['status'] != 'missing' and bool(report['added'] or report['unmatched']) for report in reports)
     print("Finished in %.2f seconds" % running_time)
-    print("%i files were accessed, %i had code cells replaced." % (total_files, replaced_files))
+    print("%i files were accessed, %i had code cells replaced and %i need checking." % (len(reports), updated, unmatched))
@@ -11,29 +11,110 @@ This belongs in the "scripts" folder, it runs every notebook in <base-dir> unles
 *** Only run sparingly since it WILL send ~20 jobs off to IBMQX ***
 *******************************************************************
 
+unless --hardware replay is given, in which case IBMQ is replaced by a stand-in that
+replays recorded job results, or simulates them on noisy fake backends. The notebooks
+are then only checked, and not saved, so the real outputs of their hardware jobs are
+kept. With --hardware record, the jobs are sent as usual and their results are recorded
+for later replays (see hardware_stand_in.py).
+
+Notebooks that ran without errors are recorded in the execution cache (see exec_cache.py).
+If a notebook's code, qiskit_textbook and the installed requirements haven't changed since,
+the cached outputs are copied into it instead of running it again. Simulator jobs with a
+fixed seed, or all of them in notebooks with "memoize_simulations": true in their metadata,
+are memoized too (see simulation_cache.py). Pass --no-cache to run every notebook regardless.
+
+The time and peak kernel memory of every cell that is run are recorded; the slowest
+--top N cells are printed at the end, and --report PATH writes all of them to a
+JSON (or, if PATH ends in .csv, CSV) file.
+
+The time taken by each notebook is added to the build history (see build_history.py).
+With --compare-baseline PCT, the run fails if any notebook took more than PCT percent
+longer than the median of its previous runs.
+
+With --warm-kernels, each notebook is handed a kernel that was started, and imported
+qiskit and the other common modules, while the previous notebook was running (only the
+first notebook waits for its kernel to start, see kernel_pool.py).
+
 """
 
 import time
 import nbformat
-from nbconvert.preprocessors import ExecutePreprocessor
 from datetime import datetime
+from notebook_execution import TextbookExecutePreprocessor, write_cell_report, print_slowest_cells, add_setup_cell, remove_setup_cell
+from exec_cache import ExecutionCache, environment_hash, notebook_key, graft_outputs, relative_notebook_path
+from build_history import BuildHistory, print_regressions
+from kernel_pool import KernelPool, print_pool_stats
+import hardware_stand_in
+import simulation_cache
 filepath = "../content/"
 exclude = ['ch-labs']  # filepaths containing these strings will be skipped
 
-def run_notebook(filename):
+def run_notebook(filename, env_hash=None, cell_rows=None, durations=None, kernel_pool=None, hardware='live', simulations=None, save=None):
+    '''
+    Runs the notebook and saves its outputs, returning 1 if this worked and 0 if it didn't.
+    The cache is only used if `env_hash` is given, the cell timings are appended to `cell_rows`
+    and, if it ran without errors, the time taken is stored in `durations`. If `kernel_pool`
+    is given, the notebook is run in one of its warm kernels. `hardware` is 'live' to send
+    jobs to IBMQ, or 'record' or 'replay' to use the hardware stand-in. Simulator results
+    are memoized if `env_hash` is given, and the hits and misses are stored in `simulations`.
+    The outputs aren't saved if `save` is False, which it is by default with 'replay', so
+    replayed or simulated results don't replace those of the real hardware.
+    '''
+    if save is None:
+        save = hardware != 'replay'
     execution_failed = False
     with open(filename) as f:
         nb = nbformat.read(f, as_version=4)
-        try:
-            ep = ExecutePreprocessor(timeout=None, kernel_name='python3')
-            ep.preprocess(nb, {'metadata': {'path': './'}})
-        except Exception as e:
-            print("[" + datetime.now().time().strftime('%H:%M') + "] " + "Error in file '", filename, "': ", str(e).split('\n')[-2])
-            execution_failed = True
+    notebook = relative_notebook_path(filename)
+    setup = []
+    if hardware != 'live':
+        setup += hardware_stand_in.setup_code(hardware, notebook)
+    if env_hash is not None:
+        setup += simulation_cache.setup_code(notebook, nb.metadata.get('memoize_simulations', False))
+    if setup:
+        add_setup_cell(nb, setup)
+
+    if env_hash is not None:
+        cache = ExecutionCache()
+        key = notebook_key(nb, env_hash, 'full')
+        cached_nb = cache.get(key)
+        if cached_nb is not None:
+            remove_setup_cell(nb)
+            print("[" + datetime.now().time().strftime('%H:%M') + "] " + "Using cached outputs for '", filename, "'")
+            if save and graft_outputs(cached_nb, nb):
+                with open(filename, 'w', encoding='utf-8') as f:
+                    nbformat.write(nb, f)
+            return 1
+
+    t0 = time.time()
+    ep = TextbookExecutePreprocessor(timeout=None, kernel_name='python3')
+    km = None
+    try:
+        if kernel_pool is not None:
+            km = kernel_pool.acquire()
+        ep.preprocess(nb, {'metadata': {'path': './'}}, km=km)
+    except Exception as e:
+        print("[" + datetime.now().time().strftime('%H:%M') + "] " + "Error in file '", filename, "': ", str(e).split('\n')[-2])
+        execution_failed = True
+    finally:
+        if km is not None:
+            kernel_pool.release(km)
+    offset = 1 if setup else 0
+    if simulations is not None and env_hash is not None:
+        simulations[filename] = simulation_cache.SimulationCache().stats(notebook)
+    if cell_rows is not None:
+        cell_rows.extend(dict(timing, notebook=filename, cell=timing['cell'] - offset)
+                         for timing in ep.cell_timings if timing['cell'] >= offset)
+    remove_setup_cell(nb)
     
     if not execution_failed:
-        with open(filename, 'w', encoding='utf-8') as f:
-            nbformat.write(nb, f)
+        if save:
+            with open(filename, 'w', encoding='utf-8') as f:
+                nbformat.write(nb, f)
+        if env_hash is not None:
+            cache.put(key, filename, 'full', nb, time.time() - t0)
+        if durations is not None:
+            durations[filename] = time.time() - t0
         return 1
     return 0
 
@@ -41,12 +122,26 @@ def run_notebook(filename):
 if __name__ == '__main__':
     import os
     import sys
+    import argparse
     t0 = time.time()
     total_files, working_files = 0, 0
+    cell_rows = []
+    durations = {}
+    simulations = {}
 
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python3 run_notebooks.py <content-dir>")
-    base_dir = sys.argv[1]
+    parser = argparse.ArgumentParser(usage="python3 run_notebooks.py <content-dir> [--no-cache] [--report PATH] [--top N] [--compare-baseline PCT] [--warm-kernels] [--hardware live|record|replay]")
+    parser.add_argument('base_dir')
+    parser.add_argument('--no-cache', action='store_true', help="run notebooks even if an identical run is in the execution cache")
+    parser.add_argument('--report', metavar='PATH', help="write the time and memory used by each cell to a JSON or CSV file")
+    parser.add_argument('--top', type=int, default=10, metavar='N', help="number of slowest cells to list at the end")
+    parser.add_argument('--compare-baseline', type=float, metavar='PCT', help="fail if a notebook is more than PCT percent slower than its median")
+    parser.add_argument('--warm-kernels', action='store_true', help="hand each notebook a kernel that has already imported qiskit")
+    parser.add_argument('--hardware', choices=['live', 'record', 'replay'], default='live',
+                        help="send hardware jobs to IBMQ, send them and record the results, or replay recorded results")
+    args = parser.parse_args()
+    base_dir = args.base_dir
+    env_hash = None if args.no_cache else environment_hash()
+    kernel_pool = KernelPool(size=1) if args.warm_kernels else None
     
     for (dirpath, _, filenames) in os.walk(base_dir):
         for name in filenames:
@@ -57,10 +152,31 @@ if __name__ == '__main__':
                     continue
                 print("[" + datetime.now().time().strftime('%H:%M') + "] " + filepath)
                 total_files += 1
-                if run_notebook(filepath) == 1:
+                if run_notebook(filepath, env_hash, cell_rows, durations, kernel_pool, args.hardware, simulations) == 1:
                     working_files += 1
+    if kernel_pool is not None:
+        kernel_pool.shutdown()
     t1 = time.time()
     running_time = t1-t0
 
+    print_slowest_cells(cell_rows, args.top)
+    simulation_cache.print_simulation_stats(list(simulations.values()))
+    if kernel_pool is not None:
+        print_pool_stats(kernel_pool.acquired, kernel_pool.warmup_seconds, kernel_pool.wait_seconds)
+    if args.report:
+        write_cell_report(cell_rows, args.report)
+
+    history = BuildHistory()
+    regressions = []
+    if args.compare_baseline is not None:
+        regressions = history.compare(durations, 'full', args.compare_baseline)
+        print_regressions(regressions, args.compare_baseline)
+    history.record(durations, 'full')
+
     print("Finished in %.2f seconds" % running_time)
-    print("%i files were accessed, %i were updated and %i were not updated due to errors." % (total_files, working_files, total_files - working_files))
+    if args.hardware == 'replay':
+        print("%i files were accessed, %i ran without errors (and weren't saved) and %i had errors." % (total_files, working_files, total_files - working_files))
+    else:
+        print("%i files were accessed, %i were updated and %i were not updated due to errors." % (total_files, working_files, total_files - working_files))
+    if regressions:
+        sys.exit(os.EX_SOFTWARE)
@@ -10,64 +10,203 @@ Cells with `uses-hardware` tags are ignored, and the cell outputs are NOT update
 
 If <toc-path> is provided, only notebooks whose names are found in the toc file will be run.
 
+With --changed PATH [PATH ...] or --since REF, only the notebooks that could be affected by
+those changed files, or by the changes since the git revision REF, are run (see affected_notebooks.py).
+
+With --jobs N, N notebooks are run at a time, each in its own worker process and kernel.
+Every notebook is run even if some fail; the failures are listed in a summary table
+at the end, and the script exits with a non-zero status if there were any.
+With --timeout SECONDS, a notebook fails if it takes longer than SECONDS to run.
+
+Notebooks that ran without errors are recorded in the execution cache (see exec_cache.py),
+and are skipped until their code, qiskit_textbook or the installed requirements change.
+Pass --no-cache to run every notebook regardless.
+
+The time and peak kernel memory of every cell that is run are recorded; the slowest
+--top N cells are printed at the end, and --report PATH writes all of them to a
+JSON (or, if PATH ends in .csv, CSV) file.
+
+The time taken by each notebook is added to the build history (see build_history.py).
+With --compare-baseline PCT, the run fails if any notebook took more than PCT percent
+longer than the median of its previous runs.
+
+With --warm-kernels, each notebook is handed a kernel that was started, and imported
+qiskit and the other common modules, while the previous notebook was running (only the
+first notebook waits for its kernel to start, see kernel_pool.py).
+
+Simulator jobs with a fixed seed, or all of them in notebooks with
+"memoize_simulations": true in their metadata, are memoized (see simulation_cache.py)
+unless --no-cache is given.
+
+With --replay-hardware, cells with `uses-hardware` tags are run too, against a stand-in
+for IBMQ that replays recorded job results or simulates them on noisy fake backends
+(see hardware_stand_in.py).
+
 """
 
 import time
 import nbformat
 import io
 from traitlets.config import Config
-from nbconvert.preprocessors import ExecutePreprocessor
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from notebook_execution import TextbookExecutePreprocessor, timestamp, error_summary, print_summary, write_cell_report, print_slowest_cells, add_setup_cell
+from exec_cache import ExecutionCache, environment_hash, notebook_key, relative_notebook_path
+from build_history import BuildHistory, print_regressions
+from affected_notebooks import find_notebooks, affected_notebooks, changes_from
+from kernel_pool import KernelPool, print_pool_stats
+import hardware_stand_in
+import simulation_cache
 filepath = "../content/"
 
-def run_notebook(filename):
+# pool of warm kernels for this process, if --warm-kernels is used
+kernel_pool = None
+
+def start_kernel_pool():
+    global kernel_pool
+    from multiprocessing import util
+    kernel_pool = KernelPool(size=1)
+    # shut the warm kernels down when a pool worker exits
+    util.Finalize(kernel_pool, kernel_pool.shutdown, exitpriority=10)
+
+def run_notebook(filename, timeout=None, env_hash=None, replay_hardware=False):
+    '''
+    Runs the notebook, returning a dict with the error message (None if it ran
+    without errors), the time taken, whether the run was found in the cache and
+    the timings of the cells. The caches (of notebooks and of simulator results)
+    are only used if `env_hash` is given. If `replay_hardware` is True,
+    `uses-hardware` cells are run against the hardware stand-in instead of being removed.
+    '''
+    t0 = time.time()
+    result = {'notebook': filename, 'error': None, 'cached': False, 'cells': []}
     c = Config()
     c.TagRemovePreprocessor.remove_cell_tags = ("remove_cell", "uses-hardware")
     c.TagRemovePreprocessor.enabled=True
     c.preprocessors = ['TagRemovePreprocessor']
-    execution_failed = False
 
     with open(filename) as f:
         nb = nbformat.read(f, as_version=4)
 
-    for cell in nb.cells.copy():
-        if "uses-hardware" in cell.metadata.get("tags", []):
-            nb.cells.remove(cell)
+    # positions of the cells that are run, in the original notebook
+    if replay_hardware:
+        positions = list(range(len(nb.cells)))
+    else:
+        positions = [idx for idx, cell in enumerate(nb.cells) if "uses-hardware" not in cell.metadata.get("tags", [])]
+        for cell in nb.cells.copy():
+            if "uses-hardware" in cell.metadata.get("tags", []):
+                nb.cells.remove(cell)
+
+    notebook = relative_notebook_path(filename)
+    setup = []
+    if replay_hardware:
+        setup += hardware_stand_in.setup_code('replay', notebook)
+    if env_hash is not None:
+        setup += simulation_cache.setup_code(notebook, nb.metadata.get('memoize_simulations', False))
+    if setup:
+        add_setup_cell(nb, setup)
+        positions.insert(0, None)
+
+    if env_hash is not None:
+        cache = ExecutionCache()
+        key = notebook_key(nb, env_hash, 'soft')
+        if cache.has(key):
+            result.update(cached=True, seconds=time.time() - t0)
+            return result
+    ep = TextbookExecutePreprocessor(timeout=None, kernel_name='python3', notebook_timeout=timeout)
+    km = None
     try:
-        ep = ExecutePreprocessor(timeout=None, kernel_name='python3')
-        ep.preprocess(nb, {'metadata': {'path': './'}})
+        if kernel_pool is not None:
+            km = kernel_pool.acquire()
+            result.update(kernel_warmup=kernel_pool.last_warmup, kernel_wait=kernel_pool.last_wait)
+        ep.preprocess(nb, {'metadata': {'path': './'}}, km=km)
     except Exception as e:
-        print("[" + datetime.now().time().strftime('%H:%M') + "] " + "Error in file '", filename, "': ", str(e).split('\n')[-2])
-        return 1
-    return 0
+        result['error'] = error_summary(e)
+        print(timestamp() + "Error in file '", filename, "': ", result['error'])
+    finally:
+        if km is not None:
+            kernel_pool.release(km)
+    result['seconds'] = time.time() - t0
+    if env_hash is not None:
+        result['simulations'] = simulation_cache.SimulationCache().stats(notebook)
+    for timing in ep.cell_timings:
+        if positions[timing['cell']] is not None:
+            result['cells'].append(dict(timing, notebook=filename, cell=positions[timing['cell']]))
+    if env_hash is not None and result['error'] is None:
+        cache.put(key, filename, 'soft', nb, result['seconds'])
+    return result
 
 if __name__ == '__main__':
     import os
     import sys
+    import argparse
     t0 = time.time()
-    total_files, working_files = 0, 0
-
-    if len(sys.argv) < 2:
-        sys.exit("Usage: python3 run_notebooks.py <content-dir> <toc-filepath>")
-    if len(sys.argv) == 3:
-        toc_filepath = sys.argv[2]
-        with open(toc_filepath) as f:
-            toc_txt = f.read()
+
+    parser = argparse.ArgumentParser(usage="python3 run_notebooks_soft.py <content-dir> [<toc-filepath>] [--jobs N] [--timeout SECONDS] [--changed PATH ... | --since REF]")
+    parser.add_argument('base_dir')
+    parser.add_argument('toc_filepath', nargs='?')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="number of notebooks to run at the same time")
+    parser.add_argument('--timeout', type=float, default=None, help="maximum number of seconds to spend on each notebook")
+    parser.add_argument('--no-cache', action='store_true', help="run notebooks even if an identical run is in the execution cache")
+    parser.add_argument('--report', metavar='PATH', help="write the time and memory used by each cell to a JSON or CSV file")
+    parser.add_argument('--top', type=int, default=10, metavar='N', help="number of slowest cells to list at the end")
+    parser.add_argument('--compare-baseline', type=float, metavar='PCT', help="fail if a notebook is more than PCT percent slower than its median")
+    parser.add_argument('--warm-kernels', action='store_true', help="hand each notebook a kernel that has already imported qiskit")
+    parser.add_argument('--replay-hardware', action='store_true', help="run uses-hardware cells against recorded or simulated IBMQ jobs")
+    parser.add_argument('--changed', nargs='+', metavar='PATH', help="only run notebooks that could be affected by these changed files")
+    parser.add_argument('--since', metavar='REF', help="only run notebooks that could be affected by the changes since this git revision")
+    args = parser.parse_intermixed_args()
+    env_hash = None if args.no_cache else environment_hash()
+    base_dir = args.base_dir
+
+    filepaths = find_notebooks(base_dir, args.toc_filepath)
+    if args.changed is not None or args.since is not None:
+        all_notebooks = len(filepaths)
+        filepaths = affected_notebooks(filepaths, changes_from(args.changed, args.since))
+        print(timestamp() + "%i of %i notebooks could be affected by the changes" % (len(filepaths), all_notebooks))
+
+    results = []
+    if args.jobs > 1:
+        initializer = start_kernel_pool if args.warm_kernels else None
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=initializer) as pool:
+            futures = [pool.submit(run_notebook, filepath, args.timeout, env_hash, args.replay_hardware) for filepath in filepaths]
+            for future in as_completed(futures):
+                result = future.result()
+                print(timestamp() + result['notebook'] + " (%.1fs)" % result['seconds'])
+                results.append(result)
     else:
-        toc_txt = None
-    base_dir = sys.argv[1]
-    
-    for (dirpath, _, filenames) in os.walk(base_dir):
-        for name in filenames:
-            if name.endswith(".ipynb"):
-                if toc_txt is None or os.path.splitext(name)[0] in toc_txt:
-                    filepath = os.path.join(dirpath, name)
-                    print("[" + datetime.now().time().strftime('%H:%M') + "] " + filepath)
-                    total_files += 1
-                    if run_notebook(filepath) != 0:
-                        sys.exit(os.EX_SOFTWARE)
+        if args.warm_kernels:
+            start_kernel_pool()
+        for filepath in filepaths:
+            print(timestamp() + filepath)
+            results.append(run_notebook(filepath, args.timeout, env_hash, args.replay_hardware))
+        if kernel_pool is not None:
+            kernel_pool.shutdown()
     t1 = time.time()
     running_time = t1-t0
 
+    print_summary(results)
+    cell_rows = [row for result in results for row in result['cells']]
+    print_slowest_cells(cell_rows, args.top)
+    simulation_cache.print_simulation_stats([result['simulations'] for result in results if 'simulations' in result])
+    if args.warm_kernels:
+        warm = [result for result in results if 'kernel_warmup' in result]
+        print_pool_stats(len(warm), sum(result['kernel_warmup'] for result in warm),
+                         sum(result['kernel_wait'] for result in warm))
+    if args.report:
+        write_cell_report(cell_rows, args.report)
+    failed = [result['notebook'] for result in results if result['error'] is not None]
+    cached = [result['notebook'] for result in results if result['cached']]
+
+    durations = {result['notebook']: result['seconds'] for result in results
+                 if result['error'] is None and not result['cached']}
+    history = BuildHistory()
+    regressions = []
+    if args.compare_baseline is not None:
+        regressions = history.compare(durations, 'soft', args.compare_baseline)
+        print_regressions(regressions, args.compare_baseline)
+    history.record(durations, 'soft')
+
     print("Finished in %.2f seconds" % running_time)
+    print("%i files were accessed, %i were cached and %i failed." % (len(results), len(cached), len(failed)))
+    if failed or regressions:
+        sys.exit(os.EX_SOFTWARE)
     sys.exit(os.EX_OK)
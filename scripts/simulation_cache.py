@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it is an IPython extension that run_notebooks.py and
+run_notebooks_soft.py load into each kernel to memoize the results of simulator jobs.
+
+`backend.run` (and so `execute`) on the Aer and BasicAer simulators is wrapped so that
+results are stored on disk, keyed on the circuits (or Qobj), the backend and its options,
+the shots and the seed. Only jobs whose results can be reproduced are memoized: those with
+a fixed `seed_simulator`, or any job in a notebook that opts in by setting
+`"memoize_simulations": true` in its metadata. Once the cache is larger than `max_size`
+bytes, the least recently used results are dropped.
+
+Usage: python3 simulation_cache.py stats
+       python3 simulation_cache.py clear
+"""
+
+import copy
+import functools
+import hashlib
+import io
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import time
+import zlib
+from pathlib import Path
+
+# imported here, while the setup cell that loads the extension has this folder on sys.path
+from hardware_stand_in import ReplayJob
+
+path_root = Path(__file__).parent.parent
+cache_path = path_root.joinpath('_build', '.exec_cache', 'simulations.sqlite')
+max_size = 256 * 2**20
+
+# simulator classes whose `run` is memoized, if they can be imported
+simulator_classes = [('qiskit_aer.backends.aerbackend', 'AerBackend'),
+                     ('qiskit.providers.aer.backends.aerbackend', 'AerBackend'),
+                     ('qiskit.providers.basicaer', 'QasmSimulatorPy'),
+                     ('qiskit.providers.basicaer', 'StatevectorSimulatorPy'),
+                     ('qiskit.providers.basicaer', 'UnitarySimulatorPy')]
+
+# state of the extension in this kernel, set by `configure` and `load_ipython_extension`
+_config = {'notebook': None, 'opt_in': False, 'path': cache_path, 'max_size': max_size}
+_cache = None
+_originals = {}
+_running = False
+
+
+class SimulationCache():
+    '''
+    SQLite store of pickled simulator results, and of how often each notebook used them.
+    '''
+
+    def __init__(self, path=cache_path, max_size=max_size):
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                                           key TEXT PRIMARY KEY,
+                                           backend TEXT,
+                                           size INTEGER,
+                                           last_used REAL,
+                                           data BLOB)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS stats (
+                                           notebook TEXT PRIMARY KEY,
+                                           hits INTEGER DEFAULT 0,
+                                           misses INTEGER DEFAULT 0,
+                                           skipped INTEGER DEFAULT 0)''')
+
+    def get(self, key):
+        '''
+        Returns the result stored under `key`, or None.
+        '''
+        row = self.connection.execute('SELECT data FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, key, backend, result):
+        data = zlib.compress(pickle.dumps(result))
+        if len(data) > self.max_size:
+            return
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                    (key, backend, len(data), time.time(), data))
+        self.evict()
+
+    def evict(self):
+        '''
+        Drops the least recently used results until the cache is no larger than `max_size`.
+        '''
+        total = self.size()[1]
+        if total <= self.max_size:
+            return
+        with self.connection:
+            for key, size in self.connection.execute('SELECT key, size FROM results ORDER BY last_used').fetchall():
+                self.connection.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def size(self):
+        '''
+        Returns the number of stored results and their total size in bytes.
+        '''
+        count, total = self.connection.execute('SELECT COUNT(*), SUM(size) FROM results').fetchone()
+        return count, total or 0
+
+    def reset_stats(self, notebook):
+        with self.connection:
+            self.connection.execute('DELETE FROM stats WHERE notebook = ?', (notebook,))
+
+    def count(self, notebook, outcome):
+        '''
+        Adds one to the `outcome` ('hits', 'misses' or 'skipped') of `notebook`.
+        '''
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO stats (notebook) VALUES (?)', (notebook,))
+            self.connection.execute(f'UPDATE stats SET {outcome} = {outcome} + 1 WHERE notebook = ?', (notebook,))
+
+    def stats(self, notebook):
+        '''
+        Returns a dict with the hits, misses and skipped (not memoized) jobs of `notebook`.
+        '''
+        row = self.connection.execute('SELECT hits, misses, skipped FROM stats WHERE notebook = ?', (notebook,)).fetchone()
+        return dict(zip(['hits', 'misses', 'skipped'], row or (0, 0, 0)))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM stats')
+            return self.connection.execute('DELETE FROM results').rowcount
+
+
+def setup_code(notebook, opt_in=False):
+    '''
+    Lines for notebook_execution.add_setup_cell that load this extension. `notebook` is the
+    path of the notebook, relative to the repository, which its stats are recorded under.
+    '''
+    return ['import simulation_cache',
+            f'simulation_cache.configure(notebook={notebook!r}, opt_in={opt_in!r})',
+            "get_ipython().extension_manager.load_extension('simulation_cache')"]
+
+
+def _json_default(value):
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, complex):
+        return [value.real, value.imag]
+    if hasattr(value, 'value') and hasattr(value, 'name'):
+        return value.value  # enums such as MeasLevel
+    raise TypeError(f"{type(value).__name__} can't be serialized")
+
+
+def circuits_digest(circuits):
+    '''
+    Hash of the circuits or Qobj of a job, or None if they can't be serialized exactly.
+    Circuit names are left out, as they are different every time a notebook is run.
+    '''
+    from qiskit import QuantumCircuit
+    try:
+        from qiskit import qpy
+    except ImportError:
+        from qiskit.circuit import qpy_serialization as qpy
+    if not isinstance(circuits, (list, tuple)):
+        circuits = [circuits]
+    digest = hashlib.sha256()
+    try:
+        for circuit in circuits:
+            if isinstance(circuit, QuantumCircuit):
+                circuit = circuit.copy()
+                circuit.name = 'circuit'
+                buffer = io.BytesIO()
+                qpy.dump(circuit, buffer)
+                digest.update(buffer.getvalue())
+            elif hasattr(circuit, 'to_dict'):
+                data = copy.deepcopy(circuit.to_dict())
+                data.pop('qobj_id', None)
+                for experiment in data.get('experiments', []):
+                    experiment.get('header', {}).pop('name', None)
+                digest.update(json.dumps(data, sort_keys=True, default=_json_default).encode())
+            else:
+                return None
+    except Exception:
+        return None
+    return digest.hexdigest()
+
+
+def _seed(backend, circuits, options):
+    seed = options.get('seed_simulator', getattr(backend.options, 'seed_simulator', None))
+    if seed is None and hasattr(circuits, 'config'):
+        seed = getattr(circuits.config, 'seed_simulator', None)
+    return seed
+
+
+def job_key(backend, circuits, options, opt_in=False):
+    '''
+    Cache key for running `circuits` on `backend` with the run `options`, or None if the
+    job shouldn't be memoized.
+    '''
+    if _seed(backend, circuits, options) is None and not opt_in:
+        return None
+    digest = circuits_digest(circuits)
+    if digest is None:
+        return None
+    name = backend.name
+    try:
+        settings = json.dumps({'backend': name() if callable(name) else name,
+                               'backend_options': dict(getattr(backend.options, '__dict__', {})),
+                               'options': options},
+                              sort_keys=True, default=_json_default)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256((digest + settings).encode()).hexdigest()
+
+
+def _rename_experiments(result, circuits):
+    # get_counts(circuit) looks experiments up by the name of the circuit
+    if hasattr(circuits, 'experiments'):
+        names = [getattr(experiment.header, 'name', None) for experiment in circuits.experiments]
+    else:
+        names = [getattr(circuit, 'name', None) for circuit in
+                 (circuits if isinstance(circuits, (list, tuple)) else [circuits])]
+    if len(names) == len(result.results):
+        for name, experiment in zip(names, result.results):
+            if name is not None and getattr(experiment, 'header', None) is not None:
+                experiment.header.name = name
+
+
+def _memoized(original):
+    @functools.wraps(original)
+    def run(backend, circuits, *args, **options):
+        global _running
+        # simulators calling each other's `run` are only counted once
+        if _cache is None or _running or args:
+            return original(backend, circuits, *args, **options)
+        notebook = _config['notebook']
+        key = job_key(backend, circuits, options, _config['opt_in'])
+        if key is None:
+            _cache.count(notebook, 'skipped')
+            return original(backend, circuits, **options)
+        result = _cache.get(key)
+        if result is not None:
+            _cache.count(notebook, 'hits')
+            _rename_experiments(result, circuits)
+            return ReplayJob(backend, result.job_id, result)
+
+        _cache.count(notebook, 'misses')
+        _running = True
+        try:
+            job = original(backend, circuits, **options)
+        finally:
+            _running = False
+        job_result = job.result
+        stored = []
+
+        def memoized_result(*args, **kwargs):
+            value = job_result(*args, **kwargs)
+            if not stored and value.success:
+                stored.append(True)
+                _cache.put(key, value.backend_name, value)
+            return value
+        job.result = memoized_result
+        return job
+    return run
+
+
+def configure(notebook=None, opt_in=False, path=cache_path, max_size=max_size):
+    '''
+    Settings used the next time the extension is loaded.
+    '''
+    _config.update(notebook=notebook, opt_in=opt_in, path=path, max_size=max_size)
+
+
+def load_ipython_extension(ipython):
+    global _cache
+    import importlib
+    _cache = SimulationCache(_config['path'], _config['max_size'])
+    _cache.reset_stats(_config['notebook'])
+    for module_name, class_name in simulator_classes:
+        try:
+            cls = getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            continue
+        if 'run' in vars(cls) and cls not in _originals:
+            _originals[cls] = cls.run
+            cls.run = _memoized(cls.run)
+
+
+def unload_ipython_extension(ipython):
+    global _cache
+    for cls, run in _originals.items():
+        cls.run = run
+    _originals.clear()
+    _cache = None
+
+
+def print_simulation_stats(stats):
+    '''
+    Prints the totals of a list of dicts returned by SimulationCache.stats.
+    '''
+    hits = sum(entry['hits'] for entry in stats)
+    misses = sum(entry['misses'] for entry in stats)
+    skipped = sum(entry['skipped'] for entry in stats)
+    if hits + misses + skipped == 0:
+        return
+    print(f"Simulation cache: {hits} hits, {misses} misses, {skipped} jobs not memoized (no fixed seed)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in ['stats', 'clear']:
+        sys.exit(__doc__.split('Usage: ')[-1].strip())
+    cache = SimulationCache()
+    if sys.argv[1] == 'clear':
+        print(f"Removed {cache.clear()} cached results")
+        sys.exit(os.EX_OK)
+    count, total = cache.size()
+    print(f"{count} cached results, {total / 2**20:.1f} MiB of {cache.max_size / 2**20:.0f} MiB")
+    rows = cache.connection.execute('SELECT notebook, hits, misses, skipped FROM stats ORDER BY notebook').fetchall()
+    for notebook, hits, misses, skipped in rows:
+        print(f"  {notebook}: {hits} hits, {misses} misses, {skipped} not memoized")
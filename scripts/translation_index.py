@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This belongs in the "scripts" folder, it keeps an index of which translated notebooks (and
+which of their cells) are behind the English notebooks they were translated from.
+
+For every notebook in <base-dir> and <target-dir>, the index stores a hash of each cell
+(for code cells, of the code without comments, see notebook_cells.py) and the cells of the
+two notebooks are aligned: code cells by their hashes, and the markdown cells in between by
+position. A translated cell is stale if:
+- it is a code cell whose code differs from the English cell's
+- it is a markdown cell whose English cell changed since the translation was last synced,
+  which is the English notebook as of the last commit of the translation (from git), or
+  as of the last `mark-synced`
+- it is missing, i.e. the English cell has no counterpart
+Only notebooks whose files changed (by their mtime and size) are read again, so updating
+the index takes milliseconds when nothing changed, and so does answering from it.
+
+replace_code_cells.py --stale-only uses it to only sync the notebooks whose code is behind,
+and graft_outputs.py to skip the notebooks that didn't change since their outputs were
+last copied.
+
+The index is stored in _build/.exec_cache/translations.sqlite.
+
+Usage: python3 translation_index.py stale <base-dir> <target-dir> [--cells]
+       python3 translation_index.py mark-synced <base-dir> <target-dir> <notebook>...
+"""
+
+import difflib
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import nbformat
+
+from notebook_cells import source_hash
+
+path_root = Path(__file__).parent.parent
+index_path = path_root.joinpath('_build', '.exec_cache', 'translations.sqlite')
+
+
+def repo_path(filepath):
+    return Path(os.path.relpath(os.path.abspath(filepath), path_root)).as_posix()
+
+
+def cell_hashes(nb):
+    '''
+    A [cell type, hash] pair for each cell of `nb`.
+    '''
+    return [[cell.cell_type, source_hash(cell.source) if cell.cell_type == 'code'
+             else hashlib.sha256(cell.source.encode('utf-8')).hexdigest()] for cell in nb.cells]
+
+
+def align_all_cells(base_cells, target_cells):
+    '''
+    Aligns the cells (as returned by `cell_hashes`) of two notebooks, returning the index of
+    the target cell paired with each base cell (or None). Code cells are matched by their
+    hashes, and markdown cells by their position between them.
+    '''
+    def tokens(cells):
+        return [cell_hash if cell_type == 'code' else cell_type for cell_type, cell_hash in cells]
+    matcher = difflib.SequenceMatcher(None, tokens(base_cells), tokens(target_cells), autojunk=False)
+    paired = [None] * len(base_cells)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+            for offset in range(i2 - i1):
+                if base_cells[i1 + offset][0] == target_cells[j1 + offset][0]:
+                    paired[i1 + offset] = j1 + offset
+    return paired
+
+
+def _git_last_commits(path):
+    '''
+    Returns a dict of each file under `path` (relative to the repository) to the last
+    commit that changed it, or an empty dict if git isn't available.
+    '''
+    try:
+        log = subprocess.run(['git', 'log', '--format=commit %H', '--name-only', '--', str(path)],
+                             cwd=path_root, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    commits, commit = {}, None
+    for line in log.splitlines():
+        if line.startswith('commit '):
+            commit = line[len('commit '):]
+        elif line and commit:
+            commits.setdefault(line, commit)
+    return commits
+
+
+def _git_notebook(commit, path):
+    try:
+        source = subprocess.run(['git', 'show', f'{commit}:{path}'], cwd=path_root,
+                                capture_output=True, text=True, check=True).stdout
+        return nbformat.reads(source, as_version=4)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+class TranslationIndex():
+    '''
+    SQLite store of the cell hashes of notebooks and their translations, and of how the
+    cells of each pair are aligned.
+    '''
+
+    def __init__(self, path=index_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS notebooks (
+                                           path TEXT PRIMARY KEY,
+                                           mtime_ns INTEGER,
+                                           size INTEGER,
+                                           cells TEXT)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS translations (
+                                           target TEXT PRIMARY KEY,
+                                           base TEXT,
+                                           synced_from TEXT,
+                                           synced_cells TEXT)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS cells (
+                                           target TEXT,
+                                           base_cell INTEGER,
+                                           target_cell INTEGER,
+                                           cell_type TEXT,
+                                           stale INTEGER)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS cells_target ON cells (target)')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS stages (
+                                           target TEXT,
+                                           stage TEXT,
+                                           state TEXT,
+                                           PRIMARY KEY (target, stage))''')
+
+    def _stat(self, filepath):
+        stat = os.stat(path_root.joinpath(filepath))
+        return stat.st_mtime_ns, stat.st_size
+
+    def _cells(self, path):
+        '''
+        Returns the cell hashes of the notebook at `path`, reading it only if it changed,
+        and whether it changed.
+        '''
+        mtime_ns, size = self._stat(path)
+        row = self.connection.execute('SELECT mtime_ns, size, cells FROM notebooks WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (mtime_ns, size):
+            return json.loads(row[2]), False
+        with open(path_root.joinpath(path)) as f:
+            cells = cell_hashes(nbformat.read(f, as_version=4))
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO notebooks VALUES (?, ?, ?, ?)',
+                                    (path, mtime_ns, size, json.dumps(cells)))
+        return cells, True
+
+    def _synced_cells(self, base, target, target_cells, commit, target_changed):
+        # the base cells the translation was made from, aligned with its cells; a translation
+        # changed since it was marked as synced is compared with its last commit again
+        row = self.connection.execute('SELECT synced_from, synced_cells FROM translations WHERE target = ?',
+                                      (target,)).fetchone()
+        if row is not None and row[0] in ['marked', f'git:{commit}'] and not target_changed:
+            return row[0], json.loads(row[1])
+        old_base = _git_notebook(commit, base) if commit else None
+        if old_base is None:
+            return None, None
+        old_cells = cell_hashes(old_base)
+        synced = [None] * len(target_cells)
+        for base_idx, target_idx in enumerate(align_all_cells(old_cells, target_cells)):
+            if target_idx is not None:
+                synced[target_idx] = old_cells[base_idx][1]
+        return f'git:{commit}', synced
+
+    def _align(self, base, target, base_cells, target_cells, synced_from, synced):
+        rows = []
+        for base_idx, target_idx in enumerate(align_all_cells(base_cells, target_cells)):
+            cell_type, base_hash = base_cells[base_idx]
+            if target_idx is None:
+                stale = True
+            elif cell_type == 'code':
+                stale = target_cells[target_idx][1] != base_hash
+            else:
+                # without a record of what the translation was made from, it's taken as up to date
+                stale = synced is not None and synced[target_idx] != base_hash
+            rows.append((target, base_idx, target_idx, cell_type, int(stale)))
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)',
+                                    (target, base, synced_from, json.dumps(synced)))
+            self.connection.execute('DELETE FROM cells WHERE target = ?', (target,))
+            self.connection.executemany('INSERT INTO cells VALUES (?, ?, ?, ?, ?)', rows)
+
+    def update(self, base_dir, target_dir):
+        '''
+        Reads the notebooks in `base_dir` and `target_dir` that changed since the last
+        update, and aligns the cells of those pairs again. Returns the pairs, as
+        (base, target) paths relative to the repository.
+        '''
+        pairs = []
+        for (dirpath, _, filenames) in os.walk(base_dir):
+            for name in sorted(filenames):
+                if name.endswith('.ipynb') and '.ipynb_checkpoints' not in dirpath:
+                    base_filepath = os.path.join(dirpath, name)
+                    target_filepath = os.path.join(target_dir, os.path.relpath(base_filepath, base_dir))
+                    pairs.append((repo_path(base_filepath), repo_path(target_filepath)))
+        commits = None
+        for base, target in pairs:
+            base_cells, base_changed = self._cells(base)
+            if not path_root.joinpath(target).exists():
+                with self.connection:
+                    self.connection.execute('DELETE FROM translations WHERE target = ?', (target,))
+                    self.connection.execute('DELETE FROM cells WHERE target = ?', (target,))
+                continue
+            target_cells, target_changed = self._cells(target)
+            aligned = self.connection.execute('SELECT 1 FROM translations WHERE target = ?', (target,)).fetchone()
+            if not (base_changed or target_changed or aligned is None):
+                continue
+            if commits is None:
+                commits = _git_last_commits(repo_path(target_dir))
+            synced_from, synced = self._synced_cells(base, target, target_cells, commits.get(target), target_changed)
+            self._align(base, target, base_cells, target_cells, synced_from, synced)
+        return pairs
+
+    def mark_synced(self, target):
+        '''
+        Records that the translation `target` is up to date with its English notebook as
+        it is now.
+        '''
+        base = self.connection.execute('SELECT base FROM translations WHERE target = ?', (target,)).fetchone()
+        if base is None:
+            raise KeyError(f"{target} isn't in the index")
+        base_cells, _ = self._cells(base[0])
+        target_cells, _ = self._cells(target)
+        synced = [None] * len(target_cells)
+        for base_idx, target_idx in enumerate(align_all_cells(base_cells, target_cells)):
+            if target_idx is not None:
+                synced[target_idx] = base_cells[base_idx][1]
+        self._align(base[0], target, base_cells, target_cells, 'marked', synced)
+
+    def stale(self, cell_type=None):
+        '''
+        Returns a dict of each translated notebook with stale cells (of `cell_type`, if
+        given) to a list of (base cell, target cell, cell type) of those cells.
+        '''
+        query = 'SELECT target, base_cell, target_cell, cell_type FROM cells WHERE stale = 1'
+        params = ()
+        if cell_type is not None:
+            query += ' AND cell_type = ?'
+            params = (cell_type,)
+        stale = {}
+        for target, base_cell, target_cell, stale_type in self.connection.execute(query + ' ORDER BY target, base_cell', params):
+            stale.setdefault(target, []).append((base_cell, target_cell, stale_type))
+        return stale
+
+    def missing(self, pairs):
+        return [target for _, target in pairs if not path_root.joinpath(target).exists()]
+
+    def stage_done(self, target, stage, base):
+        '''
+        Records that `stage` (e.g. 'graft') was run on `target` as the notebooks are now.
+        '''
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?)',
+                                    (target, stage, json.dumps([self._stat(base), self._stat(target)])))
+
+    def stage_needed(self, target, stage, base):
+        '''
+        Whether `target` or `base` changed since `stage` was last run on `target`.
+        '''
+        row = self.connection.execute('SELECT state FROM stages WHERE target = ? AND stage = ?', (target, stage)).fetchone()
+        return row is None or json.loads(row[0]) != [list(self._stat(base)), list(self._stat(target))]
+
+
+if __name__ == '__main__':
+    import argparse
+    t0 = time.time()
+    parser = argparse.ArgumentParser(usage=__doc__.split('Usage: ')[-1])
+    parser.add_argument('command', choices=['stale', 'mark-synced'])
+    parser.add_argument('base_dir')
+    parser.add_argument('target_dir')
+    parser.add_argument('notebooks', nargs='*')
+    parser.add_argument('--cells', action='store_true', help="list the stale cells of each notebook")
+    args = parser.parse_args()
+
+    index = TranslationIndex()
+    pairs = index.update(args.base_dir, args.target_dir)
+    if args.command == 'mark-synced':
+        if not args.notebooks:
+            sys.exit(__doc__.split('Usage: ')[-1].strip())
+        for notebook in args.notebooks:
+            index.mark_synced(repo_path(notebook))
+            print(f"Marked '{notebook}' as up to date")
+        sys.exit(os.EX_OK)
+
+    stale = index.stale()
+    for target, cells in stale.items():
+        counts = {cell_type: sum(1 for _, _, stale_type in cells if stale_type == cell_type) for _, _, cell_type in cells}
+        print(f"{target}: " + ', '.join(f"{count} {cell_type}" for cell_type, count in sorted(counts.items())) + " cells stale")
+        if args.cells:
+            for base_cell, target_cell, cell_type in cells:
+                where = f"cell {target_cell}" if target_cell is not None else "missing"
+                print(f"    {cell_type} cell {base_cell} of the English notebook: {where}")
+    missing = index.missing(pairs)
+    print(f"{len(stale)} of {len(pairs) - len(missing)} translated notebooks are stale, {len(missing)} aren't translated "
+          f"({(time.time() - t0) * 1000:.0f} ms)")
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import nbformat
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'scripts'))
+
+import autograde  # noqa: E402
+
+
+def _submission(path, instance, secret):
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(f'secret = {secret!r}')])
+    nb.metadata['instance'] = instance
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+    return str(path)
+
+
+def test_grading_key_depends_on_instance():
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell("secret = '101'")])
+    keys = {autograde.grading_key(nb, 'env', 'mode', index) for index in [None, 0, 1]}
+    assert len(keys) == 3
+
+
+def test_same_code_different_instances_not_shared(tmp_path, monkeypatch):
+    instances_module = pytest.importorskip('qiskit_textbook.problems.instances')
+    instances_path = str(tmp_path / 'simon.npy')
+    instances = instances_module.generate_instances('simon', 8, n=3, seed=1, jobs=1)
+    answers = [instances_module.expected_answer(record) for record in instances]
+    other = next(index for index, answer in enumerate(answers) if answer != answers[0])
+    instances_module.save_instances(instances_path, instances)
+    assignment = {'timeout': 60, 'instances': instances_path,
+                  'checks': [{'name': 'secret', 'type': 'answer', 'target': 'secret',
+                              'expected': 'expected_answer(instance)'}]}
+    cache_path = str(tmp_path / 'grades.sqlite')
+    grade_cache = autograde.GradeCache
+    monkeypatch.setattr(autograde, 'GradeCache', lambda: grade_cache(cache_path))
+
+    first = autograde.grade_submission(_submission(tmp_path / 's0.ipynb', 0, answers[0]), assignment, 'env')
+    second = autograde.grade_submission(_submission(tmp_path / 's1.ipynb', other, answers[0]), assignment, 'env')
+    assert autograde.score(first) == 1
+    assert not second['cached']
+    assert autograde.score(second) == 0